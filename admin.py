@@ -1,7 +1,8 @@
 """Renders admin pages for ops and other management tasks.
 
-Currently just /admin/responses, which shows active responses with tasks that
-haven't completed yet.
+/admin/responses shows active responses with tasks that haven't completed yet.
+/admin/entity shows a single entity with its compressed JSON properties decoded.
+/admin/seed_counters sets the front page counters' base values.
 """
 
 import datetime
@@ -9,10 +10,13 @@ import json
 
 import appengine_config
 from oauth_dropins.webutil import handlers
-from models import BlogPost, Response
+import models
+from models import Activity, BlogPost, Publish, Response, SyndicatedPostFilter
 import util
 
+from google.appengine.api import users
 from google.appengine.ext import ndb
+from google.appengine.ext.ndb.stats import KindStat, KindPropertyNameStat
 import webapp2
 
 # Import source class files so their metaclasses are initialized.
@@ -36,6 +40,7 @@ class ResponsesHandler(handlers.TemplateHandler):
     entities = []
 
     # Find the most recently attempted responses and blog posts with error URLs
+    responses = []
     for cls in BlogPost, Response:
       for e in cls.query().order(-cls.updated):
         if (len(entities) >= self.NUM_ENTITIES or
@@ -47,15 +52,20 @@ class ResponsesHandler(handlers.TemplateHandler):
         e.links = [util.pretty_link(u, new_tab=True) for u in e.error + e.failed]
         if e.key.kind() == 'Response':
           e.response = json.loads(e.response_json)
-          e.activities = [json.loads(a) for a in e.activities_json]
+          responses.append(e)
         else:
           e.response = {'content': '[BlogPost]'}
           e.activities = [{'url': e.key.id()}]
 
         entities.append(e)
 
+    for e, activities_json in zip(
+        responses, Response.load_activities_json_multi(responses)):
+      e.activities = [json.loads(a) for a in activities_json]
+
     entities.sort(key=lambda e: (e.source, e.activities, e.response))
-    return {'responses': entities}
+    return {'responses': entities,
+            'filter_hit_rates': SyndicatedPostFilter.hit_rates()}
 
 
 class MarkCompleteHandler(util.Handler):
@@ -68,7 +78,88 @@ class MarkCompleteHandler(util.Handler):
     self.redirect('/admin/responses')
 
 
+class EntityHandler(util.Handler):
+  """Shows an entity as JSON, with its JSON properties decoded.
+
+  Stands in for the admin console, which can't show compressed properties.
+  Only for admins, and only for kinds that don't have credentials.
+  """
+  KINDS = (Activity, BlogPost, Publish, Response)
+
+  def get(self):
+    if not users.is_current_user_admin():
+      self.abort(403)
+
+    key = ndb.Key(urlsafe=util.get_required_param(self, 'key'))
+    if key.kind() not in [cls._get_kind() for cls in self.KINDS]:
+      self.abort(400, 'Unsupported kind %s' % key.kind())
+
+    entity = key.get()
+    if not entity:
+      self.abort(404)
+
+    props = entity.to_dict()
+    for name, val in props.items():
+      if name.endswith('_json') or name.endswith('_jsons'):
+        if isinstance(val, list):
+          props[name] = [json.loads(v) for v in val]
+        elif val:
+          props[name] = json.loads(val)
+    if isinstance(entity, Response):
+      props['activities'] = [json.loads(a) for a in entity.load_activities_json()]
+
+    self.response.headers['Content-Type'] = 'application/json'
+    self.response.write(json.dumps(props, indent=2, default=unicode))
+
+
+class SeedCountersHandler(util.Handler):
+  """Sets the base value of each models.Counter from datastore statistics.
+
+  Run once, when the counters are first deployed. Datastore stats are up to a
+  day stale, so the counts may be a bit off.
+
+  https://developers.google.com/appengine/docs/python/ndb/admin#Statistics_queries
+  """
+  def post(self):
+    if not users.is_current_user_admin():
+      self.abort(403)
+
+    def count(query):
+      stat = query.get()  # no datastore stats in dev_appserver
+      return stat.count if stat else 0
+
+    def kind_count(kind):
+      return count(KindStat.query(KindStat.kind_name == kind))
+
+    links = sum(count(KindPropertyNameStat.query(
+                  KindPropertyNameStat.kind_name == kind,
+                  KindPropertyNameStat.property_name == property))
+                for kind in ('BlogPost', 'Response')
+                for property in ('sent', 'unsent', 'error', 'failed', 'skipped'))
+    sent = sum(count(KindPropertyNameStat.query(
+                 KindPropertyNameStat.kind_name == kind,
+                 KindPropertyNameStat.property_name == 'sent'))
+               for kind in ('BlogPost', 'Response'))
+
+    bases = {
+      'users': models.count_enabled_sources(),
+      'responses': kind_count('Response'),
+      'links': links,
+      'webmentions': sent,
+      'publishes': kind_count('Publish'),
+      'blogposts': kind_count('BlogPost'),
+      'webmentions_received': kind_count('BlogWebmention'),
+    }
+    for name, value in bases.items():
+      models.Counter.set_base(name, value)
+
+    self.response.headers['Content-Type'] = 'text/plain'
+    self.response.write(json.dumps(bases, indent=2))
+
+
 application = webapp2.WSGIApplication([
     ('/admin/responses', ResponsesHandler),
+    ('/admin/entity', EntityHandler),
+    ('/admin/seed_counters', SeedCountersHandler),
     ('/admin/mark_complete', MarkCompleteHandler),
     ], debug=appengine_config.DEBUG)
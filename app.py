@@ -4,7 +4,6 @@
 __author__ = ['Ryan Barrett <bridgy@ryanb.org>']
 
 import datetime
-import itertools
 import json
 import logging
 import urllib
@@ -12,7 +11,6 @@ import urlparse
 
 import appengine_config
 
-from granary import source as gr_source
 from oauth_dropins import blogger_v2 as oauth_blogger_v2
 from oauth_dropins import facebook as oauth_facebook
 from oauth_dropins import flickr as oauth_flickr
@@ -26,7 +24,8 @@ from blogger import Blogger
 from tumblr import Tumblr
 from wordpress_rest import WordPress
 import models
-from models import BlogPost, BlogWebmention, Publish, Response, Source
+from models import (BlogPost, BlogWebmention, DirectoryEntry, DomainIndex,
+                    Publish, Response, Source)
 import original_post_discovery
 import util
 
@@ -42,7 +41,6 @@ import wordpress_rest
 
 from google.appengine.api import memcache
 from google.appengine.ext import ndb
-from google.appengine.ext.ndb.stats import KindStat, KindPropertyNameStat
 import webapp2
 
 
@@ -81,9 +79,13 @@ class CachedPageHandler(DashboardHandler):
   * running in dev_appserver
   * there are any query params
   * there's a logins cookie
+
+  Serves expired pages while a render-page task re-renders them. That task
+  sets RERENDER_ENVIRON in its request to skip the cache and store the result.
   """
 
   EXPIRES = None  # subclasses can override
+  RERENDER_ENVIRON = 'bridgy.rerender_cached_page'
 
   @util.canonicalize_domain
   def get(self, cache=True):
@@ -92,19 +94,23 @@ class CachedPageHandler(DashboardHandler):
       return super(DashboardHandler, self).get()
 
     self.response.headers['Content-Type'] = self.content_type()
-    cached = util.CachedPage.load(self.request.path)
-    if cached:
-      self.response.write(cached.html)
-    else:
-      super(DashboardHandler, self).get()
-      util.CachedPage.store(self.request.path, self.response.body,
-                            expires=self.EXPIRES)
+    path = self.request.path
+    if not self.request.environ.get(self.RERENDER_ENVIRON):
+      cached = util.CachedPage.load(path)
+      if cached:
+        self.response.write(cached.html)
+        if cached.expired():
+          util.CachedPage.refresh(path, host_url=self.request.host_url)
+        return
+
+    super(DashboardHandler, self).get()
+    util.CachedPage.store(path, self.response.body, expires=self.EXPIRES)
 
 
 class FrontPageHandler(CachedPageHandler):
   """Handler for the front page."""
 
-  EXPIRES = datetime.timedelta(days=1)
+  EXPIRES = datetime.timedelta(minutes=10)
 
   # Facebook uses a POST instead of a GET when it renders us in Canvas.
   # http://stackoverflow.com/a/5353413/186123
@@ -114,50 +120,24 @@ class FrontPageHandler(CachedPageHandler):
     return 'templates/index.html'
 
   def template_vars(self):
-    """Use datastore stats to show stats for various things.
-
-    https://developers.google.com/appengine/docs/python/ndb/admin#Statistics_queries
-    """
-    def count(query):
-      stat = query.get()  # no datastore stats in dev_appserver
-      return stat.count if stat else 0
-
-    def kind_count(kind):
-      return count(KindStat.query(KindStat.kind_name == kind))
-
-    num_users = sum(kind_count(cls.__name__) for cls in models.sources.values())
-    link_counts = {
-      property: sum(count(KindPropertyNameStat.query(
-          KindPropertyNameStat.kind_name == kind,
-          KindPropertyNameStat.property_name == property))
-                    for kind in ('BlogPost', 'Response'))
-      for property in ('sent', 'unsent', 'error', 'failed', 'skipped')}
+    """Shows stats for various things from sharded models.Counters."""
+    counts = models.Counter.get_counts()
+    # each blog post is a webmention too
+    counts['webmentions'] += counts['blogposts']
 
     vars = super(FrontPageHandler, self).template_vars()
-
     # add comma separator between thousands
-    vars.update({k: '{:,}'.format(v) for k, v in {
-      'users': num_users,
-      'responses': kind_count('Response'),
-      'links': sum(link_counts.values()),
-      'webmentions': link_counts['sent'] + kind_count('BlogPost'),
-      'publishes': kind_count('Publish'),
-      'blogposts': kind_count('BlogPost'),
-      'webmentions_received': kind_count('BlogWebmention'),
-    }.items()})
+    vars.update({k: '{:,}'.format(v) for k, v in counts.items()})
     return vars
 
 
 class UsersHandler(CachedPageHandler):
   """Handler for /users.
 
-  Semi-optimized. Pages by source name. Queries each source type for results
-  with name greater than the start_name query param, then merge sorts the
-  results and truncates at PAGE_SIZE.
-
-  The start_name param is expected to be capitalized because capital letters
-  sort lexicographically before lower case letters. An alternative would be to
-  store a lower cased version of the name in another property and query on that.
+  Pages through DirectoryEntrys, which cover every silo, sorted by lower cased
+  name, with one query per page. The cursor query param is the urlsafe cursor
+  for the next page. The older start_name param starts at a given name. Cursors
+  are only valid for the query that made them, so next links keep start_name.
   """
 
   PAGE_SIZE = 100
@@ -171,26 +151,46 @@ class UsersHandler(CachedPageHandler):
     return 'templates/users.html'
 
   def template_vars(self):
+    cursor = self.request.get('cursor')
+    try:
+      cursor = ndb.Cursor(urlsafe=cursor) if cursor else None
+    except BaseException:
+      msg = "Couldn't parse cursor %r" % cursor
+      logging.exception(msg)
+      self.abort(400, msg)
+
+    query = DirectoryEntry.query()
     start_name = self.request.get('start_name')
-    queries = [cls.query(cls.name >= start_name).fetch_async(self.PAGE_SIZE)
-               for cls in models.sources.values()]
+    if start_name:
+      query = query.filter(DirectoryEntry.sort_name >= start_name.lower())
+    entries, next_cursor, more = query.order(DirectoryEntry.sort_name).fetch_page(
+      self.PAGE_SIZE, start_cursor=cursor)
 
-    sources = sorted(itertools.chain(*[q.get_result() for q in queries]),
-                     key=lambda s: (s.name.lower(), s.GR_CLASS.NAME))
-    sources = [self.preprocess_source(s) for s in sources
-               if s.name.lower() >= start_name.lower() and s.features
-               ][:self.PAGE_SIZE]
+    for entry in entries:
+      if entry.picture:
+        # convert image URL to https if we're serving over SSL
+        entry.picture = util.update_scheme(entry.picture, self)
 
     vars = super(UsersHandler, self).template_vars()
-    vars.update({
-        'sources': sources,
-        'PAGE_SIZE': self.PAGE_SIZE,
-        })
+    vars['sources'] = entries
+    if more and next_cursor:
+      params = [('cursor', next_cursor.urlsafe())]
+      if start_name:
+        params.append(('start_name', start_name.encode('utf-8')))
+      vars['next_link'] = '?' + urllib.urlencode(params)
     return vars
 
 
 class UserHandler(DashboardHandler):
   """Handler for a user page."""
+  PAGE_SIZE = 10
+
+  # Responses stored before the render fields existed don't have public set or
+  # indexed until the backfill_render_fields mapreduce re-puts them. While this
+  # is True, the responses list pages through all of a source's responses,
+  # computes render fields on the fly for those, and skips private ones, so
+  # some pages may come up short. Set it to False once the backfill has run.
+  RENDER_FIELDS_FALLBACK = True
 
   @util.canonicalize_domain
   def get(self, source_short_name, id):
@@ -237,114 +237,51 @@ class UserHandler(DashboardHandler):
       else:
         for domain in self.source.domains:
           if ('.blogspot.' in domain and  # Blogger uses country TLDs
-              not Blogger.query(Blogger.domains == domain).get()):
+              not DomainIndex.lookup(domain, silo=Blogger.SHORT_NAME)):
             vars['blogger_promo'] = True
           elif (domain.endswith('tumblr.com') and
-                not Tumblr.query(Tumblr.domains == domain).get()):
+                not DomainIndex.lookup(domain, silo=Tumblr.SHORT_NAME)):
             vars['tumblr_promo'] = True
           elif (domain.endswith('wordpress.com') and
-                not WordPress.query(WordPress.domains == domain).get()):
+                not DomainIndex.lookup(domain, silo=WordPress.SHORT_NAME)):
             vars['wordpress_promo'] = True
 
     # Responses
     if 'listen' in self.source.features:
-      vars['responses'] = []
-      query = Response.query().filter(Response.source == self.source.key)
-
-      # if there's a paging param (responses_before or responses_after), update
-      # query with it
-      def get_paging_param(param):
-        val = self.request.get(param)
-        try:
-          return util.parse_iso8601(val) if val else None
-        except:
-          msg = "Couldn't parse %s %r as ISO8601" % (param, val)
-          logging.exception(msg)
-          self.abort(400, msg)
-
-      before = get_paging_param('responses_before')
-      after = get_paging_param('responses_after')
-      if before and after:
-        self.abort(400, "can't handle both responses_before and responses_after")
-      elif after:
-        query = query.filter(Response.updated > after).order(Response.updated)
-      elif before:
-        query = query.filter(Response.updated < before).order(-Response.updated)
-      else:
-        query = query.order(-Response.updated)
-
-      query_iter = query.iter()
-      for i, r in enumerate(query_iter):
-        r.response = json.loads(r.response_json)
-        if r.activity_json:  # handle old entities
-          r.activities_json.append(r.activity_json)
-        r.activities = [json.loads(a) for a in r.activities_json]
-
-        if (not gr_source.Source.is_public(r.response) or
-            not all(gr_source.Source.is_public(a) for a in r.activities)):
-          continue
-        elif r.type == 'post':
-          r.activities = []
-
-        r.actor = r.response.get('author') or r.response.get('actor', {})
-
-        for a in r.activities + [r.response]:
-          if not a.get('content'):
-            a['content'] = a.get('object', {}).get('content')
-
-        if not r.response.get('content'):
-          phrases = {
-            'like': 'liked this',
-            'repost': 'reposted this',
-            'rsvp-yes': 'is attending',
-            'rsvp-no': 'is not attending',
-            'rsvp-maybe': 'might attend',
-            'invite': 'is invited',
-          }
-          r.response['content'] = '%s %s.' % (
-            r.actor.get('displayName') or '',
-            phrases.get(r.type) or phrases.get(r.response.get('verb')))
-
-        # convert image URL to https if we're serving over SSL
-        image_url = r.actor.setdefault('image', {}).get('url')
-        if image_url:
-          r.actor['image']['url'] = util.update_scheme(image_url, self)
+      query = Response.query(Response.source == self.source.key)
+      if not self.RENDER_FIELDS_FALLBACK:
+        query = query.filter(Response.public == True)
+      responses = self.paginate(vars, 'responses', query, Response.updated)
+
+      legacy = [r for r in responses if r.public is None and r.response_json]
+      for r, activities in zip(legacy,
+                               Response.load_activities_json_multi(legacy)):
+        # stored before the render fields existed. compute them from the JSON.
+        r.set_render_fields(json.loads(r.response_json),
+                            [json.loads(a) for a in activities])
+
+      vars['responses'] = [r for r in responses if r.public]
+      for r in vars['responses']:
+        r.response = {'url': r.response_url, 'content': r.response_content}
+        r.activities = [{'url': url, 'content': content} for url, content in
+                        zip(r.activity_link_urls, r.activity_contents)]
+        r.actor = {
+          'displayName': r.actor_name,
+          'url': r.actor_url,
+          # convert image URL to https if we're serving over SSL
+          'image': ({'url': util.update_scheme(r.actor_image, self)}
+                    if r.actor_image else {}),
+        }
 
         # generate original post links
         r.links = self.process_webmention_links(r)
         r.original_links = [util.pretty_link(url, new_tab=True)
                             for url in r.original_posts]
 
-        vars['responses'].append(r)
-        if len(vars['responses']) >= 10 or i > 200:
-          break
-
-      vars['responses'].sort(key=lambda r: r.updated, reverse=True)
-
-      # calculate new paging param(s)
-      new_after = (
-        before if before else
-        vars['responses'][0].updated if
-          vars['responses'] and query_iter.probably_has_next() and (before or after)
-        else None)
-      if new_after:
-        vars['responses_after_link'] = ('?responses_after=%s#responses' %
-                                         new_after.isoformat())
-
-      new_before = (
-        after if after else
-        vars['responses'][-1].updated if
-          vars['responses'] and query_iter.probably_has_next()
-        else None)
-      if new_before:
-        vars['responses_before_link'] = ('?responses_before=%s#responses' %
-                                         new_before.isoformat())
-
     # Publishes
     if 'publish' in self.source.features:
-      publishes = Publish.query().filter(Publish.source == self.source.key)\
-                                 .order(-Publish.updated)\
-                                 .fetch(10)
+      publishes = self.paginate(vars, 'publishes', Publish.query(
+        Publish.source == self.source.key), Publish.updated)
       for p in publishes:
         p.pretty_page = util.pretty_link(
           p.key.parent().id(), attrs={'class': 'original-post'}, new_tab=True)
@@ -353,9 +290,8 @@ class UserHandler(DashboardHandler):
 
     if 'webmention' in self.source.features:
       # Blog posts
-      blogposts = BlogPost.query().filter(BlogPost.source == self.source.key)\
-                                  .order(-BlogPost.created)\
-                                  .fetch(10)
+      blogposts = self.paginate(vars, 'blogposts', BlogPost.query(
+        BlogPost.source == self.source.key), BlogPost.created)
       for b in blogposts:
         b.links = self.process_webmention_links(b)
         try:
@@ -367,10 +303,8 @@ class UserHandler(DashboardHandler):
           max_length=40, new_tab=True)
 
       # Blog webmentions
-      webmentions = BlogWebmention.query()\
-          .filter(BlogWebmention.source == self.source.key)\
-          .order(-BlogWebmention.updated)\
-          .fetch(10)
+      webmentions = self.paginate(vars, 'webmentions', BlogWebmention.query(
+        BlogWebmention.source == self.source.key), BlogWebmention.updated)
       for w in webmentions:
         w.pretty_source = util.pretty_link(
           w.source_url(), attrs={'class': 'original-post'}, new_tab=True)
@@ -387,6 +321,57 @@ class UserHandler(DashboardHandler):
 
     return vars
 
+  def paginate(self, vars, name, query, prop):
+    """Fetches one page of a query's results, newest first, with cursors.
+
+    The NAME_before and NAME_after query params are urlsafe cursors for the
+    pages older and newer than this one. Adds NAME_before_link and
+    NAME_after_link to vars for the pages that exist.
+
+    Args:
+      vars: dict, template vars
+      name: string, e.g. 'responses'. Also the page's anchor for this list.
+      query: ndb.Query
+      prop: ndb.DateTimeProperty to sort by
+
+    Returns: list of entities
+    """
+    def get_paging_param(param):
+      val = self.request.get(param)
+      try:
+        return ndb.Cursor(urlsafe=val) if val else None
+      except BaseException:
+        msg = "Couldn't parse %s %r as a cursor" % (param, val)
+        logging.exception(msg)
+        self.abort(400, msg)
+
+    before = get_paging_param(name + '_before')
+    after = get_paging_param(name + '_after')
+    if before and after:
+      self.abort(400, "can't handle both %s_before and %s_after" % (name, name))
+
+    if after:
+      # walk backward from the start of the page after this one
+      results, cursor, more = query.order(prop).fetch_page(
+        self.PAGE_SIZE, start_cursor=after.reversed())
+      results.reverse()
+      newer = cursor.reversed() if more else None
+      older = after
+    else:
+      results, cursor, more = query.order(-prop).fetch_page(
+        self.PAGE_SIZE, start_cursor=before)
+      newer = before
+      older = cursor if more else None
+
+    if newer:
+      vars['%s_after_link' % name] = '?%s_after=%s#%s' % (
+        name, newer.urlsafe(), name)
+    if older:
+      vars['%s_before_link' % name] = '?%s_before=%s#%s' % (
+        name, older.urlsafe(), name)
+
+    return results
+
   def process_webmention_links(self, e):
     """Generates pretty HTML for the links in a BlogWebmention entity.
 
@@ -541,6 +526,8 @@ class RetryHandler(util.Handler):
     entity = ndb.Key(urlsafe=util.get_required_param(self, 'key')).get()
     if not entity:
       self.abort(400, 'key not found')
+    elif entity.key.kind() == 'Response' and not entity.response_json:
+      self.abort(400, 'response has been archived')
 
     # start all target URLs over
     if entity.status == 'complete':
@@ -555,7 +542,7 @@ class RetryHandler(util.Handler):
     # retry won't make us pick it up. background in #524.
     if entity.key.kind() == 'Response':
       source = entity.source.get()
-      for activity in [json.loads(a) for a in entity.activities_json]:
+      for activity in [json.loads(a) for a in entity.load_activities_json()]:
         originals, mentions = original_post_discovery.discover(
           source, activity, fetch_hfeed=False, include_redirect_sources=False)
         targets |= original_post_discovery.targets_for_response(
@@ -48,11 +48,10 @@ class BlogWebmentionHandler(webmention.WebmentionHandler):
     # look up source by domain
     source_cls = models.sources[source_short_name]
     domain = domain.lower()
-    self.source = (source_cls.query()
-                   .filter(source_cls.domains == domain)
-                   .filter(source_cls.features == 'webmention')
-                   .filter(source_cls.status == 'enabled')
-                   .get())
+    entries = models.DomainIndex.lookup(
+      domain, silo=source_cls.SHORT_NAME, feature='webmention', status='enabled')
+    self.source = (models.Source.get_cached(entries[0].source) if entries
+                   else None)
     if not self.source:
       return self.error(
         'Could not find %s account for %s. Is it registered with Bridgy?' %
@@ -119,8 +118,10 @@ class BlogWebmentionHandler(webmention.WebmentionHandler):
       msg = 'Error: %s %s; %s' % (code, e, body)
       if code == '401':
         logging.warning('Disabling source!')
-        self.source.status = 'disabled'
-        self.source.put()
+        # self.source came from the cache, so don't put it
+        source = self.source.key.get()
+        source.status = 'disabled'
+        source.put()
         return self.error(msg, status=code, mail=False)
       elif code == '404':
         # post is gone
@@ -133,6 +134,7 @@ class BlogWebmentionHandler(webmention.WebmentionHandler):
     # write results to datastore
     self.entity.status = 'complete'
     self.entity.put()
+    models.Counter.increment('webmentions_received')
     self.response.write(json.dumps(self.entity.published))
 
   def find_mention_item(self, data):
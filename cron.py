@@ -1,4 +1,4 @@
-"""Cron jobs. Currently just minor cleanup tasks.
+"""Cron jobs. Currently just minor cleanup tasks and garbage collection.
 """
 
 __author__ = ['Ryan Barrett <bridgy@ryanb.org>']
@@ -16,6 +16,7 @@ from models import Source
 from instagram import Instagram
 from twitter import Twitter
 from flickr import Flickr
+import tasks
 import util
 import webapp2
 
@@ -79,8 +80,39 @@ def maybe_update_picture(source, new_actor, handler):
   util.CachedPage.invalidate('/users')
 
 
+class GarbageCollect(webapp2.RequestHandler):
+  """Starts a gc task for each retention policy in tasks.RETENTION.
+
+  Request parameters:
+    policy: string, only start this policy. Optional.
+    dry_run: 'true' to only report what would be collected
+  """
+
+  def get(self):
+    policy = self.request.get('policy')
+    dry_run = self.request.get('dry_run') == 'true'
+    for name in sorted(tasks.RETENTION):
+      if not policy or name == policy:
+        util.add_gc_task(name, dry_run=dry_run)
+
+
+class ReseedCounters(webapp2.RequestHandler):
+  """Resets the users counter to the number of enabled sources.
+
+  Signups increment it, but disabling or deleting a source doesn't decrement
+  it. See models.Counter.
+  """
+
+  def get(self):
+    count = models.count_enabled_sources()
+    logging.info('Resetting users counter to %d', count)
+    models.Counter.reset('users', count)
+
+
 application = webapp2.WSGIApplication([
     ('/cron/replace_poll_tasks', ReplacePollTasks),
     ('/cron/update_instagram_pictures', UpdateInstagramPictures),
     ('/cron/update_flickr_pictures', UpdateFlickrPictures),
+    ('/cron/gc', GarbageCollect),
+    ('/cron/reseed_counters', ReseedCounters),
     ], debug=appengine_config.DEBUG)
@@ -80,8 +80,8 @@ class FacebookPage(models.Source):
   username = ndb.StringProperty()
   # inferred from syndication URLs if username isn't available
   inferred_username = ndb.StringProperty()
-  # maps string post ids to string facebook object ids or None. background:
-  # https://github.com/snarfed/bridgy/pull/513#issuecomment-149312879
+  # DEPRECATED. Moved to SourceState. Only read to migrate old entities.
+  # background: https://github.com/snarfed/bridgy/pull/513#issuecomment-149312879
   resolved_object_ids_json = ndb.TextProperty(compressed=True)
 
   @staticmethod
@@ -191,7 +191,9 @@ class FacebookPage(models.Source):
     """Resolve a post id to its Facebook object id, if any.
 
     Wraps granary.facebook.Facebook.resolve_object_id() and uses
-    self.resolved_object_ids_json as a cache.
+    SourceState.resolved_object_ids_json as a cache. New resolutions are stored
+    in self.updates['resolved_object_ids_json'], capped at
+    MAX_RESOLVED_OBJECT_IDS, for Source.put_updates() to write.
 
     Args:
       post_id: string Facebook post id
@@ -207,31 +209,21 @@ class FacebookPage(models.Source):
       post_id = parsed.post
 
     resolved = self.updates.setdefault('resolved_object_ids', {})
-    if self.resolved_object_ids_json and not resolved:
-      resolved = self.updates['resolved_object_ids'] = json.loads(
-        self.resolved_object_ids_json)
+    stored = self.load_state().resolved_object_ids_json
+    if stored and not resolved:
+      resolved = self.updates['resolved_object_ids'] = json.loads(stored)
 
     if post_id not in resolved:
       resolved[post_id] = self.gr_source.resolve_object_id(
         self.key.id(), post_id, activity=activity)
+      keep = heapq.nlargest(
+        MAX_RESOLVED_OBJECT_IDS,
+        (int(id) if util.is_int(id) else id for id in resolved.keys()))
+      self.updates['resolved_object_ids_json'] = json.dumps(
+        {str(id): resolved[str(id)] for id in keep})
 
     return resolved[post_id]
 
-  def _pre_put_hook(self):
-    """Encode updates['resolved_object_ids'] into resolved_object_ids_json.
-
-    ...and cap it at MAX_RESOLVED_OBJECT_IDS.
-    """
-    if self.updates:
-      resolved = self.updates.get('resolved_object_ids')
-      if resolved:
-        keep = heapq.nlargest(
-          MAX_RESOLVED_OBJECT_IDS,
-          (int(id) if util.is_int(id) else id for id in resolved.keys()))
-        logging.info('Saving %s resolved Facebook post ids.', len(keep))
-        self.resolved_object_ids_json = json.dumps(
-          {str(id): resolved[str(id)] for id in keep})
-
   def infer_profile_url(self, url):
     """Find a Facebook profile URL (ideally the one with the user's numeric ID)
 
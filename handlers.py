@@ -19,6 +19,8 @@ URL paths are:
 """
 
 import copy
+import datetime
+import hashlib
 import json
 import logging
 import re
@@ -32,6 +34,9 @@ from oauth_dropins.webutil import handlers
 import models
 import original_post_discovery
 import util
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
 import webapp2
 
 # Import source class files so their metaclasses are initialized.
@@ -41,6 +46,18 @@ import googleplus
 import instagram
 import twitter
 
+# Rendered output cache. Entries are fresh for RENDER_CACHE_FRESH. After that,
+# one request at a time re-renders them while the others are served the stale
+# copy, until RENDER_CACHE_TTL.
+RENDER_CACHE_FRESH = datetime.timedelta(minutes=5)
+RENDER_CACHE_TTL = datetime.timedelta(hours=1)
+RENDER_CACHE_LOCK_TTL = 60  # seconds
+
+# Stored Responses updated longer ago than this are refetched from the silo
+# instead. Receivers usually fetch right after we send, and propagate tasks
+# give up after a day.
+STORED_RESPONSE_MAX_AGE = datetime.timedelta(days=1)
+
 TEMPLATE = string.Template("""\
 <!DOCTYPE html>
 <html>
@@ -78,7 +95,8 @@ class ItemHandler(webapp2.RequestHandler):
   VALID_ID = re.compile(r'^[\w.+:@-]+$')
 
   def head(self, *args):
-    """Return an empty 200 with no caching directives."""
+    """Same as GET, including validators. App Engine drops the body."""
+    self.get(*args)
 
   def get_item(self, id):
     """Fetches and returns an object from the given source.
@@ -101,6 +119,94 @@ class ItemHandler(webapp2.RequestHandler):
     """
     return obj.get('title') or obj.get('content') or 'Bridgy Response'
 
+  def get_stored(self, type, post_id, response_id=None):
+    """Looks up a fresh stored Response and its activity for this item.
+
+    Like, repost, and RSVP Response key ids are tag URIs with silo-specific
+    names, e.g. POST_ID_favorited_by_USER_ID, so we find them with a keys-only
+    prefix scan on POST_ID_ and match the USER_ID suffix and type. Some silos,
+    e.g. Twitter, key reposts by the repost's own id instead, so we also try
+    that for reposts.
+
+    Stored responses and activities are pruned, so they're missing tags and
+    other fields that original post discovery uses. We also return the
+    Response's webmention targets so that discover() can fill those back in.
+
+    Args:
+      type: string, 'post', 'comment', 'like', 'repost', or 'rsvp'
+      post_id: string, site-specific post or event id
+      response_id: string, site-specific comment id, or id of the user who
+        liked, reposted, or RSVPed. Unused for posts.
+
+    Returns: (ActivityStreams response dict, activity dict, set of string
+      target URLs) tuple, or (None, None, None) if we don't have a fresh stored
+      copy. The activity is the response itself for posts.
+    """
+    tag_uri = self.source.gr_source.tag_uri
+    if type == 'post':
+      candidates = [models.Response.get_by_id(tag_uri(post_id))]
+    elif type == 'comment':
+      candidates = [models.Response.get_by_id(tag_uri(response_id))]
+    else:
+      prefix = tag_uri(post_id + '_')
+      query = models.Response.query(
+        models.Response.key >= ndb.Key(models.Response, prefix),
+        models.Response.key < ndb.Key(models.Response, prefix + u'\ufffd'))
+      keys = [k for k in query.fetch(keys_only=True)
+              if k.string_id().endswith('_' + response_id)]
+      if type == 'repost':
+        keys.append(ndb.Key(models.Response, tag_uri(response_id)))
+      candidates = ndb.get_multi(keys)
+
+    resp = next((r for r in candidates if r and r.type == type and
+                 r.source == self.source.key), None)
+    if not resp or not resp.response_json:  # missing or archived by gc
+      return None, None, None
+    elif resp.updated < util.now_fn() - STORED_RESPONSE_MAX_AGE:
+      logging.info('Stored response %s is stale', resp.key.string_id())
+      return None, None, None
+
+    obj = json.loads(resp.response_json)
+    targets = set(resp.sent + resp.unsent + resp.error + resp.failed +
+                  resp.skipped + resp.original_posts)
+    if type == 'post':
+      return obj, obj, targets
+
+    # use the activity for this post if the response has more than one
+    activities = [json.loads(a) for a in resp.load_activities_json()]
+    for activity in activities:
+      parsed = util.parse_tag_uri(activity.get('id', ''))
+      if parsed and parsed[1] == post_id:
+        return obj, activity, targets
+    if activities:
+      return obj, activities[0], targets
+    return None, None, None
+
+  def discover(self, post, type, targets=None):
+    """Runs original post discovery on an item's post, without fetching h-feed.
+
+    If targets is provided, any of them that discovery doesn't find are added
+    too. Only posts and comments are sent to mentions, so for comments,
+    targets on one of the source's domains are added as originals and the rest
+    as mentions.
+
+    Args:
+      post: ActivityStreams activity dict
+      type: string, 'post', 'comment', 'like', 'repost', or 'rsvp'
+      targets: set of string URLs, a stored Response's webmention targets
+
+    Returns: (set of string original post URLs, set of string mention URLs)
+    """
+    originals, mentions = original_post_discovery.discover(
+      self.source, post, fetch_hfeed=False)
+    for url in (targets or set()) - originals - mentions:
+      if type == 'post' or (type == 'comment' and not util.domain_or_parent_in(
+          util.domain_from_link(url), self.source.domains)):
+        mentions.add(url)
+      else:
+        originals.add(url)
+    return originals, mentions
+
   def get_post(self, id, is_event=False):
     """Fetch a post.
 
@@ -125,13 +231,37 @@ class ItemHandler(webapp2.RequestHandler):
       if not util.interpret_http_exception(e)[0]:
         logging.warning('Error fetching source post %s', id, exc_info=True)
 
+  def get_with_post(self, get_fn, post_id, is_event=False):
+    """Fetches an item and its post from the silo in parallel.
+
+    Errors are reported the same way as when they're fetched serially:
+    exceptions from get_fn propagate, and get_post() logs its own and returns
+    None.
+
+    Both run in threads with their own ndb contexts. See util.run_parallel().
+    Do datastore work that the rest of the request depends on, e.g. stored
+    Response lookups, here on the request thread before calling this.
+
+    Args:
+      get_fn: no-argument function that fetches and returns the item
+      post_id: string, site-specific post or event id
+      is_event: bool
+
+    Returns: (item, post) tuple of ActivityStreams object dicts
+    """
+    item, post = util.run_parallel(lambda fn: fn(), (
+      get_fn, lambda: self.get_post(post_id, is_event=is_event)))
+    return item, post
+
+  # so that async writes, e.g. ResolvedUrls, finish before the request ends
+  @ndb.toplevel
   def get(self, type, source_short_name, string_id, *ids):
     source_cls = models.sources.get(source_short_name)
     if not source_cls:
       self.abort(400, "Source type '%s' not found. Known sources: %s" %
                  (source_short_name, filter(None, models.sources.keys())))
 
-    self.source = source_cls.get_by_id(string_id)
+    self.source = models.Source.get_cached(ndb.Key(source_cls, string_id))
     if not self.source:
       self.abort(400, 'Source %s %s not found' % (source_short_name, string_id))
 
@@ -143,6 +273,84 @@ class ItemHandler(webapp2.RequestHandler):
       if not self.VALID_ID.match(id):
         self.abort(404, 'Invalid id %s' % id)
 
+    # rendered output is keyed by the source's render version, which changes
+    # whenever one of its responses is new or changed. see Response.
+    # image URLs depend on the request's scheme, so it's part of the key too.
+    version_key = models.Response.render_version_key(self.source.key)
+    cache_key = 'R %s %s %s %s %s' % (self.request.scheme, type,
+                                      self.source.key.urlsafe(), ' '.join(ids),
+                                      format)
+    got = memcache.get_multi([version_key, cache_key])
+    version = got.get(version_key) or 0
+    cached = got.get(cache_key)
+    if cached and cached['version'] != version:
+      cached = None
+
+    now = util.now_fn()
+    if cached:
+      fresh = now - cached['rendered'] < RENDER_CACHE_FRESH
+      if fresh or not memcache.add(cache_key + ' lock', '',
+                                   time=RENDER_CACHE_LOCK_TTL):
+        self.write_cached(cached)
+        return
+
+    self.render(source_short_name, string_id, type, ids, format)
+
+    if self.response.status_int == 200:
+      cached = {
+        'version': version,
+        'rendered': now,
+        'content_type': self.response.headers['Content-Type'],
+        'body': self.response.body,
+      }
+      memcache.set(cache_key, cached, time=int(RENDER_CACHE_TTL.total_seconds()))
+    elif cached:
+      logging.info('Re-rendering failed, serving stale copy from %s',
+                   cached['rendered'])
+    else:
+      return
+
+    self.response.clear()
+    self.response.status_int = 200
+    self.write_cached(cached)
+
+  def write_cached(self, cached):
+    """Writes a render cache entry to the response.
+
+    Adds a strong ETag of the body, Last-Modified, and Cache-Control, and
+    answers conditional requests that match with a 304. If-None-Match takes
+    precedence over If-Modified-Since, per RFC 7232.
+
+    Args:
+      cached: dict render cache entry
+    """
+    body = cached['body']
+    etag = hashlib.sha1(body).hexdigest()
+    rendered = cached['rendered'].replace(microsecond=0)
+    self.response.headers['Access-Control-Allow-Origin'] = '*'
+    self.response.headers['Cache-Control'] = 'public, max-age=%d' % (
+      RENDER_CACHE_FRESH.total_seconds())
+    self.response.etag = etag
+    self.response.last_modified = rendered
+
+    if self.request.headers.get('If-None-Match'):
+      not_modified = etag in self.request.if_none_match
+    else:
+      since = self.request.if_modified_since
+      not_modified = since and since.replace(tzinfo=None) >= rendered
+
+    if not_modified:
+      self.response.status_int = 304
+      return
+
+    self.response.headers['Content-Type'] = cached['content_type']
+    self.response.out.write(body)
+
+  def render(self, source_short_name, string_id, type, ids, format):
+    """Fetches the object and writes it to the response as HTML or JSON.
+
+    If the silo returns an HTTP error, writes that instead.
+    """
     label = '%s:%s %s %s' % (source_short_name, string_id, type, ids)
     logging.info('Fetching %s', label)
     try:
@@ -222,13 +430,15 @@ class ItemHandler(webapp2.RequestHandler):
 # likes, reposts, or rsvps. Matches logic in poll() (step 4) in tasks.py!
 class PostHandler(ItemHandler):
   def get_item(self, id):
-    posts = self.source.get_activities(activity_id=id, user_id=self.source.key.id())
-    post = posts[0] if posts else None
+    post, _, targets = self.get_stored('post', id)
     if not post:
-      return None
+      posts = self.source.get_activities(activity_id=id,
+                                         user_id=self.source.key.id())
+      post = posts[0] if posts else None
+      if not post:
+        return None
 
-    originals, mentions = original_post_discovery.discover(
-      self.source, post, fetch_hfeed=False)
+    originals, mentions = self.discover(post, 'post', targets)
     obj = post['object']
     obj['upstreamDuplicates'] = list(
       set(util.get_list(obj, 'upstreamDuplicates')) | originals)
@@ -238,14 +448,16 @@ class PostHandler(ItemHandler):
 
 class CommentHandler(ItemHandler):
   def get_item(self, post_id, id):
-    cmt = self.source.gr_source.get_comment(
-      id, activity_id=post_id, activity_author_id=self.source.key.id())
+    cmt, post, targets = self.get_stored('comment', post_id, id)
     if not cmt:
-      return None
-    post = self.get_post(post_id)
+      cmt, post = self.get_with_post(
+        lambda: self.source.gr_source.get_comment(
+          id, activity_id=post_id, activity_author_id=self.source.key.id()),
+        post_id)
+      if not cmt:
+        return None
     if post:
-      originals, mentions = original_post_discovery.discover(
-        self.source, post, fetch_hfeed=False)
+      originals, mentions = self.discover(post, 'comment', targets)
       self.merge_urls(cmt, 'inReplyTo', originals)
       self.merge_urls(cmt, 'tags', mentions, object_type='mention')
     return cmt
@@ -253,13 +465,16 @@ class CommentHandler(ItemHandler):
 
 class LikeHandler(ItemHandler):
   def get_item(self, post_id, user_id):
-    like = self.source.get_like(self.source.key.string_id(), post_id, user_id)
+    like, post, targets = self.get_stored('like', post_id, user_id)
     if not like:
-      return None
-    post = self.get_post(post_id)
+      like, post = self.get_with_post(
+        lambda: self.source.get_like(self.source.key.string_id(), post_id,
+                                     user_id),
+        post_id)
+      if not like:
+        return None
     if post:
-      originals, mentions = original_post_discovery.discover(
-        self.source, post, fetch_hfeed=False)
+      originals, mentions = self.discover(post, 'like', targets)
       self.merge_urls(like, 'object', originals)
     return like
 
@@ -280,33 +495,37 @@ class LikeHandler(ItemHandler):
 
 class RepostHandler(ItemHandler):
   def get_item(self, post_id, share_id):
-    repost = self.source.gr_source.get_share(
-      self.source.key.string_id(), post_id, share_id)
+    repost, post, targets = self.get_stored('repost', post_id, share_id)
     if not repost:
-      return None
+      repost, post = self.get_with_post(
+        lambda: self.source.gr_source.get_share(
+          self.source.key.string_id(), post_id, share_id),
+        post_id)
+      if not repost:
+        return None
     # webmention receivers don't want to see their own post in their
     # comments, so remove content before rendering.
     for key in 'content', 'attachments':
       if key in repost:
         del repost[key]
-    post = self.get_post(post_id)
     if post:
-      originals, mentions = original_post_discovery.discover(
-        self.source, post, fetch_hfeed=False)
+      originals, mentions = self.discover(post, 'repost', targets)
       self.merge_urls(repost, 'object', originals)
     return repost
 
 
 class RsvpHandler(ItemHandler):
   def get_item(self, event_id, user_id):
-    rsvp = self.source.gr_source.get_rsvp(
-      self.source.key.string_id(), event_id, user_id)
+    rsvp, event, targets = self.get_stored('rsvp', event_id, user_id)
     if not rsvp:
-      return None
-    event = self.get_post(event_id, is_event=True)
+      rsvp, event = self.get_with_post(
+        lambda: self.source.gr_source.get_rsvp(
+          self.source.key.string_id(), event_id, user_id),
+        event_id, is_event=True)
+      if not rsvp:
+        return None
     if event:
-      originals, mentions = original_post_discovery.discover(
-        self.source, event, fetch_hfeed=False)
+      originals, mentions = self.discover(event, 'rsvp', targets)
       self.merge_urls(rsvp, 'inReplyTo', originals)
     return rsvp
 
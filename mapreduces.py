@@ -11,6 +11,7 @@ import gc
 import json
 
 from mapreduce import operation as op
+import models
 import util
 
 
@@ -24,3 +25,71 @@ def prune_activity_json(response):
   # helps avoid hitting the instance memory limit
   gc.collect()
   yield op.db.Put(response)
+
+
+def backfill_activity_urls(response):
+  """Populate Response.activity_urls for Responses stored before it existed.
+
+  Also folds the deprecated activity_json property into activities_json.
+  """
+  if response.activity_urls:
+    return
+
+  source = response.source.get()
+  if not source:
+    return
+
+  if response.activity_json:
+    response.activities_json.append(response.activity_json)
+    response.activity_json = None
+
+  response.activity_urls = models.Response.canonical_activity_urls(
+    source, [json.loads(a) for a in response.load_activities_json()])
+  if response.activity_urls:
+    yield op.db.Put(response)
+
+
+def migrate_activities(response):
+  """Moves a Response's inline activities_json into shared Activity entities.
+  """
+  activities_json = response.load_activities_json()
+  if not activities_json or not (response.activities_json or
+                                 response.activity_json):
+    return
+
+  # normalize so these hash the same as activities stored by polls
+  response.activity_keys = models.Activity.store_multi(
+    [json.dumps(json.loads(a), sort_keys=True) for a in activities_json])
+  response.activities_json = []
+  response.activity_json = None
+  yield op.db.Put(response)
+
+
+def backfill_render_fields(response):
+  """Populates Response.public and the other render fields, and indexes public.
+
+  Responses stored before the render fields existed have public None, and ones
+  stored before public was indexed aren't in its index, so user pages can't
+  find either.
+  """
+  if response.public is None and response.response_json:
+    response.set_render_fields(
+      json.loads(response.response_json),
+      [json.loads(a) for a in response.load_activities_json()])
+  yield op.db.Put(response)
+
+
+def backfill_directory(source):
+  """Adds a Source that hasn't been written since DirectoryEntry existed to it.
+
+  Run once per Source kind.
+  """
+  models.DirectoryEntry.update_source(source)
+
+
+def backfill_domain_index(source):
+  """Adds a Source that hasn't been written since DomainIndex existed to it.
+
+  Run once per Source kind.
+  """
+  models.DomainIndex.update_source(source)
@@ -1,11 +1,17 @@
 """Datastore model classes.
 """
 
+import collections
 import datetime
+import hashlib
+import itertools
 import json
 import logging
 import pprint
+import random
 import re
+import struct
+import threading
 
 import appengine_config
 from appengine_config import HTTP_TIMEOUT
@@ -17,6 +23,10 @@ from webmentiontools import send
 import superfeedr
 import util
 
+from google.appengine.api import memcache
+from google.appengine.api.datastore import MAX_ALLOWABLE_QUERIES
+from google.appengine.datastore import entity_pb
+from google.appengine.api.datastore_types import _MAX_STRING_LENGTH
 from google.appengine.ext import ndb
 
 VERB_TYPES = ('post', 'comment', 'like', 'repost', 'rsvp')
@@ -47,6 +57,26 @@ def get_type(obj):
     return 'post'
 
 
+def count_enabled_sources():
+  """Returns the number of enabled sources, across all silos."""
+  return sum(cls.query(cls.status == 'enabled').count()
+             for cls in sources.values())
+
+
+def _log_errors(fn, *args, **kwargs):
+  """Calls fn(*args, **kwargs) and logs any exception instead of raising it.
+
+  For work that runs after a write has already committed, e.g. updating
+  indices, so that callers don't see a failure for a successful write.
+  """
+  try:
+    fn(*args, **kwargs)
+  except AssertionError:
+    raise  # for unit tests
+  except Exception:
+    logging.error('%s failed after commit', fn.__name__, exc_info=True)
+
+
 class DisableSource(Exception):
   """Raised when a user has deauthorized our app inside a given platform.
   """
@@ -78,6 +108,11 @@ class Source(StringIdModel):
   POLL_STATUSES = ('ok', 'error', 'polling')
   FEATURES = ('listen', 'publish', 'webmention')
 
+  # get_cached() cache lifetime, and serialization format version. Bump
+  # CACHE_FORMAT when Source properties change incompatibly.
+  CACHE_TTL = datetime.timedelta(minutes=10)
+  CACHE_FORMAT = 1
+
   # short name for this site type. used in URLs, etc.
   SHORT_NAME = None
   # the corresponding granary class
@@ -130,6 +165,9 @@ class Source(StringIdModel):
 
   last_activity_id = ndb.StringProperty()
   last_activities_etag = ndb.StringProperty()
+
+  # DEPRECATED. Moved to SourceState. Only read to migrate old entities. See
+  # load_state().
   last_activities_cache_json = ndb.TextProperty()
   seen_responses_cache_json = ndb.TextProperty(compressed=True)
 
@@ -137,10 +175,19 @@ class Source(StringIdModel):
   # limited. it can be used e.g. to modify the poll period.
   rate_limited = False
 
+  # this is set temporarily, in memory only, by task handlers that crawl the
+  # user's web site. it's a datetime when the current request will hit its
+  # deadline. original_post_discovery stops crawling permalinks before then.
+  crawl_deadline = None
+
   # maps updated property names to values that put_updates() writes back to the
-  # datastore transactionally. set this to {} before beginning.
+  # datastore transactionally. set this to {} before beginning. SourceState
+  # property names are written to the SourceState instead.
   updates = None
 
+  # this source's SourceState, cached in memory by load_state().
+  _state = None
+
   # gr_source is *not* set to None by default here, since it needs to be unset
   # for __getattr__ to run when it's accessed.
 
@@ -176,6 +223,88 @@ class Source(StringIdModel):
     """
     return ndb.Key(cls, id).get()
 
+  @staticmethod
+  def get_cached(key):
+    """Returns the source with the given key, via a read-through memcache cache.
+
+    Only for read-only code paths! The returned source may be up to CACHE_TTL
+    stale if an invalidation is lost, and changes to it must not be put.
+    Transactions always bypass the cache.
+
+    Cache entries are keyed by a per-source version number that every put
+    increments, so a reader that raced with a put can't cache stale data under
+    the new version.
+
+    Args:
+      key: ndb.Key
+
+    Returns: Source, or None if it doesn't exist
+    """
+    return Source.get_cached_multi([key])[0]
+
+  @staticmethod
+  def get_cached_multi(keys):
+    """Like get_cached(), but for many sources, with batch gets.
+
+    Args:
+      keys: sequence of ndb.Key
+
+    Returns: list of Sources, or None for ones that don't exist, in the same
+      order as keys
+    """
+    keys = list(keys)
+    if ndb.in_transaction():
+      return ndb.get_multi(keys)
+
+    version_keys = [Source._cache_version_key(key) for key in keys]
+    versions = memcache.get_multi(version_keys)
+    cache_keys = ['Source %s %s %s' % (Source.CACHE_FORMAT, key.urlsafe(),
+                                       versions.get(version_key) or 0)
+                  for key, version_key in zip(keys, version_keys)]
+    cached = memcache.get_multi(cache_keys)
+
+    misses = [key for key, cache_key in zip(keys, cache_keys)
+              if cache_key not in cached]
+    fetched = dict(zip(misses, ndb.get_multi(misses)))
+    to_cache = {cache_key: ndb.model_to_protobuf(fetched[key]).Encode()
+                for key, cache_key in zip(keys, cache_keys)
+                if fetched.get(key)}
+    if to_cache:
+      memcache.set_multi(to_cache, time=int(Source.CACHE_TTL.total_seconds()))
+
+    return [ndb.model_from_protobuf(entity_pb.EntityProto(cached[cache_key]))
+            if cache_key in cached else fetched[key]
+            for key, cache_key in zip(keys, cache_keys)]
+
+  @staticmethod
+  def _cache_version_key(key):
+    return 'Source version %s' % key.urlsafe()
+
+  def _post_put_hook(self, future):
+    """Invalidates get_cached() entries and updates the DomainIndex and
+    DirectoryEntry.
+
+    Waits for the commit in transactions. Errors are logged, not raised, since
+    the source itself is already stored. The index updates skip unchanged
+    sources based on a memcache signature that's only set on success, so the
+    next put retries them.
+    """
+    version_key = self._cache_version_key(self.key)
+    def on_commit():
+      _log_errors(memcache.incr, version_key, initial_value=0)
+      _log_errors(DomainIndex.update_source, self)
+      _log_errors(DirectoryEntry.update_source, self)
+    ndb.get_context().call_on_commit(on_commit)
+
+  @classmethod
+  def _post_delete_hook(cls, key, future):
+    version_key = cls._cache_version_key(key)
+    def on_commit():
+      _log_errors(memcache.incr, version_key, initial_value=0)
+      _log_errors(DomainIndex.remove_source, key)
+      _log_errors(DirectoryEntry.remove_source, key)
+    ndb.get_context().call_on_commit(on_commit)
+
   def user_tag_id(self):
     """Returns the tag URI for this source, e.g. 'tag:plus.google.com:123456'."""
     return self.gr_source.tag_uri(self.key.id())
@@ -212,9 +341,22 @@ class Source(StringIdModel):
 
     updates = source.updates
     source = source.key.get()
-    source.updates = updates  # because FacebookPage._pre_put_hook uses it
+    source.updates = updates
+    state_updates = {}
     for name, val in updates.items():
-      setattr(source, name, val)
+      if name in SourceState.PROPERTIES:
+        state_updates[name] = val
+      else:
+        setattr(source, name, val)
+
+    if state_updates:
+      state = source.load_state()
+      state.populate(**state_updates)
+      state.put()
+      # the state now has everything, so drop the deprecated copies
+      for name in SourceState.PROPERTIES:
+        if getattr(source, name, None) is not None:
+          setattr(source, name, None)
 
     if source.status == 'error':  # deprecated
       logging.warning('Resetting status from error to enabled')
@@ -223,6 +365,20 @@ class Source(StringIdModel):
     source.put()
     return source
 
+  def load_state(self):
+    """Returns this source's SourceState.
+
+    Loads it from the datastore the first time and caches it in memory after
+    that. If it hasn't been stored yet, returns a new one populated from the
+    deprecated properties on the source itself, which put_updates() then
+    stores. That lazily migrates existing sources.
+    """
+    if self._state is None:
+      key = SourceState.key_for(self)
+      self._state = key.get() or SourceState(key=key, **{
+        name: getattr(self, name, None) for name in SourceState.PROPERTIES})
+    return self._state
+
   def poll_period(self):
     """Returns the poll frequency for this source, as a datetime.timedelta.
 
@@ -410,6 +566,8 @@ class Source(StringIdModel):
 
     # TODO: ugh, *all* of this should be transactional
     source.put()
+    if not existing:
+      Counter.increment('users')
 
     if 'listen' in source.features:
       util.add_poll_task(source, now=True)
@@ -451,18 +609,26 @@ class Source(StringIdModel):
       return
 
     author_url = author_urls[0]
+    if not util.FetchFailure.should_fetch(author_url):
+      return
+
     logging.info('Attempting to discover webmention endpoint on %s', author_url)
     mention = send.WebmentionSend('https://brid.gy/', author_url)
     mention.requests_kwargs = {'timeout': HTTP_TIMEOUT,
                                'headers': util.USER_AGENT_HEADER}
     try:
       mention._discoverEndpoint()
-    except BaseException:
+    except BaseException, e:
       logging.info('Error discovering webmention endpoint', exc_info=True)
       mention.error = {'code': 'EXCEPTION'}
+      util.FetchFailure.record_failure(author_url, e)
 
     self._fetched_html = getattr(mention, 'html', None)
     error = getattr(mention, 'error', None)
+    if not error or error.get('code') == 'NO_ENDPOINT':
+      util.FetchFailure.record_success(author_url)
+    elif error.get('code') == 'BAD_TARGET_URL':
+      util.FetchFailure.record_failure(author_url, error.get('http_status'))
     endpoint = getattr(mention, 'receiver_endpoint', None)
     if error or not endpoint:
       logging.info("No webmention endpoint found: %s %r", error, endpoint)
@@ -543,9 +709,9 @@ class Source(StringIdModel):
     domain = util.domain_from_link(url)
     if domain == self.gr_source.DOMAIN:
       return url
-    user = self.__class__.query(self.__class__.domains == domain).get()
-    if user:
-      return self.gr_source.user_url(user.key.id())
+    entries = DomainIndex.lookup(domain, silo=self.SHORT_NAME)
+    if entries:
+      return self.gr_source.user_url(entries[0].source.id())
 
   def preprocess_for_publish(self, obj):
     """Preprocess an object before trying to publish it.
@@ -583,6 +749,259 @@ class Source(StringIdModel):
     pass
 
 
+class SourceState(ndb.Model):
+  """Bulky poll state for a source, kept off the Source entity itself.
+
+  Source is read in almost every request and task, but only polls need this,
+  so it's stored separately and loaded on demand by Source.load_state(). It's
+  a child of its source, with key id STATE_ID, so that Source.put_updates()
+  can write both in the same transaction.
+  """
+  STATE_ID = 'state'
+
+  # Turn off instance and memcache caching. See Source for details.
+  _use_cache = False
+  _use_memcache = False
+
+  last_activities_cache_json = ndb.TextProperty(compressed=True)
+  seen_responses_cache_json = ndb.TextProperty(compressed=True)
+  # only used by FacebookPage. maps string post ids to string facebook object
+  # ids or None.
+  resolved_object_ids_json = ndb.TextProperty(compressed=True)
+  updated = ndb.DateTimeProperty(auto_now=True)
+
+  PROPERTIES = ('last_activities_cache_json', 'seen_responses_cache_json',
+                'resolved_object_ids_json')
+
+  @classmethod
+  def key_for(cls, source):
+    return ndb.Key(cls, cls.STATE_ID, parent=source.key)
+
+
+class DomainIndexEntry(ndb.Model):
+  """One source in a DomainIndex."""
+  silo = ndb.StringProperty()  # Source.SHORT_NAME
+  source = ndb.KeyProperty()
+  features = ndb.StringProperty(repeated=True)
+  status = ndb.StringProperty()
+
+
+class DomainIndex(StringIdModel):
+  """The sources, in all silos, that have a given domain in their domains.
+
+  Key id is the lowercased domain. Maintained by Source's put and delete hooks,
+  so that looking up sources by domain is one key get instead of a query per
+  silo. Lookups are cached in memory in each instance for up to CACHE_TTL, in
+  an LRU cache of up to CACHE_SIZE domains.
+
+  Sources that haven't been written since DomainIndex existed aren't in it
+  until the backfill_domain_index mapreduce adds them, so while QUERY_FALLBACK
+  is set, lookups for domains with no index fall back to a query per silo.
+  """
+  CACHE_TTL = datetime.timedelta(minutes=1)
+  CACHE_SIZE = 1000
+  # set to False once mapreduces.backfill_domain_index has run for every silo
+  QUERY_FALLBACK = True
+
+  # Turn off instance and memcache caching. lookup_multi() has its own cache.
+  _use_cache = False
+  _use_memcache = False
+
+  entries = ndb.LocalStructuredProperty(DomainIndexEntry, repeated=True)
+  # indexed so that update_source() can find domains a source no longer has
+  source_keys = ndb.KeyProperty(repeated=True)
+  updated = ndb.DateTimeProperty(auto_now=True)
+
+  # maps domain to (datetime expiration, list of DomainIndexEntry), least
+  # recently used first. guarded by _cache_lock.
+  _cache = collections.OrderedDict()
+  _cache_lock = threading.Lock()
+
+  @classmethod
+  def lookup(cls, domain, silo=None, feature=None, status=None):
+    """Returns the DomainIndexEntrys for a domain, optionally filtered.
+
+    Args:
+      domain: string
+      silo: string Source.SHORT_NAME
+      feature: string, e.g. 'listen'
+      status: string, e.g. 'enabled'
+
+    Returns: list of DomainIndexEntry
+    """
+    return cls.lookup_multi([domain], silo=silo, feature=feature, status=status)
+
+  @classmethod
+  def lookup_multi(cls, domains, silo=None, feature=None, status=None):
+    """Like lookup(), but for multiple domains at once, with one batch get.
+
+    Returns: list of DomainIndexEntry, deduped by source
+    """
+    now = util.now_fn()
+    domains = util.uniquify(d.lower() for d in domains if d)
+
+    found = {}
+    with cls._cache_lock:
+      for domain in domains:
+        cached = cls._cache.pop(domain, None)
+        if cached and cached[0] > now:
+          cls._cache[domain] = cached
+          found[domain] = cached[1]
+
+    misses = [d for d in domains if d not in found]
+    for domain, index in zip(misses, ndb.get_multi(
+        ndb.Key(cls, d) for d in misses)):
+      if index:
+        found[domain] = index.entries
+      elif cls.QUERY_FALLBACK:
+        found[domain] = cls._query(domain)
+      else:
+        found[domain] = []
+      with cls._cache_lock:
+        cls._cache[domain] = (now + cls.CACHE_TTL, found[domain])
+        while len(cls._cache) > cls.CACHE_SIZE:
+          cls._cache.popitem(last=False)
+
+    entries = collections.OrderedDict()
+    for domain in domains:
+      for e in found[domain]:
+        if ((not silo or e.silo == silo) and
+            (not feature or feature in e.features) and
+            (not status or e.status == status)):
+          entries.setdefault(e.source, e)
+    return entries.values()
+
+  @staticmethod
+  def _query(domain):
+    """Queries every silo for sources with a domain, in parallel.
+
+    Returns: list of unsaved DomainIndexEntry
+    """
+    futures = [(silo, source_cls.query(source_cls.domains == domain)
+                      .fetch_async(100))
+               for silo, source_cls in sources.items()]
+    return [DomainIndexEntry(silo=silo, source=source.key,
+                             features=source.features, status=source.status)
+            for silo, future in futures for source in future.get_result()]
+
+  @classmethod
+  def update_source(cls, source):
+    """Updates the index for a source's current domains, features, and status.
+
+    Skips the work if they haven't changed since the last update.
+    """
+    signature = hashlib.sha1(json.dumps(
+      [sorted(source.domains), sorted(source.features), source.status])
+    ).hexdigest()
+    signature_key = 'DomainIndex signature %s' % source.key.urlsafe()
+    if memcache.get(signature_key) == signature:
+      return
+
+    entry = DomainIndexEntry(silo=source.SHORT_NAME, source=source.key,
+                             features=source.features, status=source.status)
+    domains = set(d.lower() for d in source.domains if d)
+    for domain in domains:
+      cls._update(domain, source.key, entry)
+    cls.remove_source(source.key, keep=domains)
+    memcache.set(signature_key, signature)
+
+  @classmethod
+  def remove_source(cls, key, keep=()):
+    """Removes a source from the index for all domains except keep."""
+    for index_key in cls.query(cls.source_keys == key).iter(keys_only=True):
+      if index_key.id() not in keep:
+        cls._update(index_key.id(), key, None)
+
+  @classmethod
+  @ndb.transactional
+  def _update(cls, domain, key, entry):
+    """Replaces or removes a source's entry in a domain's index.
+
+    Args:
+      domain: string
+      key: Source key
+      entry: DomainIndexEntry, or None to remove
+    """
+    with cls._cache_lock:
+      cls._cache.pop(domain, None)
+    existing = cls.get_by_id(domain)
+    entries = [e for e in existing.entries if e.source != key] if existing else []
+    if entry:
+      entries.append(entry)
+
+    if entries:
+      cls(id=domain, entries=entries,
+          source_keys=[e.source for e in entries]).put()
+    elif existing:
+      existing.key.delete()
+
+
+class DirectoryEntry(StringIdModel):
+  """A source listed on /users, denormalized for paging in one query.
+
+  Key id is the source's urlsafe key. Maintained by Source's put and delete
+  hooks. Only sources with features are listed.
+  """
+  # Turn off instance and memcache caching. See Response for details.
+  _use_cache = False
+  _use_memcache = False
+
+  source = ndb.KeyProperty()
+  silo = ndb.StringProperty(indexed=False)  # Source.SHORT_NAME
+  name = ndb.StringProperty(indexed=False)
+  # lower cased name. /users sorts and pages by this.
+  sort_name = ndb.StringProperty()
+  label = ndb.StringProperty(indexed=False)
+  bridgy_path = ndb.StringProperty(indexed=False)
+  picture = ndb.StringProperty(indexed=False)
+  features = ndb.StringProperty(repeated=True)
+  updated = ndb.DateTimeProperty(auto_now=True)
+
+  @classmethod
+  def update_source(cls, source):
+    """Updates, adds, or removes a source's entry.
+
+    Skips the write if its fields haven't changed since the last update.
+    Invalidates the cached first page of /users when it writes.
+    """
+    name = source.name or source.key.string_id()
+    fields = {
+      'source': source.key,
+      'silo': source.SHORT_NAME,
+      'name': name,
+      'sort_name': name.lower(),
+      'label': source.label(),
+      'bridgy_path': source.bridgy_path(),
+      'picture': source.picture,
+      'features': source.features,
+    } if source.features else None
+
+    signature = hashlib.sha1(json.dumps(
+      fields and dict(fields, source=source.key.urlsafe()), sort_keys=True)
+    ).hexdigest()
+    signature_key = cls._signature_key(source.key)
+    if memcache.get(signature_key) == signature:
+      return
+
+    if fields:
+      cls(id=source.key.urlsafe(), **fields).put()
+      util.CachedPage.invalidate('/users')
+    else:
+      cls.remove_source(source.key)
+    memcache.set(signature_key, signature)
+
+  @classmethod
+  def remove_source(cls, key):
+    """Removes a source's entry, if any."""
+    ndb.Key(cls, key.urlsafe()).delete()
+    memcache.delete(cls._signature_key(key))
+    util.CachedPage.invalidate('/users')
+
+  @staticmethod
+  def _signature_key(key):
+    return 'DirectoryEntry signature %s' % key.urlsafe()
+
+
 class Webmentions(StringIdModel):
   """A bundle of links to send webmentions for.
 
@@ -590,6 +1009,9 @@ class Webmentions(StringIdModel):
   """
   STATUSES = ('new', 'processing', 'complete', 'error')
 
+  # Counter name to increment for each new entity. Subclasses must override.
+  COUNTER = None
+
   # Turn off instance and memcache caching. See Source for details.
   _use_cache = False
   _use_memcache = False
@@ -647,36 +1069,160 @@ class Webmentions(StringIdModel):
       self.status = 'complete'
 
     self.put()
+    Counter.increment(self.COUNTER)
+    Counter.increment('links', len(self.unsent + self.sent + self.error +
+                                   self.failed + self.skipped))
     return self
 
 
+class Activity(StringIdModel):
+  """A pruned ActivityStreams activity that Responses refer to.
+
+  Content addressed: the key id is the SHA-1 hex digest of the JSON, so an
+  activity with hundreds of responses is only stored once.
+
+  last_used is refreshed whenever a new Response refers to an existing
+  activity, so that gc doesn't delete activities that are still in use. See
+  tasks.delete_orphaned_activities().
+  """
+  # store_multi() only refreshes last_used when it's older than this, so that
+  # activities with lots of responses aren't rewritten on every poll.
+  LAST_USED_RESOLUTION = datetime.timedelta(days=1)
+
+  activity_json = ndb.TextProperty(compressed=True)
+  created = ndb.DateTimeProperty(auto_now_add=True)
+  # None for activities stored before this existed. Use used_since().
+  last_used = ndb.DateTimeProperty()
+
+  def used_since(self, time):
+    return (self.last_used or self.created) >= time
+
+  @staticmethod
+  def id_for(activity_json):
+    if isinstance(activity_json, unicode):
+      activity_json = activity_json.encode('utf-8')
+    return hashlib.sha1(activity_json).hexdigest()
+
+  @classmethod
+  def store_multi(cls, activities_json):
+    """Stores activities that aren't already stored.
+
+    Does one batch get for all of them and only writes the missing ones.
+
+    Args:
+      activities_json: sequence of string JSON activities
+
+    Returns: list of Activity keys, in the same order as activities_json
+    """
+    keys = [ndb.Key(cls, cls.id_for(a)) for a in activities_json]
+    unique = dict(zip(keys, activities_json))
+    existing = ndb.get_multi(unique.keys())
+
+    now = util.now_fn()
+    to_put = []
+    for (key, activity_json), stored in zip(unique.items(), existing):
+      if not stored:
+        to_put.append(cls(key=key, activity_json=activity_json, last_used=now))
+      elif not stored.used_since(now - cls.LAST_USED_RESOLUTION):
+        stored.last_used = now
+        to_put.append(stored)
+    ndb.put_multi(to_put)
+    return keys
+
+  @classmethod
+  def delete_unused_multi(cls, keys, cutoff):
+    """Deletes the activities that haven't been used since cutoff.
+
+    Each one is checked and deleted in its own transaction, so one that
+    store_multi() refreshes concurrently is either kept or stored again.
+
+    Args:
+      keys: sequence of Activity ndb.Keys
+      cutoff: datetime
+
+    Returns: list of deleted ndb.Keys
+    """
+    @ndb.transactional_tasklet
+    def delete(key):
+      activity = yield key.get_async()
+      if activity and not activity.used_since(cutoff):
+        yield key.delete_async()
+        raise ndb.Return(key)
+
+    futures = [delete(key) for key in keys]
+    return [f.get_result() for f in futures if f.get_result()]
+
+
 class Response(Webmentions):
   """A comment, like, or repost to be propagated.
 
   The key name is the comment object id as a tag URI.
   """
+  COUNTER = 'responses'
+
   # ActivityStreams JSON activity and comment, like, or repost
   type = ndb.StringProperty(choices=VERB_TYPES, default='comment')
-  # These are TextProperty, and not JsonProperty, so that their plain text is
-  # visible in the App Engine admin console. (JsonProperty uses a blob. :/)
-  activities_json = ndb.TextProperty(repeated=True)
-  response_json = ndb.TextProperty()
+  # Activities, stored once each in Activity entities. Use
+  # load_activities_json() to read them.
+  activity_keys = ndb.KeyProperty(kind=Activity, repeated=True)
+  # These are compressed TextProperty, and not JsonProperty, so that callers
+  # get the raw JSON text. ndb decompresses them lazily, on first access, and
+  # values stored before they were compressed are still read as is. The admin
+  # console can't show compressed values, so use /admin/entity instead.
+  #
+  # Old entities store their activities inline here instead of in
+  # activity_keys. mapreduces.migrate_activities() moves them.
+  activities_json = ndb.TextProperty(repeated=True, compressed=True)
+  response_json = ndb.TextProperty(compressed=True)
   # Old values for response_json. Populated when the silo reports that the
   # response has changed, e.g. the user edited a comment or changed their RSVP
   # to an event.
-  old_response_jsons = ndb.TextProperty(repeated=True)
+  old_response_jsons = ndb.TextProperty(repeated=True, compressed=True)
   # JSON dict mapping original post url to activity index in activities_json.
   # only set when there's more than one activity.
   urls_to_activity = ndb.TextProperty()
   # Original post links found by original post discovery
   original_posts = ndb.StringProperty(repeated=True)
+  # Canonicalized URLs of the activities in activities_json. Indexed so that
+  # tasks.repropagate_old_responses() can query for them. Populated by
+  # canonical_activity_urls().
+  activity_urls = ndb.StringProperty(repeated=True)
+
+  # Denormalized from response_json and the activities so that user pages can
+  # render responses without loading or parsing any JSON. Populated by
+  # set_render_fields(). None for responses stored before these existed.
+  # public is indexed so that user pages can query for just public responses.
+  public = ndb.BooleanProperty()
+  actor_name = ndb.StringProperty(indexed=False)
+  actor_url = ndb.StringProperty(indexed=False)
+  actor_image = ndb.StringProperty(indexed=False)
+  response_url = ndb.StringProperty(indexed=False)
+  response_content = ndb.TextProperty()
+  # parallel lists, one value per activity. empty for posts.
+  activity_link_urls = ndb.StringProperty(repeated=True, indexed=False)
+  activity_contents = ndb.TextProperty(repeated=True)
+
+  RENDER_FIELDS = ('public', 'actor_name', 'actor_url', 'actor_image',
+                   'response_url', 'response_content', 'activity_link_urls',
+                   'activity_contents')
+
+  # content for responses that don't have any, after the actor's name
+  PHRASES = {
+    'like': 'liked this',
+    'repost': 'reposted this',
+    'rsvp-yes': 'is attending',
+    'rsvp-no': 'is not attending',
+    'rsvp-maybe': 'might attend',
+    'invite': 'is invited',
+  }
 
   # DEPRECATED, DO NOT USE! see https://github.com/snarfed/bridgy/issues/217
   activity_json = ndb.TextProperty()
 
   def label(self):
     return ' '.join((self.key.kind(), self.type, self.key.id(),
-                     json.loads(self.response_json).get('url', '[no url]')))
+                     json.loads(self.response_json or '{}').get(
+                       'url', '[no url]')))
 
   def add_task(self, **kwargs):
     util.add_propagate_task(self, **kwargs)
@@ -686,9 +1232,98 @@ class Response(Webmentions):
     type = get_type(obj)
     return type if type in VERB_TYPES else 'comment'
 
+  @staticmethod
+  def canonical_activity_urls(source, activities):
+    """Returns the canonicalized URLs of activities, for activity_urls.
+
+    Args:
+      source: Source
+      activities: sequence of ActivityStreams activity dicts
+    """
+    urls = []
+    for activity in activities:
+      url = activity.get('url') or activity.get('object', {}).get('url')
+      if url:
+        url = source.canonicalize_syndication_url(url, activity=activity)
+        if len(url) <= _MAX_STRING_LENGTH:
+          urls.append(url)
+    return util.uniquify(urls)
+
+  def set_render_fields(self, response, activities):
+    """Populates the denormalized fields in RENDER_FIELDS.
+
+    Args:
+      response: pruned ActivityStreams response object dict
+      activities: sequence of pruned ActivityStreams activity dicts
+    """
+    self.public = (gr_source.Source.is_public(response) and
+                   all(gr_source.Source.is_public(a) for a in activities))
+
+    actor = response.get('author') or response.get('actor') or {}
+    self.actor_name = actor.get('displayName')
+    self.actor_url = actor.get('url')
+    self.actor_image = (actor.get('image') or {}).get('url')
+
+    self.response_url = response.get('url')
+    content = response.get('content') or response.get('object', {}).get('content')
+    if not content:
+      content = '%s %s.' % (self.actor_name or '',
+                            self.PHRASES.get(self.type) or
+                            self.PHRASES.get(response.get('verb')))
+    self.response_content = content
+
+    if self.type == 'post':
+      activities = []
+    self.activity_link_urls = [
+      a.get('url') or a.get('object', {}).get('url') or '' for a in activities]
+    self.activity_contents = [
+      a.get('content') or a.get('object', {}).get('content') or ''
+      for a in activities]
+
+  def load_activities_json(self):
+    """Returns this response's activities as a list of JSON strings."""
+    return Response.load_activities_json_multi([self])[0]
+
+  @staticmethod
+  def load_activities_json_multi(responses):
+    """Loads activities for multiple responses with one batch get.
+
+    Handles both activity_keys and the older inline activities_json and
+    activity_json.
+
+    Args:
+      responses: sequence of Responses
+
+    Returns: list of lists of string JSON activities, one per response
+    """
+    keys = util.uniquify(itertools.chain.from_iterable(
+      r.activity_keys for r in responses))
+    activities = dict(zip(keys, ndb.get_multi(keys)))
+
+    loaded = []
+    for r in responses:
+      activities_json = list(r.activities_json)
+      if r.activity_json:
+        activities_json.append(r.activity_json)
+      for key in r.activity_keys:
+        activity = activities.get(key)
+        if activity:
+          activities_json.append(activity.activity_json)
+        else:
+          logging.warning('%s is missing activity %s', r.key, key)
+      loaded.append(activities_json)
+
+    return loaded
+
   @ndb.transactional(xg=True)
   def get_or_save(self, source):
     resp = super(Response, self).get_or_save()
+    if not resp.response_json:
+      # archived by gc. keep it as is so we don't propagate it again.
+      return resp
+
+    new_urls = [url for url in self.activity_urls
+                if url not in resp.activity_urls]
 
     if (self.type != resp.type or
         source.gr_source.activity_changed(json.loads(resp.response_json),
@@ -700,8 +1335,17 @@ class Response(Webmentions):
       resp.sent = resp.error = resp.failed = resp.skipped = []
       resp.old_response_jsons = resp.old_response_jsons[:10] + [resp.response_json]
       resp.response_json = self.response_json
+      resp.activity_urls += new_urls
+      if self.public is not None:
+        resp.populate(**{f: getattr(self, f) for f in self.RENDER_FIELDS})
       resp.put()
       self.add_task(transactional=True)
+    elif new_urls or (resp.public is None and self.public is not None):
+      # also backfills render fields on responses stored before they existed
+      resp.activity_urls += new_urls
+      if resp.public is None:
+        resp.populate(**{f: getattr(self, f) for f in self.RENDER_FIELDS})
+      resp.put()
 
     return resp
 
@@ -719,12 +1363,31 @@ class Response(Webmentions):
     """Don't allow storing new entities with activity_json."""
     assert self.activity_json is None
 
+  @staticmethod
+  def render_version_key(source_key):
+    """Returns the memcache key for a source's handlers.py render version."""
+    return 'Response render version %s' % source_key.urlsafe()
+
+  def _post_put_hook(self, future):
+    """Invalidates the source's rendered permalinks when we'll propagate.
+
+    A new status means this response is new or changed, or has new original
+    posts, and receivers will fetch its permalinks soon. Waits for the commit in
+    transactions.
+    """
+    if self.status == 'new' and self.source:
+      version_key = self.render_version_key(self.source)
+      ndb.get_context().call_on_commit(
+        lambda: memcache.incr(version_key, initial_value=0))
+
 
 class BlogPost(Webmentions):
   """A blog post to be processed for links to send webmentions to.
 
   The key name is the URL.
   """
+  COUNTER = 'blogposts'
+
   feed_item = ndb.JsonProperty(compressed=True)  # from Superfeedr
 
   def label(self):
@@ -760,7 +1423,7 @@ class Publish(ndb.Model):
   type_label = ndb.StringProperty()  # source-specific type, e.g. 'favorite'
   status = ndb.StringProperty(choices=STATUSES, default='new')
   source = ndb.KeyProperty()
-  html = ndb.TextProperty()  # raw HTML fetched from source
+  html = ndb.TextProperty(compressed=True)  # raw HTML fetched from source
   published = ndb.JsonProperty(compressed=True)
   created = ndb.DateTimeProperty(auto_now_add=True)
   updated = ndb.DateTimeProperty(auto_now=True)
@@ -812,7 +1475,6 @@ class SyndicatedPost(ndb.Model):
   updated = ndb.DateTimeProperty(auto_now=True)
 
   @classmethod
-  @ndb.transactional(xg=True)
   def insert_original_blank(cls, source, original):
     """Insert a new original -> None relationship. Does a check-and-set to
     make sure no previous relationship exists for this original. If
@@ -822,12 +1484,9 @@ class SyndicatedPost(ndb.Model):
       source: models.Source subclass
       original: string
     """
-    if cls.query(cls.original == original, ancestor=source.key).get():
-      return
-    cls(parent=source.key, original=original, syndication=None).put()
+    cls.insert_multi(source, [(None, original)])
 
   @classmethod
-  @ndb.transactional(xg=True)
   def insert_syndication_blank(cls, source, syndication):
     """Insert a new syndication -> None relationship. Does a check-and-set
     to make sure no previous relationship exists for this
@@ -837,13 +1496,9 @@ class SyndicatedPost(ndb.Model):
       source: models.Source subclass
       original: string
     """
-
-    if cls.query(cls.syndication == syndication, ancestor=source.key).get():
-      return
-    cls(parent=source.key, original=None, syndication=syndication).put()
+    cls.insert_multi(source, [(syndication, None)])
 
   @classmethod
-  @ndb.transactional(xg=True)
   def insert(cls, source, syndication, original):
     """Insert a new (non-blank) syndication -> original relationship.
 
@@ -862,23 +1517,389 @@ class SyndicatedPost(ndb.Model):
     Return:
       the new SyndicatedPost or a preexisting one if it exists
     """
-    # check for an exact match
-    duplicate = cls.query(cls.syndication == syndication,
-                          cls.original == original,
-                          ancestor=source.key).get()
-    if duplicate:
-      return duplicate
+    assert syndication and original
+    return cls.insert_multi(source, [(syndication, original)])[
+      (syndication, original)]
+
+  @classmethod
+  @ndb.transactional(xg=True)
+  def insert_multi(cls, source, relationships, deletes=()):
+    """Stores many relationships for a single source in one transaction.
+
+    Same check-and-set semantics as insert(), insert_original_blank(), and
+    insert_syndication_blank(), but with one set of queries and one commit for
+    the whole batch:
 
-    # delete blanks (expect at most 1 of each)
-    ndb.delete_multi(
-      cls.query(ndb.OR(
-        ndb.AND(cls.syndication == syndication, cls.original == None),
-        ndb.AND(cls.original == original, cls.syndication == None)),
-                ancestor=source.key).fetch(keys_only=True))
+    * An exact duplicate of an existing (syndication, original) relationship
+      isn't stored again. Otherwise, it replaces blanks for its syndication
+      and original URLs.
+    * A (syndication, None) or (None, original) blank is only stored if no
+      other relationship, stored or in this batch, has that URL.
 
-    r = cls(parent=source.key, original=original, syndication=syndication)
-    r.put()
-    return r
+    Args:
+      source: models.Source subclass
+      relationships: sequence of (syndication, original) string tuples. At
+        most one of the two may be None.
+      deletes: sequence of SyndicatedPost ndb.Keys to delete in the same
+        transaction
+
+    Return:
+      dict mapping each non-blank (syndication, original) tuple in
+      relationships to the new or preexisting SyndicatedPost
+    """
+    relationships = util.uniquify(relationships)
+    deletes = set(deletes)
+
+    # load everything that might conflict, 30 URLs per query
+    existing = {}
+    for prop, urls in ((cls.syndication, set(s for s, _ in relationships if s)),
+                       (cls.original, set(o for _, o in relationships if o))):
+      urls = list(urls)
+      for i in xrange(0, len(urls), MAX_ALLOWABLE_QUERIES):
+        for r in cls.query(prop.IN(urls[i:i + MAX_ALLOWABLE_QUERIES]),
+                           ancestor=source.key):
+          if r.key not in deletes:
+            existing[r.key] = r
+    rows = existing.values()
+
+    results = {}
+    new = []
+    # non-blanks first, so they win over blanks for the same URLs in this batch
+    for syndication, original in sorted(relationships, key=lambda r: None in r):
+      if syndication and original:
+        duplicate = next((r for r in rows if r.syndication == syndication and
+                          r.original == original), None)
+        if duplicate:
+          results[(syndication, original)] = duplicate
+          continue
+        for r in list(rows):
+          if ((r.syndication == syndication and r.original is None) or
+              (r.original == original and r.syndication is None)):
+            rows.remove(r)
+            deletes.add(r.key)
+      elif any((syndication and r.syndication == syndication) or
+               (original and r.original == original) for r in rows):
+        continue
+
+      r = cls(parent=source.key, original=original, syndication=syndication)
+      rows.append(r)
+      new.append(r)
+      if syndication and original:
+        results[(syndication, original)] = r
+
+    ndb.delete_multi(deletes)
+    ndb.put_multi(new)
+    SyndicatedPostFilter.add_urls(source, [(r.syndication, r.original)
+                                           for r in new])
+    return results
 
   def _pre_put_hook(self):
     self.key.parent().get().on_new_syndicated_post(self)
+
+
+class SyndicatedPostFilter(ndb.Model):
+  """Bloom filter over a source's SyndicatedPost syndication and original URLs.
+
+  Lets original_post_discovery skip SyndicatedPost queries that we know will
+  come back empty. False positives are possible, false negatives aren't, so a
+  negative answer means there's definitely no matching SyndicatedPost.
+
+  Child of the Source, so it's in the same entity group as its SyndicatedPosts
+  and updated transactionally with them, once per batch, in
+  SyndicatedPost.insert_multi. Built lazily from the existing SyndicatedPosts
+  the first time it's loaded; see build(). Deleted SyndicatedPosts stay in the
+  filter; they only cost an extra query.
+
+  Key id is always 'filter'.
+  """
+  NUM_BITS = 2 ** 16
+  NUM_HASHES = 4
+  HIT_RATE_COUNTERS = ('negative', 'positive', 'false positive')
+
+  # if a build dies partway through, another one can take over after this long
+  BUILD_TIMEOUT = datetime.timedelta(minutes=10)
+
+  bits = ndb.BlobProperty(compressed=True)
+  # True while build() is scanning the source's SyndicatedPosts. The filter
+  # can't answer negatively until it's done.
+  building = ndb.BooleanProperty(default=False)
+  updated = ndb.DateTimeProperty(auto_now=True)
+
+  @classmethod
+  def key_for(cls, source_key):
+    return ndb.Key(cls, 'filter', parent=source_key)
+
+  @classmethod
+  def load(cls, source):
+    """Returns the filter for a source, building and storing it if necessary.
+
+    Memoized on the source object, so each poll only loads it once.
+    insert_multi() keeps the memoized copy up to date.
+
+    Args:
+      source: models.Source subclass
+    """
+    filter = getattr(source, '_syndpost_filter', None)
+    if not filter:
+      filter = cls.key_for(source.key).get()
+      if not filter or (filter.building and
+                        filter.updated < util.now_fn() - cls.BUILD_TIMEOUT):
+        filter = cls.build(source.key)
+      source._syndpost_filter = filter
+    return filter
+
+  @classmethod
+  def build(cls, source_key):
+    """Builds and stores a source's filter from its existing SyndicatedPosts.
+
+    The scan can be big, so it happens outside any transaction. First we store
+    an empty filter with building=True, so insert_multi() starts adding new
+    URLs to it, then we scan, then we merge the scanned URLs into the stored
+    filter. Anything stored during the scan ends up in one or the other.
+
+    Returns the stored filter, which may still be building if another request
+    is already building it.
+
+    Args:
+      source_key: ndb.Key of a Source
+    """
+    key = cls.key_for(source_key)
+    filter, ours = cls._start_build(key)
+    if not ours:
+      return filter
+
+    logging.info('Building SyndicatedPostFilter for %s', source_key)
+    filter = cls(bits=str(bytearray(cls.NUM_BITS / 8)))
+    for syndpost in SyndicatedPost.query(ancestor=source_key):
+      filter._add(syndication=syndpost.syndication, original=syndpost.original)
+    return cls._finish_build(key, filter.bits)
+
+  @classmethod
+  @ndb.transactional
+  def _start_build(cls, key):
+    """Stores an empty filter if there isn't one or its build timed out.
+
+    Returns (SyndicatedPostFilter, boolean whether we stored it and should
+    build it).
+    """
+    filter = key.get()
+    if filter and not (filter.building and
+                       filter.updated < util.now_fn() - cls.BUILD_TIMEOUT):
+      return filter, False
+    filter = cls(key=key, bits=str(bytearray(cls.NUM_BITS / 8)), building=True)
+    filter.put()
+    return filter, True
+
+  @classmethod
+  @ndb.transactional
+  def _finish_build(cls, key, bits):
+    filter = key.get()
+    filter.bits = str(bytearray(a | b for a, b in
+                                zip(bytearray(filter.bits), bytearray(bits))))
+    filter.building = False
+    filter.put()
+    return filter
+
+  @classmethod
+  def add_urls(cls, source, relationships):
+    """Adds URLs to a source's filter, if it exists. One get and one put.
+
+    If it doesn't exist yet, it will include these URLs when it's built. Call
+    inside the transaction that stores the SyndicatedPosts.
+
+    Args:
+      source: models.Source subclass
+      relationships: sequence of (syndication, original) string tuples
+    """
+    if not relationships:
+      return
+    filter = cls.key_for(source.key).get()
+    if filter:
+      for syndication, original in relationships:
+        filter._add(syndication=syndication, original=original)
+      filter.put()
+
+    memoized = getattr(source, '_syndpost_filter', None)
+    if memoized:
+      for syndication, original in relationships:
+        memoized._add(syndication=syndication, original=original)
+
+  def might_contain(self, syndication=None, original=None):
+    """Returns False if there's definitely no SyndicatedPost with this URL.
+
+    Pass exactly one of syndication or original. Always returns True while the
+    filter is still building.
+    """
+    assert bool(syndication) != bool(original)
+    if self.building:
+      return True
+    bits = bytearray(self.bits)
+    return all(bits[i / 8] & (1 << (i % 8)) for i in
+               self._indices(syndication=syndication, original=original))
+
+  def _add(self, syndication=None, original=None):
+    bits = bytearray(self.bits)
+    for i in self._indices(syndication=syndication, original=original):
+      bits[i / 8] |= 1 << (i % 8)
+    self.bits = str(bits)
+
+  @classmethod
+  def _indices(cls, syndication=None, original=None):
+    """Generates the bit indices for the given URL(s)."""
+    for prefix, url in ('S', syndication), ('O', original):
+      if url:
+        digest = hashlib.md5(('%s %s' % (prefix, url)).encode('utf-8')).digest()
+        for val in struct.unpack('>4I', digest)[:cls.NUM_HASHES]:
+          yield val % cls.NUM_BITS
+
+  @classmethod
+  def record_hits(cls, **counts):
+    """Adds to the hit rate counters in memcache.
+
+    Args:
+      negative, positive, false_positive: integers. a false positive is a
+        positive whose query came back empty.
+    """
+    memcache.offset_multi(
+      {name.replace('_', ' '): val for name, val in counts.items() if val},
+      key_prefix='SyndicatedPostFilter ', initial_value=0)
+
+  @classmethod
+  def hit_rates(cls):
+    """Returns a dict mapping counter name to count since memcache was flushed.
+    """
+    counts = memcache.get_multi(cls.HIT_RATE_COUNTERS,
+                                key_prefix='SyndicatedPostFilter ')
+    return {name: counts.get(name, 0) for name in cls.HIT_RATE_COUNTERS}
+
+
+class DomainCapability(StringIdModel):
+  """Whether a web site uses syndication markup. Key id is the domain.
+
+  original_post_discovery records whether each crawl of a domain's permalinks
+  found any rel-syndication or u-syndication links. If none of the last HISTORY
+  crawls found any, we throttle the domain: we only crawl THROTTLED_PERMALINKS
+  of its permalinks at a time, except every REPROBE_PERIOD, when we crawl it
+  normally again to see if it has started.
+  """
+  HISTORY = 5
+  THROTTLED_PERMALINKS = 1
+  REPROBE_PERIOD = datetime.timedelta(days=7)
+
+  # whether each recent crawl found syndication links, newest first
+  syndication = ndb.BooleanProperty(repeated=True, indexed=False)
+  # last time we crawled this domain without throttling
+  last_probe = ndb.DateTimeProperty()
+  updated = ndb.DateTimeProperty(auto_now=True)
+
+  @classmethod
+  def throttled(cls, domains):
+    """Returns the subset of domains that are currently throttled.
+
+    Args:
+      domains: sequence of string domains
+    """
+    domains = [d for d in domains if d]
+    return set(domain for domain, cap in
+               zip(domains, ndb.get_multi(ndb.Key(cls, d) for d in domains))
+               if cap and cap.is_throttled())
+
+  @classmethod
+  @ndb.transactional
+  def record(cls, domain, found, throttled=False):
+    """Records the result of a crawl.
+
+    Args:
+      domain: string
+      found: boolean, whether the crawl found any syndication links
+      throttled: boolean, whether the crawl was throttled
+    """
+    cap = cls.get_by_id(domain) or cls(id=domain)
+    cap.syndication = ([found] + cap.syndication)[:cls.HISTORY]
+    if not throttled:
+      cap.last_probe = util.now_fn()
+    cap.put()
+
+  def is_throttled(self):
+    return (len(self.syndication) >= self.HISTORY and not any(self.syndication)
+            and self.last_probe is not None
+            and util.now_fn() < self.last_probe + self.REPROBE_PERIOD)
+
+
+class GarbageCollection(StringIdModel):
+  """Where the last complete run of a tasks.RETENTION archive policy ended.
+
+  Key id is the policy name. Everything older than archived_before has already
+  been archived, so later runs skip it.
+  """
+  archived_before = ndb.DateTimeProperty()
+  updated = ndb.DateTimeProperty(auto_now=True)
+
+
+class Counter(StringIdModel):
+  """One shard of a sharded aggregate counter, e.g. for front page stats.
+
+  Key id is 'NAME SHARD', where SHARD is 0 to NUM_SHARDS - 1, or 'base' for the
+  starting value, set from datastore statistics by /admin/seed_counters.
+  Increments go to a random shard so that they don't contend.
+
+  Sources that get disabled or deleted never decrement users, so
+  /cron/reseed_counters resets it to the number of enabled sources daily.
+  """
+  NAMES = ('users', 'responses', 'links', 'webmentions', 'publishes',
+           'blogposts', 'webmentions_received')
+  NUM_SHARDS = 20
+
+  # Turn off instance and memcache caching so that counts are fresh.
+  _use_cache = False
+  _use_memcache = False
+
+  count = ndb.IntegerProperty(default=0, indexed=False)
+
+  @classmethod
+  def increment(cls, name, delta=1):
+    """Adds delta to a counter, after the current transaction commits, if any.
+
+    Args:
+      name: string, one of NAMES
+      delta: integer
+    """
+    assert name in cls.NAMES, name
+    if delta:
+      ndb.get_context().call_on_commit(lambda: cls._increment(name, delta))
+
+  @classmethod
+  @ndb.transactional
+  def _increment(cls, name, delta):
+    id = '%s %d' % (name, random.randrange(cls.NUM_SHARDS))
+    shard = cls.get_by_id(id) or cls(id=id)
+    shard.count += delta
+    shard.put()
+
+  @classmethod
+  def set_base(cls, name, count):
+    assert name in cls.NAMES, name
+    cls(id='%s base' % name, count=count).put()
+
+  @classmethod
+  def reset(cls, name, count):
+    """Sets a counter's base to count and clears its shards.
+
+    Not atomic, so increments that land in between may be lost or doubled.
+    """
+    assert name in cls.NAMES, name
+    ndb.delete_multi(ndb.Key(cls, '%s %d' % (name, shard))
+                     for shard in range(cls.NUM_SHARDS))
+    cls.set_base(name, count)
+
+  @classmethod
+  def get_counts(cls, names=NAMES):
+    """Returns a dict mapping counter name to total, with one batch get."""
+    shards = range(cls.NUM_SHARDS) + ['base']
+    keys = [ndb.Key(cls, '%s %s' % (name, shard))
+            for name in names for shard in shards]
+    counts = dict.fromkeys(names, 0)
+    for key, shard in zip(keys, ndb.get_multi(keys)):
+      if shard:
+        counts[key.id().split()[0]] += shard.count
+    return counts
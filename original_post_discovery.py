@@ -23,8 +23,17 @@ lookups in the following primary cases:
     request for *each* post permalink that has not been seen before.
   - 1 DB query for the initial check plus 1 additional DB query for
     *each* post permalink.
+
+Each crawl fetches at most MAX_PERMALINKS permalinks, newest first, and stops
+early if the current request is close to its deadline. Permalinks we don't get
+to are handed off to a crawl-permalinks task.
+
+Syndication links to other silos are stored for the author's Bridgy accounts
+there too, so that they don't have to crawl the same h-feed again.
 """
 
+import calendar
+import collections
 import datetime
 import itertools
 import logging
@@ -37,9 +46,21 @@ from granary import source as gr_source
 from google.appengine.api.datastore import MAX_ALLOWABLE_QUERIES
 from bs4 import BeautifulSoup
 import models
-from models import SyndicatedPost
+from models import SyndicatedPost, SyndicatedPostFilter
 
 from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+# maximum number of h-entry permalinks to fetch in a single crawl. the rest are
+# deferred to a crawl-permalinks task.
+MAX_PERMALINKS = 30
+
+# stop crawling permalinks when we're this close to source.crawl_deadline.
+CRAWL_DEADLINE_MARGIN = datetime.timedelta(minutes=1)
+
+# store the relationships found so far after this many crawled permalinks, so
+# that a crawl that dies partway through doesn't lose them.
+FLUSH_PERMALINKS = 10
 
 
 def discover(source, activity, fetch_hfeed=True, include_redirect_sources=True):
@@ -92,10 +113,13 @@ def discover(source, activity, fetch_hfeed=True, include_redirect_sources=True):
                     att_origs)
       mentions.update(att_origs)
 
+  # resolve all of the URLs at once, in parallel
+  targets = util.get_webmention_targets(list(originals) + list(mentions))
+
   def resolve(urls):
     resolved = set()
     for url in urls:
-      final, _, send = util.get_webmention_target(url)
+      final, _, send = targets[url]
       if send:
         resolved.add(final)
         if include_redirect_sources:
@@ -193,9 +217,18 @@ def _posse_post_discovery(source, activity, syndication_url, fetch_hfeed):
     sequence of string original post urls, possibly empty
   """
   logging.info('starting posse post discovery with syndicated %s', syndication_url)
-  relationships = SyndicatedPost.query(
-    SyndicatedPost.syndication == syndication_url,
-    ancestor=source.key).fetch()
+  relationships = []
+  if SyndicatedPostFilter.load(source).might_contain(
+      syndication=syndication_url):
+    relationships = SyndicatedPost.query(
+      SyndicatedPost.syndication == syndication_url,
+      ancestor=source.key).fetch()
+    SyndicatedPostFilter.record_hits(positive=1,
+                                     false_positive=int(not relationships))
+  else:
+    logging.debug('SyndicatedPostFilter says we have no %s', syndication_url)
+    SyndicatedPostFilter.record_hits(negative=1)
+
   if not relationships and fetch_hfeed:
     # a syndicated post we haven't seen before! fetch the author's URLs to see
     # if we can find it.
@@ -239,28 +272,33 @@ def _process_author(source, author_url, refetch=False, store_blanks=True):
   Return:
     a dict of syndicated_url to a list of new models.SyndicatedPost
   """
+  # check backoff first so that we don't even resolve backed off URLs
+  if not util.FetchFailure.should_fetch(author_url):
+    return {}
+
   # for now use whether the url is a valid webmention target
   # as a proxy for whether it's worth searching it.
-  # TODO skip sites we know don't have microformats2 markup
-  author_url, _, ok = util.get_webmention_target(author_url)
-  if not ok:
+  # sites that don't have syndication markup are throttled in crawl_permalinks()
+  resolved, _, ok = util.get_webmention_target(author_url)
+  if not ok or (resolved != author_url and
+                not util.FetchFailure.should_fetch(resolved)):
     return {}
+  author_url = resolved
 
   try:
     logging.debug('fetching author url %s', author_url)
     author_resp = util.requests_get(author_url)
-    # TODO for error codes that indicate a temporary error, should we make
-    # a certain number of retries before giving up forever?
     author_resp.raise_for_status()
     author_dom = BeautifulSoup(author_resp.text)
   except AssertionError:
     raise  # for unit tests
-  except BaseException:
-    # TODO limit allowed failures, cache the author's h-feed url
-    # or the # of times we've failed to fetch it
+  except BaseException, e:
     logging.warning('Could not fetch author url %s', author_url, exc_info=True)
+    util.FetchFailure.record_failure(author_url, e)
     return {}
 
+  util.FetchFailure.record_success(author_url)
+
   feeditems = _find_feed_items(author_url, author_dom)
 
   # look for all other feed urls using rel='feed', type='text/html'
@@ -287,11 +325,14 @@ def _process_author(source, author_url, refetch=False, store_blanks=True):
       feed_urls.add(feed_url)
 
   for feed_url in feed_urls:
+    if not util.FetchFailure.should_fetch(feed_url):
+      continue
     try:
       logging.debug("fetching author's rel-feed %s", feed_url)
       feed_resp = util.requests_get(feed_url)
       feed_resp.raise_for_status()
       logging.debug("author's rel-feed fetched successfully %s", feed_url)
+      util.FetchFailure.record_success(feed_url)
       feeditems = _merge_hfeeds(feeditems,
                                 _find_feed_items(feed_url, feed_resp.text))
 
@@ -304,23 +345,46 @@ def _process_author(source, author_url, refetch=False, store_blanks=True):
 
     except AssertionError:
       raise  # reraise assertions for unit tests
-    except BaseException:
+    except BaseException, e:
       logging.warning('Could not fetch h-feed url %s.', feed_url,
                       exc_info=True)
+      util.FetchFailure.record_failure(feed_url, e)
+
+  return crawl_permalinks(source, _rank_permalinks(feeditems), refetch=refetch,
+                          store_blanks=store_blanks)
+
+
+def crawl_permalinks(source, entries, refetch=False, store_blanks=True):
+  """Processes h-feed permalinks in order until we run out of crawl budget.
 
-  permalink_to_entry = {}
-  for child in feeditems:
-    if 'h-entry' in child['type']:
-      # TODO maybe limit to first ~30 entries? (do that here rather than,
-      # below because we want the *first* n entries)
-      for permalink in child['properties'].get('url', []):
-        if isinstance(permalink, basestring):
-          permalink_to_entry[permalink] = child
-        else:
-          logging.warn('unexpected non-string "url" property: %s', permalink)
-
-  # query all preexisting permalinks at once, instead of once per link
-  permalinks_list = list(permalink_to_entry.keys())
+  We process at most MAX_PERMALINKS permalinks that need fetching, and we stop
+  early if source.crawl_deadline is within CRAWL_DEADLINE_MARGIN. Whatever's
+  left over is handed off to a crawl-permalinks task so that it's not lost.
+  Relationships are stored every FLUSH_PERMALINKS permalinks and before
+  deferring, so a crawl that dies partway through keeps what it found.
+
+  Domains that haven't had syndication links lately (see
+  models.DomainCapability) only get DomainCapability.THROTTLED_PERMALINKS
+  permalinks crawled, and the rest are dropped.
+
+  Args:
+    source: models.Source subclass
+    entries: sequence of (string permalink, h-entry dict) tuples, in the order
+      they should be processed
+    refetch: boolean, whether to refetch and process entries we've seen before
+    store_blanks: boolean, whether we should store blank SyndicatedPosts when
+      we don't find a relationship
+
+  Return:
+    a dict of syndicated_url to a list of new models.SyndicatedPost
+  """
+  # query all preexisting permalinks at once, instead of once per link. skip the
+  # ones that the filter says we definitely haven't seen.
+  filter = SyndicatedPostFilter.load(source)
+  permalinks_list = [permalink for permalink, _ in entries
+                     if filter.might_contain(original=permalink)]
+  SyndicatedPostFilter.record_hits(positive=len(permalinks_list),
+                                   negative=len(entries) - len(permalinks_list))
   # fetch the maximum allowed entries (currently 30) at a time
   preexisting_list = itertools.chain.from_iterable(
     SyndicatedPost.query(
@@ -332,13 +396,80 @@ def _process_author(source, author_url, refetch=False, store_blanks=True):
     preexisting.setdefault(r.original, []).append(r)
 
   results = {}
-  for permalink, entry in permalink_to_entry.iteritems():
+  crawled = 0
+  leftover = []
+  # relationships to store and keys to delete, one transaction per flush()
+  inserts = []
+  deletes = []
+  # relationships for the author's other silos, for _share_relationships()
+  shared = []
+  # permalinks that had any syndication links
+  syndicated = []
+
+  # maps domain to number of permalinks crawled
+  domains = collections.Counter()
+  throttled = models.DomainCapability.throttled(
+    set(util.domain_from_link(permalink) for permalink, _ in entries))
+  # backoff state for every permalink we might fetch, in one batch get
+  failures = util.FetchFailure.load_multi(
+    permalink for permalink, _ in entries
+    if refetch or not preexisting.get(permalink))
+  # domains that became backed off during this crawl. failures doesn't know
+  # about them.
+  down = set()
+
+  def flush():
+    if inserts or deletes:
+      stored = SyndicatedPost.insert_multi(source, inserts, deletes=deletes)
+      # swap in the stored entities for the unsaved ones from _process_entry
+      for rs in results.values():
+        rs[:] = [stored.get((r.syndication, r.original), r) for r in rs]
+      del inserts[:]
+      del deletes[:]
+
+  for permalink, entry in entries:
+    domain = util.domain_from_link(permalink)
+    if preexisting.get(permalink) and not refetch:
+      continue  # _process_entry won't fetch anything, so it's free
+    elif (domain in throttled and
+          domains[domain] >= models.DomainCapability.THROTTLED_PERMALINKS):
+      logging.debug('skipping permalink on throttled domain: %s', permalink)
+      continue
+    elif domain in down:
+      logging.debug('skipping permalink on backed off domain: %s', permalink)
+      continue
+    elif leftover or crawled >= MAX_PERMALINKS or _near_deadline(source):
+      if not leftover:
+        flush()
+      leftover.append((permalink, entry))
+      continue
+
     logging.debug('processing permalink: %s', permalink)
+    crawled += 1
+    domains[domain] += 1
     new_results = _process_entry(
       source, permalink, entry, refetch, preexisting.get(permalink, []),
-      store_blanks=store_blanks)
+      inserts, deletes, shared, syndicated, store_blanks=store_blanks,
+      failures=failures.get(permalink), down=down)
     for key, value in new_results.iteritems():
       results.setdefault(key, []).extend(value)
+    if crawled % FLUSH_PERMALINKS == 0:
+      flush()
+
+  flush()
+  _share_relationships(source, shared)
+
+  syndicated_domains = set(util.domain_from_link(url) for url in syndicated)
+  for domain in domains:
+    if domain:
+      models.DomainCapability.record(domain, domain in syndicated_domains,
+                                     throttled=domain in throttled)
+
+  if leftover:
+    logging.info('Crawl budget exhausted after %d permalinks. Deferring %d more '
+                 'to a crawl-permalinks task.', crawled, len(leftover))
+    util.add_crawl_permalinks_task(source, leftover, refetch=refetch,
+                                   store_blanks=store_blanks)
 
   if source.updates is not None and results:
     # keep track of the last time we've seen rel=syndication urls for
@@ -352,6 +483,101 @@ def _process_author(source, author_url, refetch=False, store_blanks=True):
   return results
 
 
+def _share_relationships(source, relationships):
+  """Stores relationships for the author's other sources.
+
+  Authors often have several Bridgy accounts, e.g. Twitter and Facebook, that
+  all point to the same web site. When we crawl it for one of them, we store
+  the syndication links to the other silos too, so that those sources find
+  them with a SyndicatedPost query instead of crawling the same h-feed again.
+
+  Sibling sources are the ones in other silos with any of this source's
+  domains that are listening. They're found with DomainIndex, which caches
+  lookups. We only share relationships whose syndication and original URLs
+  the sibling's SyndicatedPostFilter says it definitely doesn't have yet, so
+  we never replace its own blanks, and we don't write anything when nothing
+  changed. Filter false positives just mean the sibling finds those itself.
+
+  Args:
+    source: models.Source subclass that we crawled for
+    relationships: sequence of (syndication, original) tuples whose
+      syndication URLs are in other silos
+  """
+  if not relationships or not source.domains:
+    return
+
+  by_domain = {}
+  for syndication, original in relationships:
+    by_domain.setdefault(util.domain_from_link(syndication), []).append(
+      (syndication, original))
+
+  siblings = []
+  for entry in models.DomainIndex.lookup_multi(source.domains, feature='listen'):
+    cls = models.sources.get(entry.silo)
+    if (cls and entry.source != source.key and entry.status != 'disabled' and
+        getattr(cls.GR_CLASS, 'DOMAIN', None) in by_domain):
+      siblings.append(entry.source)
+
+  for sibling in ndb.get_multi(siblings):
+    if (not sibling or sibling.status == 'disabled' or
+        'listen' not in sibling.features):
+      continue
+    filter = SyndicatedPostFilter.load(sibling)
+    new = []
+    for syndication, original in by_domain[sibling.GR_CLASS.DOMAIN]:
+      syndication = sibling.canonicalize_syndication_url(syndication)
+      if not (filter.might_contain(syndication=syndication) or
+              filter.might_contain(original=original)):
+        new.append((syndication, original))
+
+    if new:
+      logging.info('Sharing %d relationships with %s', len(new), sibling.label())
+      SyndicatedPost.insert_multi(sibling, new)
+
+
+def _rank_permalinks(feeditems):
+  """Returns the h-entry permalinks in an h-feed in the order we should crawl.
+
+  Newest first, based on dt-published, then by position in the feed. Entries
+  without a (parseable) dt-published sort after those with one.
+
+  Args:
+    feeditems: list of mf2 item dicts
+
+  Returns:
+    list of (string permalink, h-entry dict) tuples, one per unique permalink
+  """
+  ranked = []
+  seen = set()
+  for position, child in enumerate(feeditems):
+    if 'h-entry' not in child['type']:
+      continue
+
+    published = 0
+    for val in child['properties'].get('published', [])[:1]:
+      try:
+        published = calendar.timegm(util.parse_iso8601(val).utctimetuple())
+      except BaseException:
+        logging.debug('could not parse dt-published %r', val)
+
+    for permalink in child['properties'].get('url', []):
+      if isinstance(permalink, basestring):
+        if permalink not in seen:
+          seen.add(permalink)
+          ranked.append((-published, position, permalink, child))
+      else:
+        logging.warn('unexpected non-string "url" property: %s', permalink)
+
+  ranked.sort(key=lambda r: r[:2])
+  return [(permalink, child) for _, _, permalink, child in ranked]
+
+
+def _near_deadline(source):
+  """Returns True if source.crawl_deadline is set and we're close to it."""
+  return bool(source.crawl_deadline and
+              util.now_fn() + CRAWL_DEADLINE_MARGIN >= source.crawl_deadline)
+
+
 def _merge_hfeeds(feed1, feed2):
   """Merge items from two h-feeds into a composite feed. Skips items in
   feed2 that are already represented in feed1, based on the "url" property.
@@ -398,9 +624,10 @@ def _find_feed_items(feed_url, feed_doc):
 
 
 def _process_entry(source, permalink, feed_entry, refetch, preexisting,
-                   store_blanks=True):
-  """Fetch and process an h-entry, saving a new SyndicatedPost to the
-  DB if successful.
+                   inserts, deletes, shared, syndicated,
+                   store_blanks=True, failures=None, down=None):
+  """Fetch and process an h-entry, collecting new SyndicatedPost
+  relationships to be stored if successful.
 
   Args:
     source:
@@ -410,11 +637,22 @@ def _process_entry(source, permalink, feed_entry, refetch, preexisting,
     refetch: boolean, whether to refetch and process entries we've seen before
     preexisting: a list of previously discovered models.SyndicatedPosts
       for this permalink
+    inserts: list. (syndication, original) tuples to store are appended to it.
+    deletes: list. keys of SyndicatedPosts to delete are appended to it.
+    shared: list. (syndication, original) tuples for other silos are appended
+      to it. See _share_relationships().
+    syndicated: list. permalink is appended to it if it has any syndication
+      links, to any silo.
     store_blanks: boolean, whether we should store blank SyndicatedPosts when
       we don't find a relationship
+    failures: optional list of util.FetchFailures for permalink, from
+      util.FetchFailure.load_multi()
+    down: optional set. If fetching permalink fails and its domain becomes
+      backed off, the domain is added to it.
 
   Returns:
-    a dict from syndicated url to a list of new models.SyndicatedPosts
+    a dict from syndicated url to a list of new models.SyndicatedPosts. They
+    haven't been stored yet; pass inserts to SyndicatedPost.insert_multi().
   """
   # if the post has already been processed, do not add to the results
   # since this method only returns *newly* discovered relationships.
@@ -429,30 +667,46 @@ def _process_entry(source, permalink, feed_entry, refetch, preexisting,
       logging.debug('previously found relationship(s) for original %s: %s',
                     permalink, synds)
 
+  # if the permalink or its site is backed off, don't touch it at all, not even
+  # to resolve it, and don't store a blank, so that we try again later.
+  backed_off = not util.FetchFailure.should_fetch(permalink, failures=failures)
+
   # first try with the h-entry from the h-feed. if we find the syndication url
   # we're looking for, we don't have to fetch the permalink
-  permalink, _, type_ok = util.get_webmention_target(permalink)
+  resolved, _, type_ok = util.get_webmention_target(permalink,
+                                                    resolve=not backed_off)
+  if resolved != permalink:
+    # the failures we were given were for the unresolved URL
+    failures = None
+    backed_off = not util.FetchFailure.should_fetch(resolved)
+  permalink = resolved
   usynd = feed_entry.get('properties', {}).get('syndication', [])
   if usynd:
     logging.debug('u-syndication links on the h-feed h-entry: %s', usynd)
+    syndicated.append(permalink)
   results = _process_syndication_urls(source, permalink, set(
-    url for url in usynd if isinstance(url, basestring)), preexisting)
+    url for url in usynd if isinstance(url, basestring)), preexisting, shared)
   success = True
 
   # fetch the full permalink page, which often has more detailed information
   if not results:
     parsed = None
     try:
-      logging.debug('fetching post permalink %s', permalink)
-      if type_ok:
+      if type_ok and not backed_off:
+        logging.debug('fetching post permalink %s', permalink)
         resp = util.requests_get(permalink)
         resp.raise_for_status()
+        util.FetchFailure.record_success(permalink, failures=failures)
         parsed = mf2py.Parser(url=permalink, doc=resp.text).to_dict()
+      elif type_ok:
+        success = False
     except AssertionError:
       raise  # for unit tests
-    except BaseException:
-      # TODO limit the number of allowed failures
+    except BaseException, e:
       logging.warning('Could not fetch permalink %s', permalink, exc_info=True)
+      if (util.FetchFailure.record_failure(permalink, e) and
+          down is not None):
+        down.add(util.domain_from_link(permalink))
       success = False
 
     if parsed:
@@ -471,34 +725,37 @@ def _process_entry(source, permalink, feed_entry, refetch, preexisting,
           logging.debug('u-syndication links: %s', usynd)
         syndication_urls.update(url for url in usynd
                                 if isinstance(url, basestring))
+      if syndication_urls:
+        syndicated.append(permalink)
       results = _process_syndication_urls(
-        source, permalink, syndication_urls, preexisting)
+        source, permalink, syndication_urls, preexisting, shared)
 
   # detect and delete SyndicatedPosts that were removed from the site
   if success:
-    result_syndposts = itertools.chain(*results.values())
+    result_syndposts = list(itertools.chain(*results.values()))
     for syndpost in list(preexisting):
       if syndpost.syndication and syndpost not in result_syndposts:
         logging.info('deleting relationship that disappeared: %s', syndpost)
-        syndpost.key.delete()
+        deletes.append(syndpost.key)
         preexisting.remove(syndpost)
 
   if not results:
     logging.debug('no syndication links from %s to current source %s.',
                   permalink, source.label())
     results = {}
-    if store_blanks and not preexisting:
+    if store_blanks and not preexisting and not (type_ok and backed_off):
       # remember that this post doesn't have syndication links for this
       # particular source
       logging.debug('saving empty relationship so that %s will not be '
                     'searched again', permalink)
-      SyndicatedPost.insert_original_blank(source, permalink)
+      inserts.append((None, permalink))
 
   # only return results that are not in the preexisting list
   new_results = {}
   for syndurl, syndposts_for_url in results.iteritems():
     for syndpost in syndposts_for_url:
       if syndpost not in preexisting:
+        inserts.append((syndpost.syndication, syndpost.original))
         new_results.setdefault(syndurl, []).append(syndpost)
 
   if new_results:
@@ -507,10 +764,10 @@ def _process_entry(source, permalink, feed_entry, refetch, preexisting,
 
 
 def _process_syndication_urls(source, permalink, syndication_urls,
-                              preexisting):
+                              preexisting, shared):
   """Process a list of syndication URLs looking for one that matches the
-  current source.  If one is found, stores a new SyndicatedPost in the
-  db.
+  current source.  If one is found, creates a new SyndicatedPost, but
+  doesn't store it.
 
   Args:
     source: a models.Source subclass
@@ -518,13 +775,15 @@ def _process_syndication_urls(source, permalink, syndication_urls,
     syndication_urls: a collection of strings. the unfitered list
       of syndication urls
     preexisting: a list of previously discovered SyndicatedPosts
+    shared: list. (syndication, original) tuples for URLs in other silos are
+      appended to it.
 
   Returns: dict mapping string syndication url to list of SyndicatedPost
   """
 
   results = {}
-  # save the results (or lack thereof) to the db, and put them in a
-  # map for immediate use
+  # put the results in a map for immediate use. _process_entry's caller
+  # stores them.
   for syndication_url in syndication_urls:
     # follow redirects to give us the canonical syndication url --
     # gives the best chance of finding a match.
@@ -532,21 +791,22 @@ def _process_syndication_urls(source, permalink, syndication_urls,
     # source-specific logic to standardize the URL. (e.g., replace facebook
     # username with numeric id)
     syndication_url = source.canonicalize_syndication_url(syndication_url)
-    # check that the syndicated url belongs to this source TODO save future
-    # lookups by saving results for other sources too (note: query the
-    # appropriate source subclass by author.domains, rather than
-    # author.domain_urls)
-    if util.domain_from_link(syndication_url) == source.GR_CLASS.DOMAIN:
+    # check that the syndicated url belongs to this source. if it's another
+    # silo, save it for the author's sources there.
+    if util.domain_from_link(syndication_url) != source.GR_CLASS.DOMAIN:
+      shared.append((syndication_url, permalink))
+    else:
       # we may have already seen this relationship, save a DB lookup by
       # finding it in the preexisting list
       relationship = next((sp for sp in preexisting
                            if sp.syndication == syndication_url
                            and sp.original == permalink), None)
       if not relationship:
-        logging.debug('saving discovered relationship %s -> %s',
+        logging.debug('discovered relationship %s -> %s',
                       syndication_url, permalink)
-        relationship = SyndicatedPost.insert(
-          source, syndication=syndication_url, original=permalink)
+        relationship = SyndicatedPost(parent=source.key,
+                                      syndication=syndication_url,
+                                      original=permalink)
       results.setdefault(syndication_url, []).append(relationship)
   return results
 
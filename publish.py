@@ -146,7 +146,9 @@ class Handler(webmention.WebmentionHandler):
 
     # look up source by domain
     domain = domain.lower()
-    sources = source_cls.query().filter(source_cls.domains == domain).fetch(100)
+    sources = filter(None, models.Source.get_cached_multi(
+      e.source for e in models.DomainIndex.lookup(domain,
+                                                  silo=source_cls.SHORT_NAME)))
     if not sources:
       return self.error("Could not find <b>%(type)s</b> account for <b>%(domain)s</b>. Check that your %(type)s profile has %(domain)s in its <em>web site</em> or <em>link</em> field, then try signing up again." %
         {'type': source_cls.GR_CLASS.NAME, 'domain': domain})
@@ -445,6 +447,7 @@ class Handler(webmention.WebmentionHandler):
       if self.PREVIEW:
         entity.type = 'preview'
       entity.put()
+      models.Counter.increment('publishes')
 
     logging.debug('Publish entity: %s', entity.key.urlsafe())
     return entity
@@ -5,9 +5,11 @@ __author__ = ['Ryan Barrett <bridgy@ryanb.org>']
 
 import bz2
 import calendar
+import collections
 import copy
 import datetime
 import gc
+import itertools
 import json
 import logging
 import random
@@ -15,8 +17,10 @@ import urlparse
 
 from google.appengine.api import memcache
 from google.appengine.api import datastore_errors
+from google.appengine.api.datastore import MAX_ALLOWABLE_QUERIES
 from google.appengine.api.datastore_types import _MAX_STRING_LENGTH
 from google.appengine.ext import ndb
+from google.appengine.ext.ndb.stats import KindStat
 from granary import source as gr_source
 import webapp2
 from webmentiontools import send
@@ -25,6 +29,7 @@ import appengine_config
 
 from oauth_dropins import handlers
 from granary.source import Source
+import app
 # need to import model class definitions since poll creates and saves entities.
 import blogger
 import facebook
@@ -32,7 +37,8 @@ import flickr
 import googleplus
 import instagram
 import models
-from models import Response
+from models import (BlogPost, BlogWebmention, DomainCapability, Publish,
+                    Response, SyndicatedPost)
 import original_post_discovery
 import tumblr
 import twitter
@@ -43,6 +49,80 @@ WEBMENTION_DISCOVERY_CACHE_TIME = 60 * 60 * 2  # 2h
 
 ERROR_HTTP_RETURN_CODE = 304  # "Not Modified"
 
+# task queue request deadline
+TASK_DEADLINE = datetime.timedelta(minutes=10)
+
+# max entities to delete or archive per gc task
+GC_BATCH_SIZE = 500
+
+Retention = collections.namedtuple('Retention',
+                                   ('days', 'query', 'date', 'archive'))
+
+# Garbage collection policies, keyed by name. query returns a query for
+# entities we no longer need once their date property is more than days old.
+# If archive is set, those entities are kept and only the named properties are
+# cleared. Otherwise they're deleted outright.
+#
+# Archive policies record the cutoff of their last complete run in a
+# models.GarbageCollection and only look at entities newer than it after that,
+# so they don't read and rewrite the same archived entities every run.
+#
+# Never collect anything we still use to dedupe:
+# * complete Responses keep us from propagating the same comments and likes
+#   again when silo APIs return old ones, so we only drop their JSON and keep
+#   their key, status, targets, and render fields. Activities that no archived
+#   Response refers to any more are deleted along with them.
+# * complete Publishes and BlogWebmentions keep us from publishing the same
+#   page twice, so we only drop their raw HTML. (We query those by created,
+#   since archiving them bumps updated.)
+# * (None, original) SyndicatedPosts mark permalinks we've already crawled.
+#   insert_multi keeps at most one per original, so we leave them alone and
+#   only collect old (syndication, None) blanks.
+# * new, processing, and error Responses and BlogPosts may still propagate.
+#
+# Caches are safe to drop once they'd be refetched or recomputed anyway:
+# * ResolvedUrls past RESOLVED_URL_TTL are refreshed before they're used again.
+# * FetchFailures whose retry_after is long past only matter for how fast the
+#   next failure backs off, and that's capped at FETCH_BACKOFF_MAX.
+# * DomainCapabilities that haven't been probed in a long time are for domains
+#   we've stopped crawling. If we crawl them again, we start over unthrottled.
+RETENTION = {
+  'Response': Retention(
+    365, lambda: Response.query(Response.status == 'complete'),
+    Response.updated, ('response_json', 'activities_json', 'activity_keys',
+                       'old_response_jsons', 'urls_to_activity')),
+  'BlogPost': Retention(
+    365, lambda: BlogPost.query(BlogPost.status == 'complete'),
+    BlogPost.updated, None),
+  'Publish-new': Retention(
+    30, lambda: Publish.query(Publish.status == 'new'), Publish.updated, None),
+  'Publish-failed': Retention(
+    90, lambda: Publish.query(Publish.status == 'failed'), Publish.updated,
+    None),
+  'Publish-preview': Retention(
+    30, lambda: Publish.query(Publish.type == 'preview'), Publish.updated,
+    None),
+  'Publish-html': Retention(
+    90, lambda: Publish.query(Publish.status == 'complete'), Publish.created,
+    ('html',)),
+  'BlogWebmention-failed': Retention(
+    90, lambda: BlogWebmention.query(BlogWebmention.status == 'failed'),
+    BlogWebmention.updated, None),
+  'BlogWebmention-html': Retention(
+    90, lambda: BlogWebmention.query(BlogWebmention.status == 'complete'),
+    BlogWebmention.created, ('html',)),
+  'SyndicatedPost': Retention(
+    180, lambda: SyndicatedPost.query(SyndicatedPost.original == None),
+    SyndicatedPost.updated, None),
+  'ResolvedUrl': Retention(
+    util.RESOLVED_URL_TTL.days, lambda: util.ResolvedUrl.query(),
+    util.ResolvedUrl.fetched, None),
+  'FetchFailure': Retention(
+    30, lambda: util.FetchFailure.query(), util.FetchFailure.retry_after, None),
+  'DomainCapability': Retention(
+    90, lambda: DomainCapability.query(), DomainCapability.last_probe, None),
+}
+
 
 class Poll(webapp2.RequestHandler):
   """Task handler that fetches and processes new responses from a single source.
@@ -83,6 +163,7 @@ class Poll(webapp2.RequestHandler):
     source = models.Source.put_updates(source)
 
     source.updates = {}
+    source.crawl_deadline = util.now_fn() + TASK_DEADLINE
     try:
       self.poll(source)
     except models.DisableSource:
@@ -119,9 +200,10 @@ class Poll(webapp2.RequestHandler):
     # * posts by the user
     # * search all posts for the user's domain URLs to find links
     #
+    state = source.load_state()
     cache = util.CacheDict()
-    if source.last_activities_cache_json:
-      cache.update(json.loads(source.last_activities_cache_json))
+    if state.last_activities_cache_json:
+      cache.update(json.loads(state.last_activities_cache_json))
 
     try:
       # search for links first so that the user's activities and responses
@@ -260,10 +342,11 @@ class Poll(webapp2.RequestHandler):
     #
     # Step 3: filter out responses we've already seen
     #
-    # seen responses (JSON objects) for each source are stored in its entity.
+    # seen responses (JSON objects) for each source are stored in its
+    # SourceState.
     unchanged_responses = []
-    if source.seen_responses_cache_json:
-      for seen in json.loads(source.seen_responses_cache_json):
+    if state.seen_responses_cache_json:
+      for seen in json.loads(state.seen_responses_cache_json):
         id = seen['id']
         resp = responses.get(id)
         if resp and not source.gr_source.activity_changed(seen, resp, log=True):
@@ -274,6 +357,7 @@ class Poll(webapp2.RequestHandler):
     # Step 4: store new responses and enqueue propagate tasks
     #
     pruned_responses = []
+    resp_entities = []
     for id, resp in responses.items():
       resp_type = Response.get_type(resp)
       activities = resp.pop('activities', [])
@@ -308,17 +392,29 @@ class Poll(webapp2.RequestHandler):
       # activities. details in the step 2 comment above.
       pruned_response = util.prune_response(resp)
       pruned_responses.append(pruned_response)
+      pruned_activities = [util.prune_activity(a) for a in activities]
       resp_entity = Response(
         id=id,
         source=source.key,
-        activities_json=[json.dumps(util.prune_activity(a)) for a in activities],
         response_json=json.dumps(pruned_response),
         type=resp_type,
         unsent=list(urls_to_activity.keys()),
         failed=list(too_long),
-        original_posts=resp.get('originals', []))
+        original_posts=resp.get('originals', []),
+        activity_urls=Response.canonical_activity_urls(source, activities))
       if urls_to_activity and len(activities) > 1:
         resp_entity.urls_to_activity=json.dumps(urls_to_activity)
+      resp_entity.set_render_fields(pruned_response, pruned_activities)
+      # sort keys so that identical activities serialize, and hash, identically
+      resp_entities.append((resp_entity, [
+        json.dumps(a, sort_keys=True) for a in pruned_activities]))
+
+    # store each distinct activity once, then the responses that refer to them
+    activity_keys = iter(models.Activity.store_multi(list(
+      itertools.chain.from_iterable(a for _, a in resp_entities))))
+    for resp_entity, activities_json in resp_entities:
+      resp_entity.activity_keys = list(
+        itertools.islice(activity_keys, len(activities_json)))
       resp_entity.get_or_save(source)
 
     # update cache
@@ -338,76 +434,141 @@ class Poll(webapp2.RequestHandler):
     # if the author has added syndication urls since the first time
     # original_post_discovery ran, we'll miss them. this cleanup task will
     # periodically check for updated urls. only kicks in if the author has
-    # *ever* published a rel=syndication url
+    # *ever* published a rel=syndication url. the refetch itself happens in a
+    # refetch-hfeed task so that slow personal web sites don't slow down polls.
     if (source.last_hfeed_fetch == models.REFETCH_HFEED_TRIGGER or
         (source.last_syndication_url and
          source.last_hfeed_fetch + source.refetch_period()
            <= source.last_poll_attempt)):
-      logging.info('refetching h-feed for source %s', source.label())
-      relationships = original_post_discovery.refetch(source)
-      if relationships:
-        logging.info('refetch h-feed found new rel=syndication relationships: %s',
-                     relationships)
-        try:
-          self.repropagate_old_responses(source, relationships)
-        except BaseException, e:
-          if (isinstance(e, (datastore_errors.BadRequestError,
-                             datastore_errors.Timeout)) or
-              util.is_connection_failure(e)):
-            logging.info('Timeout while repropagating responses.', exc_info=True)
-          else:
-            raise
+      util.add_refetch_hfeed_task(source)
     else:
       logging.info(
           'skipping refetch h-feed. last-syndication-url %s, last-hfeed-fetch %s',
           source.last_syndication_url, source.last_hfeed_fetch)
 
-  def repropagate_old_responses(self, source, relationships):
-    """Find old Responses that match a new SyndicatedPost and repropagate them.
 
-    We look through as many responses as we can until the datastore query expires.
-    """
-    for response in (Response.query(Response.source == source.key)
-                     .order(-Response.updated)):
-      if response.activity_json:  # handle old entities
-        response.activities_json.append(response.activity_json)
-        response.activity_json = None
-
-      new_orig_urls = set()
-      for activity_json in response.activities_json:
-        activity = json.loads(activity_json)
-        activity_url = activity.get('url') or activity.get('object', {}).get('url')
-        if not activity_url:
-          logging.warning('activity has no url %s', activity_json)
-          continue
+def repropagate_old_responses(source, relationships):
+  """Find old Responses that match a new SyndicatedPost and repropagate them.
 
-        activity_url = source.canonicalize_syndication_url(activity_url,
-                                                           activity=activity)
-        # look for activity url in the newly discovered list of relationships
-        for relationship in relationships.get(activity_url, []):
-          # won't re-propagate if the discovered link is already among
-          # these well-known upstream duplicates
-          if (relationship.original in response.sent or
-              relationship.original in response.original_posts):
-            logging.info(
-              '%s found a new rel=syndication link %s -> %s, but the '
-              'relationship had already been discovered by another method',
-              response.label(), relationship.original,
-              relationship.syndication)
-          else:
-            logging.info(
-              '%s found a new rel=syndication link %s -> %s, and '
-              'will be repropagated with a new target!',
-              response.label(), relationship.original,
-              relationship.syndication)
-            new_orig_urls.add(relationship.original)
+  Queries Response.activity_urls for the relationships' syndication URLs, 30 at
+  a time. A Response can match URLs in more than one batch, so they're deduped
+  by key before we touch them.
+  """
+  urls = relationships.keys()
+  responses = {}
+  for i in xrange(0, len(urls), MAX_ALLOWABLE_QUERIES):
+    query = Response.query(
+      Response.source == source.key,
+      Response.activity_urls.IN(urls[i:i + MAX_ALLOWABLE_QUERIES]))
+    for response in query:
+      responses.setdefault(response.key, response)
+
+  for response in sorted(responses.values(), key=lambda r: r.updated,
+                         reverse=True):
+    if not response.response_json:
+      continue  # archived by gc
+
+    new_orig_urls = set()
+    for activity_url in response.activity_urls:
+      # look for activity url in the newly discovered list of relationships
+      for relationship in relationships.get(activity_url, []):
+        # won't re-propagate if the discovered link is already among
+        # these well-known upstream duplicates
+        if (relationship.original in response.sent or
+            relationship.original in response.original_posts):
+          logging.info(
+            '%s found a new rel=syndication link %s -> %s, but the '
+            'relationship had already been discovered by another method',
+            response.label(), relationship.original,
+            relationship.syndication)
+        else:
+          logging.info(
+            '%s found a new rel=syndication link %s -> %s, and '
+            'will be repropagated with a new target!',
+            response.label(), relationship.original,
+            relationship.syndication)
+          new_orig_urls.add(relationship.original)
+
+    if new_orig_urls:
+      # re-open a previously 'complete' propagate task
+      response.status = 'new'
+      response.unsent.extend(list(new_orig_urls))
+      response.put()
+      response.add_task()
+
+
+class RefetchHfeed(webapp2.RequestHandler):
+  """Task handler that refetches a source's h-feed for new syndication links.
+
+  Repropagates old responses that match new relationships.
+
+  Request parameters:
+    source_key: string key of source entity
+  """
+
+  def post(self):
+    logging.debug('Params: %s', self.request.params)
+
+    source = ndb.Key(urlsafe=self.request.params['source_key']).get()
+    if not source or source.status == 'disabled' or 'listen' not in source.features:
+      logging.error('Source not found or disabled. Dropping task.')
+      return
+    logging.info('Source: %s %s, %s', source.label(), source.key.string_id(),
+                 source.bridgy_url(self))
 
-      if new_orig_urls:
-        # re-open a previously 'complete' propagate task
-        response.status = 'new'
-        response.unsent.extend(list(new_orig_urls))
-        response.put()
-        response.add_task()
+    source.updates = {}
+    source.crawl_deadline = util.now_fn() + TASK_DEADLINE
+    relationships = original_post_discovery.refetch(source)
+    if relationships:
+      logging.info('refetch h-feed found new rel=syndication relationships: %s',
+                   relationships)
+      try:
+        repropagate_old_responses(source, relationships)
+      except BaseException, e:
+        if (isinstance(e, (datastore_errors.BadRequestError,
+                           datastore_errors.Timeout)) or
+            util.is_connection_failure(e)):
+          logging.info('Timeout while repropagating responses.', exc_info=True)
+        else:
+          raise
+
+    models.Source.put_updates(source)
+
+
+class CrawlPermalinks(webapp2.RequestHandler):
+  """Task handler that crawls h-feed permalinks left over from an earlier crawl.
+
+  Request parameters:
+    source_key: string key of source entity
+    entries: JSON list of [string permalink, [string u-syndication URL, ...]]
+    refetch: 'true' to reprocess permalinks we've seen before
+    store_blanks: 'true' to store blank SyndicatedPosts
+  """
+
+  def post(self):
+    logging.debug('Params: %s', self.request.params)
+
+    source = ndb.Key(urlsafe=self.request.params['source_key']).get()
+    if not source or source.status == 'disabled' or 'listen' not in source.features:
+      logging.error('Source not found or disabled. Dropping task.')
+      return
+    logging.info('Source: %s %s, %s', source.label(), source.key.string_id(),
+                 source.bridgy_url(self))
+
+    entries = [(permalink, {'properties': {'syndication': synds}})
+               for permalink, synds in json.loads(self.request.params['entries'])]
+
+    source.updates = {}
+    source.crawl_deadline = util.now_fn() + TASK_DEADLINE
+    relationships = original_post_discovery.crawl_permalinks(
+      source, entries, refetch=self.request.get('refetch') == 'true',
+      store_blanks=self.request.get('store_blanks') == 'true')
+    if relationships:
+      logging.info('crawl found new rel=syndication relationships: %s',
+                   relationships)
+      repropagate_old_responses(source, relationships)
+
+    models.Source.put_updates(source)
 
 
 class SendWebmentions(webapp2.RequestHandler):
@@ -508,6 +669,9 @@ class SendWebmentions(webapp2.RequestHandler):
         logging.info('Sent! %s', mention.response)
         self.record_source_webmention(mention)
         self.entity.sent.append(target)
+        if not getattr(self.entity, 'old_response_jsons', None):
+          # don't count resends of responses that changed
+          models.Counter.increment('webmentions')
       else:
         code = error['code']
         status = error.get('http_status', 0)
@@ -627,7 +791,7 @@ class PropagateResponse(SendWebmentions):
   """Task handler that sends webmentions for a Response.
 
   Attributes:
-    activities: parsed Response.activities_json list
+    activities: parsed list of the Response's activities
 
   Request parameters:
     response_key: string key of Response entity
@@ -638,7 +802,7 @@ class PropagateResponse(SendWebmentions):
     if not self.lease(ndb.Key(urlsafe=self.request.params['response_key'])):
       return
 
-    self.activities = [json.loads(a) for a in self.entity.activities_json]
+    self.activities = [json.loads(a) for a in self.entity.load_activities_json()]
     response_obj = json.loads(self.entity.response_json)
     if (not Source.is_public(response_obj) or
         not all(Source.is_public(a) for a in self.activities)):
@@ -713,7 +877,9 @@ class PropagateBlogPost(SendWebmentions):
       source_domains = self.entity.source.get().domains
       to_send = set()
       for url in self.entity.unsent:
-        url, domain, ok = util.get_webmention_target(url)
+        # don't try to resolve links to sites that have been failing
+        url, domain, ok = util.get_webmention_target(
+          url, resolve=util.FetchFailure.should_fetch(url))
         # skip "self" links to this blog's domain
         if ok and domain not in source_domains:
           to_send.add(url)
@@ -725,8 +891,162 @@ class PropagateBlogPost(SendWebmentions):
     return self.entity.key.id()
 
 
+class RenderCachedPage(webapp2.RequestHandler):
+  """Task handler that re-renders an expired util.CachedPage.
+
+  Request parameters:
+    path: string, the page's path, e.g. '/users'
+    host_url: string, scheme and host to render with, e.g. 'https://brid.gy'.
+      Optional, defaults to this task's.
+  """
+
+  def post(self):
+    logging.debug('Params: %s', self.request.params)
+
+    path = self.request.params['path']
+    resp = app.application.get_response(
+      path, base_url=self.request.get('host_url') or None,
+      environ={app.CachedPageHandler.RERENDER_ENVIRON: True})
+    if resp.status_int != 200:
+      logging.error('Re-rendering %s returned %s', path, resp.status_int)
+      self.abort(ERROR_HTTP_RETURN_CODE)
+
+
+class GarbageCollect(webapp2.RequestHandler):
+  """Task handler that deletes or archives one batch of old entities.
+
+  Adds another gc task to continue from where this one left off, if necessary,
+  and logs a report when the last one finishes.
+
+  Request parameters:
+    policy: string, key in RETENTION
+    cursor: string, urlsafe query cursor to start from. Optional.
+    cutoff, since: string datetimes, POLL_TASK_DATETIME_FORMAT. The first task
+      in a run computes them and passes them on, so that every task runs the
+      same query. since is only used by archive policies. Optional.
+    dry_run: 'true' to only count what we'd collect, not delete or archive it
+    count: integer, number of entities collected so far in this run
+    bytes: integer, approximate bytes reclaimed so far in this run
+  """
+
+  def post(self):
+    logging.debug('Params: %s', self.request.params)
+
+    name = self.request.params['policy']
+    policy = RETENTION.get(name)
+    if not policy:
+      logging.error('Unknown gc policy %s. Dropping task.', name)
+      return
+
+    dry_run = self.request.get('dry_run') == 'true'
+    count = int(self.request.get('count', 0))
+    reclaimed = int(self.request.get('bytes', 0))
+    cursor = self.request.get('cursor')
+
+    format = util.POLL_TASK_DATETIME_FORMAT
+    cutoff = self.request.get('cutoff')
+    if cutoff:
+      cutoff = datetime.datetime.strptime(cutoff, format)
+      since = self.request.get('since')
+      since = datetime.datetime.strptime(since, format) if since else None
+    else:
+      cutoff = util.now_fn() - datetime.timedelta(days=policy.days)
+      # round trip so that continuation tasks get exactly the same value
+      cutoff = datetime.datetime.strptime(cutoff.strftime(format), format)
+      progress = (models.GarbageCollection.get_by_id(name)
+                  if policy.archive else None)
+      since = progress.archived_before if progress else None
+
+    query = policy.query().filter(policy.date < cutoff)
+    if since:
+      query = query.filter(policy.date >= since)
+    results, next_cursor, more = query.fetch_page(
+      GC_BATCH_SIZE, keys_only=not policy.archive,
+      start_cursor=ndb.Cursor(urlsafe=cursor) if cursor else None)
+
+    if policy.archive:
+      archived = []
+      activity_keys = set()
+      for entity in results:
+        size = 0
+        for prop in policy.archive:
+          val = getattr(entity, prop)
+          if isinstance(val, list):
+            size += sum(len(unicode(v)) for v in val)
+          elif val:
+            size += len(val)
+        if size:
+          activity_keys.update(getattr(entity, 'activity_keys', []))
+          for prop in policy.archive:
+            setattr(entity, prop,
+                    [] if entity._properties[prop]._repeated else None)
+          archived.append(entity)
+          reclaimed += size
+      count += len(archived)
+      if archived and not dry_run:
+        ndb.put_multi(archived)
+        delete_orphaned_activities(activity_keys, cutoff)
+    else:
+      count += len(results)
+      reclaimed += len(results) * average_entity_size(query.kind)
+      if not dry_run:
+        ndb.delete_multi(results)
+
+    verb = 'would collect' if dry_run else 'collected'
+    if more and next_cursor:
+      logging.info('gc %s %s %d entities so far, continuing', name, verb, count)
+      params = {'cutoff': cutoff.strftime(format)}
+      if since:
+        params['since'] = since.strftime(format)
+      util.add_gc_task(name, cursor=next_cursor.urlsafe(), dry_run=dry_run,
+                       count=count, bytes=reclaimed, **params)
+    else:
+      logging.info('gc %s %s %d entities, reclaiming ~%d bytes', name, verb,
+                   count, reclaimed)
+      if policy.archive and not dry_run:
+        models.GarbageCollection(id=name, archived_before=cutoff).put()
+
+
+def delete_orphaned_activities(keys, cutoff):
+  """Deletes the Activities that no Response has used since cutoff.
+
+  Checks for Responses that still refer to each one with a keys-only query, in
+  parallel. Those queries are eventually consistent, and a new Response can
+  reuse an old Activity at any time, so Activities are only deleted if
+  Activity.store_multi() hasn't refreshed their last_used since cutoff either.
+
+  Args:
+    keys: sequence of Activity ndb.Keys
+    cutoff: datetime
+  """
+  keys = list(keys)
+  futures = [Response.query(Response.activity_keys == key).get_async(
+               keys_only=True) for key in keys]
+  orphans = [key for key, future in zip(keys, futures)
+             if not future.get_result()]
+  if orphans:
+    deleted = models.Activity.delete_unused_multi(orphans, cutoff)
+    logging.info('Deleted %d orphaned Activities', len(deleted))
+
+
+def average_entity_size(kind):
+  """Returns the average size of an entity of the given kind, in bytes.
+
+  Includes index rows. Uses datastore statistics, so it's approximate and may
+  be a day or two stale. Returns 0 if there are no stats, e.g. in dev_appserver.
+
+  https://cloud.google.com/appengine/docs/python/datastore/stats
+  """
+  stat = KindStat.query(KindStat.kind_name == kind).get()
+  return stat.bytes / stat.count if stat and stat.count else 0
+
+
 application = webapp2.WSGIApplication([
     ('/_ah/queue/poll(-now)?', Poll),
+    ('/_ah/queue/refetch-hfeed', RefetchHfeed),
+    ('/_ah/queue/crawl-permalinks', CrawlPermalinks),
     ('/_ah/queue/propagate', PropagateResponse),
     ('/_ah/queue/propagate-blogpost', PropagateBlogPost),
+    ('/_ah/queue/render-page', RenderCachedPage),
+    ('/_ah/queue/gc', GarbageCollect),
     ], debug=appengine_config.DEBUG)
@@ -3,6 +3,7 @@
 """
 import datetime
 import json
+import re
 import urllib
 
 from google.appengine.api import memcache
@@ -12,7 +13,10 @@ import mf2py
 import webapp2
 
 import app
+import appengine_config
 import models
+from models import Response
+import tasks
 import util
 import testutil
 
@@ -202,6 +206,76 @@ class AppTest(testutil.ModelsTest):
         ('result', 'declined')
       ]), resp.headers['Location'])
 
+  def test_front_page_serves_stale_and_rerenders(self):
+    self.mox.stubs.Set(appengine_config, 'DEBUG', False)
+    util.CachedPage.store('/', 'stale', expires=datetime.timedelta(minutes=-1))
+
+    resp = app.application.get_response('/')
+    self.assertEquals(200, resp.status_int)
+    self.assertEquals('stale', resp.body)
+
+    queued = self.taskqueue_stub.GetTasks('render-page')
+    self.assertEquals(1, len(queued))
+    resp = tasks.application.get_response(
+      '/_ah/queue/render-page', method='POST',
+      body=urllib.urlencode(testutil.get_task_params(queued[0])))
+    self.assertEquals(200, resp.status_int)
+
+    fresh = util.CachedPage.get_by_id('/')
+    self.assertNotEquals('stale', fresh.html)
+    self.assertFalse(fresh.expired())
+    self.assertEquals(fresh.html, app.application.get_response('/').body)
+
+  def test_front_page_rerender_keeps_scheme_and_host(self):
+    self.mox.stubs.Set(appengine_config, 'DEBUG', False)
+    util.CachedPage.store('/', 'stale', expires=datetime.timedelta(minutes=-1))
+
+    resp = app.application.get_response('/', scheme='https')
+    self.assertEquals('stale', resp.body)
+
+    queued = self.taskqueue_stub.GetTasks('render-page')
+    self.assertEquals(1, len(queued))
+    params = testutil.get_task_params(queued[0])
+    self.assertEquals({'path': '/', 'host_url': 'https://localhost'}, params)
+    resp = tasks.application.get_response(
+      '/_ah/queue/render-page', method='POST', body=urllib.urlencode(params))
+    self.assertEquals(200, resp.status_int)
+
+    # query params skip the cache, so this renders in the foreground
+    foreground = app.application.get_response('/?x=y', scheme='https')
+    self.assertEquals(foreground.body, util.CachedPage.get_by_id('/').html)
+
+  def test_users_page(self):
+    self.mox.stubs.Set(app.UsersHandler, 'PAGE_SIZE', 2)
+    for source in self.sources:
+      source.key.delete()
+    for name in 'bob', 'Carol', 'alice', 'Dave':
+      testutil.FakeSource.new(None, name=name, features=['listen']).put()
+    testutil.FakeSource.new(None, name='Eve', features=[]).put()
+
+    def get_page(path):
+      resp = app.application.get_response(path)
+      self.assertEquals(200, resp.status_int)
+      names = re.findall(r'fake_icon.png" />\s*(\w+)</a>', resp.body)
+      next_link = re.search(r'href="(\?cursor=[^"]+)"', resp.body)
+      return names, next_link and next_link.group(1).replace('&amp;', '&')
+
+    names, next_link = get_page('/users')
+    self.assertEquals(['alice', 'bob'], names)
+    names, next_link = get_page('/users' + next_link)
+    self.assertEquals(['Carol', 'Dave'], names)
+
+    names, _ = get_page('/users?start_name=c')
+    self.assertEquals(['Carol', 'Dave'], names)
+
+    # the next link from a start_name page has to use the same query
+    names, next_link = get_page('/users?start_name=b')
+    self.assertEquals(['bob', 'Carol'], names)
+    self.assertIn('start_name=b', next_link)
+    names, next_link = get_page('/users' + next_link)
+    self.assertEquals(['Dave'], names)
+    self.assertIsNone(next_link)
+
   def test_user_page(self):
     resp = app.application.get_response(self.sources[0].bridgy_path())
     self.assertEquals(200, resp.status_int)
@@ -253,6 +327,70 @@ class AppTest(testutil.ModelsTest):
     self.assertEquals(
       ['disabled'], hcard['properties'].get('bridgy-publish-status'))
 
+  def test_user_page_paging(self):
+    self.mox.stubs.Set(app.UserHandler, 'RENDER_FIELDS_FALLBACK', False)
+    for i in range(25):
+      Response(id='tag:fa.ke,2013:%d' % i, source=self.sources[0].key,
+               public=True, response_url='http://resp/%d' % i).put()
+    Response(id='tag:fa.ke,2013:private', source=self.sources[0].key,
+             public=False, response_url='http://resp/private').put()
+
+    def get_page(path):
+      resp = app.application.get_response(path)
+      self.assertEquals(200, resp.status_int)
+      shown = set(int(i) for i in re.findall(r'http://resp/(\d+)', resp.body))
+      links = dict(re.findall(
+        r'href="\?responses_(before|after)=([^"#]+)#responses"', resp.body))
+      self.assertNotIn('http://resp/private', resp.body)
+      return shown, links
+
+    path = self.sources[0].bridgy_path()
+    shown, links = get_page(path)
+    self.assertEquals(set(range(15, 25)), shown)
+    self.assertNotIn('after', links)
+
+    shown, links = get_page('%s?responses_before=%s' % (
+      path, links['before']))
+    self.assertEquals(set(range(5, 15)), shown)
+
+    shown, links = get_page('%s?responses_after=%s' % (
+      path, links['after']))
+    self.assertEquals(set(range(15, 25)), shown)
+
+  def test_user_page_responses_without_render_fields(self):
+    """Responses stored before the render fields existed still show up."""
+    Response(id='tag:fa.ke,2013:legacy', source=self.sources[0].key,
+             type='comment', response_json=json.dumps({
+               'url': 'http://resp/legacy',
+               'content': 'legacy content',
+               'author': {'displayName': 'Legacy Author'},
+             }),
+             activities_json=[json.dumps({'url': 'http://act/legacy'})]).put()
+    Response(id='tag:fa.ke,2013:legacy-private', source=self.sources[0].key,
+             type='comment', response_json=json.dumps({
+               'url': 'http://resp/legacy-private',
+               'to': [{'objectType': 'group', 'alias': '@private'}],
+             })).put()
+    Response(id='tag:fa.ke,2013:new', source=self.sources[0].key,
+             public=True, response_url='http://resp/new').put()
+
+    resp = app.application.get_response(self.sources[0].bridgy_path())
+    self.assertEquals(200, resp.status_int)
+    self.assertIn('http://resp/new', resp.body)
+    self.assertIn('http://resp/legacy', resp.body)
+    self.assertIn('legacy content', resp.body)
+    self.assertIn('Legacy Author', resp.body)
+    self.assertIn('http://act/legacy', resp.body)
+    self.assertNotIn('http://resp/legacy-private', resp.body)
+
+    # the fallback doesn't write anything
+    self.assertIsNone(Response.get_by_id('tag:fa.ke,2013:legacy').public)
+
+  def test_user_page_bad_cursor(self):
+    resp = app.application.get_response(
+      self.sources[0].bridgy_path() + '?responses_before=not%20a%20cursor')
+    self.assertEquals(400, resp.status_int)
+
   def test_logout(self):
     util.now_fn = lambda: datetime.datetime(2000, 1, 1)
     resp = app.application.get_response('/logout')
@@ -11,6 +11,8 @@ from oauth_dropins import instagram as oauth_instagram
 import cron
 import instagram
 from instagram import Instagram
+import models
+import tasks
 import testutil
 from testutil import FakeSource, HandlerTest
 
@@ -52,6 +54,35 @@ class CronTest(HandlerTest):
     self.assert_equals(sources[4].urlsafe(),
                        testutil.get_task_params(tasks[0])['source_key'])
 
+  def test_gc(self):
+    resp = cron.application.get_response('/cron/gc')
+    self.assertEqual(200, resp.status_int)
+
+    queued = self.taskqueue_stub.GetTasks('gc')
+    self.assertEqual(len(tasks.RETENTION), len(queued))
+    params = [testutil.get_task_params(task) for task in queued]
+    self.assertEqual(sorted(tasks.RETENTION), [p['policy'] for p in params])
+    self.assertEqual(['false'], list(set(p['dry_run'] for p in params)))
+
+  def test_gc_one_policy_dry_run(self):
+    resp = cron.application.get_response('/cron/gc?policy=Response&dry_run=true')
+    self.assertEqual(200, resp.status_int)
+
+    queued = self.taskqueue_stub.GetTasks('gc')
+    self.assertEqual(1, len(queued))
+    self.assertEqual({'policy': 'Response', 'dry_run': 'true'},
+                     testutil.get_task_params(queued[0]))
+
+  def test_reseed_counters(self):
+    models.Counter.set_base('users', 10)
+    models.Counter.increment('users')
+    FakeSource.new(None).put()
+    FakeSource.new(None, status='disabled').put()
+
+    resp = cron.application.get_response('/cron/reseed_counters')
+    self.assertEqual(200, resp.status_int)
+    self.assertEqual({'users': 1}, models.Counter.get_counts(('users',)))
+
   def test_update_instagram_pictures(self):
     for username in 'a', 'b':
       self.expect_urlopen(
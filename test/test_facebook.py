@@ -363,31 +363,40 @@ class FacebookPageTest(testutil.ModelsTest):
     self.assertEquals('https://www.facebook.com/212038/posts/123',
                       syndpost.syndication)
 
-  def test_pre_put_hook(self):
+  def test_resolved_object_ids_stored_in_state(self):
     self.expect_api_call('212038_1', {'id': '0', 'object_id': '2'})
     self.expect_api_call('212038_3', {'id': '0', 'object_id': '4'})
     self.expect_api_call('212038_5', {})
     self.mox.ReplayAll()
 
-    self.assertIsNone(self.fb.key.get().resolved_object_ids_json)
+    self.assertIsNone(self.fb.key.get().load_state().resolved_object_ids_json)
 
     self.fb.canonicalize_syndication_url('http://facebook.com/foo/posts/1')
     self.fb.canonicalize_syndication_url('http://facebook.com/foo/posts/3')
-    self.fb.put()
+    models.Source.put_updates(self.fb)
     self.assertEquals(json.dumps({'1': '2', '3': '4'}),
-                      self.fb.key.get().resolved_object_ids_json)
+                      self.fb.key.get().load_state().resolved_object_ids_json)
 
     try:
       orig = facebook.MAX_RESOLVED_OBJECT_IDS
       facebook.MAX_RESOLVED_OBJECT_IDS = 2
       self.fb.canonicalize_syndication_url('http://facebook.com/foo/posts/5')
-      self.fb.put()
+      models.Source.put_updates(self.fb)
       # should keep the highest ids
       self.assertEquals(json.dumps({'3': '4', '5': None}),
-                        self.fb.key.get().resolved_object_ids_json)
+                        self.fb.key.get().load_state().resolved_object_ids_json)
     finally:
       facebook.MAX_RESOLVED_OBJECT_IDS = orig
 
+  def test_resolved_object_ids_migrated_from_source(self):
+    self.fb.resolved_object_ids_json = json.dumps({'1': '2'})
+    self.fb.put()
+
+    fb = self.fb.key.get()
+    self.assertEquals('https://www.facebook.com/212038/posts/2',
+                      fb.canonicalize_syndication_url(
+                        'http://facebook.com/foo/posts/1'))
+
   def test_oauth_scopes(self):
     """Ensure that passing "feature" translates to the appropriate permission
     scopes when authing when Facebook.
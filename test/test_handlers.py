@@ -1,16 +1,22 @@
 """Unit tests for handlers.py.
 """
 
+import copy
 import json
+import re
 import StringIO
 import urllib2
 
+from google.appengine.api import memcache
 from google.appengine.api import urlfetch_errors
+from granary import microformats2
 
 import handlers
 import models
+import original_post_discovery
 import testutil
-from testutil import FakeGrSource
+from testutil import FakeGrSource, NOW
+import util
 
 
 class HandlersTest(testutil.HandlerTest):
@@ -455,3 +461,231 @@ asdf http://other/link qwert
 
 </article>
 """)
+
+  def get_post(self):
+    resp = handlers.application.get_response(
+      '/post/fake/%s/000?format=json' % self.source.key.string_id(),
+      scheme='https')
+    self.assertEqual(200, resp.status_int, resp.body)
+    return json.loads(resp.body)['properties']['content'][0]['value']
+
+  def test_render_cache(self):
+    self.assertEqual('asdf http://other/link qwert', self.get_post())
+
+    # should serve from the cache, not fetch the post again
+    self.activities[0]['object']['content'] = 'new'
+    self.assertEqual('asdf http://other/link qwert', self.get_post())
+
+    # a new response for this source invalidates its renders
+    models.Response(id='tag:fa.ke,2013:xyz', source=self.source.key,
+                    status='new').put()
+    self.assertEqual('new', self.get_post())
+
+  def test_render_cache_ignores_processing_responses(self):
+    self.get_post()
+    self.activities[0]['object']['content'] = 'new'
+    models.Response(id='tag:fa.ke,2013:xyz', source=self.source.key,
+                    status='processing').put()
+    self.assertEqual('asdf http://other/link qwert', self.get_post())
+
+  def test_render_cache_stale_while_revalidate(self):
+    self.get_post()
+    self.activities[0]['object']['content'] = 'new'
+    util.now_fn = lambda: NOW + handlers.RENDER_CACHE_FRESH * 2
+
+    # another request is already re-rendering, so serve the stale copy
+    key = 'R https post %s 000 json' % self.source.key.urlsafe()
+    self.assertTrue(memcache.add(key + ' lock', ''))
+    self.assertEqual('asdf http://other/link qwert', self.get_post())
+
+    memcache.delete(key + ' lock')
+    self.assertEqual('new', self.get_post())
+
+  def test_render_cache_stale_on_error(self):
+    self.get_post()
+    util.now_fn = lambda: NOW + handlers.RENDER_CACHE_FRESH * 2
+
+    self.mox.StubOutWithMock(testutil.FakeSource, 'get_activities')
+    testutil.FakeSource.get_activities(
+      activity_id='000', user_id=self.source.key.string_id()
+    ).AndRaise(urlfetch_errors.InternalTransientError('Try again pls'))
+    self.mox.ReplayAll()
+    self.assertEqual('asdf http://other/link qwert', self.get_post())
+
+  def store_response(self, id, type, response, **kwargs):
+    models.Response(id='tag:fa.ke,2013:%s' % id, source=self.source.key,
+                    type=type, status='complete',
+                    response_json=json.dumps(response),
+                    activities_json=[json.dumps(self.activities[0])],
+                    **kwargs).put()
+
+  def get_json(self, path):
+    resp = handlers.application.get_response(
+      (path % self.source.key.string_id()) + '?format=json')
+    self.assertEqual(200, resp.status_int, resp.body)
+    return json.loads(resp.body)['properties']
+
+  def test_comment_stored_response(self):
+    # FakeGrSource.comment is unset, so this would 404 if it hit the silo
+    self.store_response('a1', 'comment', {
+      'id': 'tag:fa.ke,2013:a1',
+      'content': 'stored',
+    })
+    FakeGrSource.activities = []
+
+    props = self.get_json('/comment/fake/%s/000/a1')
+    self.assertEqual(['tag:fa.ke,2013:a1'], props['uid'])
+    self.assertEqual('stored', props['content'][0]['value'])
+    self.assertEqual(['http://or.ig/post'],
+                     microformats2.get_string_urls(props['in-reply-to']))
+
+  def test_like_stored_response(self):
+    self.store_response('000_liked_by_111', 'like', {
+      'objectType': 'activity',
+      'verb': 'like',
+      'id': 'tag:fa.ke,2013:000_liked_by_111',
+      'object': {'url': 'http://fa.ke/000'},
+      'author': {'displayName': 'Stored'},
+    })
+    # a repost by the same user shouldn't match
+    self.store_response('000_reposted_by_111', 'repost', {'content': 'x'})
+
+    props = self.get_json('/like/fake/%s/000/111')
+    self.assertEqual(['tag:fa.ke,2013:000_liked_by_111'], props['uid'])
+    self.assertEqual(['http://fa.ke/000', 'http://or.ig/post'],
+                     microformats2.get_string_urls(props['like-of']))
+
+  def test_repost_stored_response_keyed_by_share_id(self):
+    # Twitter keys retweets by the retweet's own id, not POST_ID_...
+    self.store_response('222', 'repost', {
+      'objectType': 'activity',
+      'verb': 'share',
+      'id': 'tag:fa.ke,2013:222',
+      'object': {'url': 'http://fa.ke/000'},
+    })
+
+    props = self.get_json('/repost/fake/%s/000/222')
+    self.assertEqual(['tag:fa.ke,2013:222'], props['uid'])
+    self.assertEqual(['http://fa.ke/000', 'http://or.ig/post'],
+                     microformats2.get_string_urls(props['repost-of']))
+
+  def test_stored_response_has_same_links_as_live(self):
+    FakeGrSource.comment = {
+      'id': 'tag:fa.ke,2013:a1',
+      'content': 'qwert',
+      'inReplyTo': [{'url': 'http://fa.ke/000'}],
+    }
+    links = lambda body: sorted(re.findall(r'<a class="([^"]+)" href="([^"]+)"',
+                                           body))
+
+    url = '/comment/fake/%s/000/a1' % self.source.key.string_id()
+    live = handlers.application.get_response(url, scheme='https')
+    self.assertEqual(200, live.status_int, live.body)
+
+    # store it pruned with its targets, the same way poll does. the pruned
+    # activity doesn't have upstreamDuplicates, so discovery can't find
+    # http://or.ig/post in it.
+    originals, mentions = original_post_discovery.discover(
+      self.source, copy.deepcopy(self.activities[0]),
+      include_redirect_sources=False)
+    models.Response(
+      id='tag:fa.ke,2013:a1', source=self.source.key, type='comment',
+      status='complete',
+      response_json=json.dumps(util.prune_response(
+        copy.deepcopy(FakeGrSource.comment))),
+      activities_json=[json.dumps(util.prune_activity(
+        copy.deepcopy(self.activities[0])))],
+      sent=list(original_post_discovery.targets_for_response(
+        FakeGrSource.comment, originals=originals, mentions=mentions)),
+    ).put()
+
+    memcache.flush_all()
+    self.mox.StubOutWithMock(FakeGrSource, 'get_comment')
+    self.mox.ReplayAll()
+    stored = handlers.application.get_response(url, scheme='https')
+    self.assertEqual(200, stored.status_int, stored.body)
+    self.assertEqual(links(live.body), links(stored.body))
+    self.assertIn(('u-mention', 'http://other/link'), links(stored.body))
+    self.assertIn(('u-in-reply-to', 'http://or.ig/post'), links(stored.body))
+
+  def test_stale_stored_response_falls_back_to_silo(self):
+    self.store_response('a1', 'comment', {'content': 'stored'})
+    FakeGrSource.comment = {'content': 'live'}
+    util.now_fn = lambda: NOW + handlers.STORED_RESPONSE_MAX_AGE * 2
+
+    props = self.get_json('/comment/fake/%s/000/a1')
+    self.assertEqual('live', props['content'][0]['value'])
+
+  def test_validators(self):
+    url = '/post/fake/%s/000' % self.source.key.string_id()
+    resp = handlers.application.get_response(url)
+    self.assertEqual(200, resp.status_int, resp.body)
+    etag = resp.headers['ETag']
+    self.assertTrue(etag)
+    self.assertEqual('public, max-age=300', resp.headers['Cache-Control'])
+    last_modified = resp.headers['Last-Modified']
+    self.assertTrue(last_modified)
+
+    resp = handlers.application.get_response(
+      url, headers={'If-None-Match': etag})
+    self.assertEqual(304, resp.status_int)
+    self.assertEqual('', resp.body)
+    self.assertEqual(etag, resp.headers['ETag'])
+
+    resp = handlers.application.get_response(
+      url, headers={'If-None-Match': '"other"'})
+    self.assertEqual(200, resp.status_int)
+
+    resp = handlers.application.get_response(
+      url, headers={'If-Modified-Since': last_modified})
+    self.assertEqual(304, resp.status_int)
+
+    resp = handlers.application.get_response(
+      url, headers={'If-Modified-Since': 'Sat, 01 Jan 2000 00:00:00 GMT'})
+    self.assertEqual(200, resp.status_int)
+
+  def test_head(self):
+    resp = handlers.application.get_response(
+      '/post/fake/%s/000' % self.source.key.string_id(), method='HEAD')
+    self.assertEqual(200, resp.status_int)
+    self.assertTrue(resp.headers['ETag'])
+
+    resp = handlers.application.get_response('/post/fake/not_a_user/000',
+                                             method='HEAD')
+    self.assertEqual(400, resp.status_int)
+
+  def test_comment_and_post_fetched_in_parallel(self):
+    util.MAX_PARALLEL_REQUESTS = 2
+    FakeGrSource.comment = {'content': 'qwert'}
+    props = self.get_json('/comment/fake/%s/000/111')
+    self.assertEqual('qwert', props['content'][0]['value'])
+    self.assertEqual(['http://or.ig/post'],
+                     microformats2.get_string_urls(props['in-reply-to']))
+
+  def test_like_and_post_fetched_in_parallel(self):
+    util.MAX_PARALLEL_REQUESTS = 2
+    FakeGrSource.like = {
+      'objectType': 'activity',
+      'verb': 'like',
+      'id': 'tag:fa.ke,2013:111',
+      'object': {'url': 'http://example.com/original/post'},
+    }
+    props = self.get_json('/like/fake/%s/000/111')
+    self.assertEqual(['tag:fa.ke,2013:111'], props['uid'])
+    self.assertEqual(['http://example.com/original/post', 'http://or.ig/post'],
+                     microformats2.get_string_urls(props['like-of']))
+
+  def test_parallel_item_errors_pass_through(self):
+    util.MAX_PARALLEL_REQUESTS = 2
+    err = urllib2.HTTPError('url', 410, 'Gone', {},
+                            StringIO.StringIO('Gone baby gone'))
+    self.mox.StubOutWithMock(FakeGrSource, 'get_comment')
+    FakeGrSource.get_comment('111', activity_id='000',
+                             activity_author_id=self.source.key.id()
+                             ).AndRaise(err)
+    self.mox.ReplayAll()
+
+    resp = handlers.application.get_response(
+      '/comment/fake/%s/000/111' % self.source.key.string_id())
+    self.assertEqual(410, resp.status_int)
+    self.assertEqual('FakeSource error:\nGone baby gone', resp.body)
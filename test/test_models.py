@@ -8,6 +8,8 @@ import datetime
 import json
 
 
+from google.appengine.api import datastore_errors
+from google.appengine.ext import ndb
 from granary import source as gr_source
 import mox
 
@@ -17,12 +19,13 @@ import flickr
 import googleplus
 import instagram
 import models
-from models import BlogPost, Response, Source, SyndicatedPost
+from models import BlogPost, Response, Source, SyndicatedPost, SyndicatedPostFilter
 import superfeedr
 import testutil
 from testutil import FakeGrSource
 import tumblr
 import twitter
+import util
 import wordpress_rest
 from testutil import FakeSource
 
@@ -58,6 +61,61 @@ class ResponseTest(testutil.ModelsTest):
     self.assert_entities_equal(saved, same)
     self.assert_no_propagate_task()
 
+  def test_get_or_save_adds_activity_urls(self):
+    """New activity URLs should be added to an existing response."""
+    response = self.responses[0]
+    response.put()
+
+    response.activity_urls = ['https://source/post/url', 'https://other']
+    saved = response.get_or_save(self.sources[0])
+    self.assertEqual(['https://source/post/url', 'https://other'],
+                     saved.activity_urls)
+    self.assertEqual(saved.activity_urls, response.key.get().activity_urls)
+    self.assert_no_propagate_task()
+
+  def test_set_render_fields(self):
+    response = Response(type='like')
+    response.set_render_fields({
+      'verb': 'like',
+      'author': {'displayName': 'Alice', 'url': 'http://alice',
+                 'image': {'url': 'http://alice/pic'}},
+    }, [{'url': 'http://source/post', 'object': {'content': 'my post'}}])
+
+    self.assertTrue(response.public)
+    self.assertEqual('Alice', response.actor_name)
+    self.assertEqual('http://alice', response.actor_url)
+    self.assertEqual('http://alice/pic', response.actor_image)
+    self.assertEqual('Alice liked this.', response.response_content)
+    self.assertEqual(['http://source/post'], response.activity_link_urls)
+    self.assertEqual(['my post'], response.activity_contents)
+
+    response.set_render_fields({'content': 'foo'}, [
+      {'to': [{'objectType': 'group', 'alias': '@private'}]}])
+    self.assertFalse(response.public)
+    self.assertEqual('foo', response.response_content)
+
+  def test_get_or_save_backfills_render_fields(self):
+    response = self.responses[0]
+    response.put()
+    self.assertIsNone(response.key.get().public)
+
+    response.set_render_fields(json.loads(response.response_json),
+                               [json.loads(a) for a in response.activities_json])
+    response.get_or_save(self.sources[0])
+    stored = response.key.get()
+    self.assertTrue(stored.public)
+    self.assertEqual(response.actor_name, stored.actor_name)
+    self.assert_no_propagate_task()
+
+  def test_canonical_activity_urls(self):
+    self.assertEqual(['https://source/post/url', 'https://obj/url'],
+                     Response.canonical_activity_urls(self.sources[0], [
+                       {'url': 'http://source/post/url'},
+                       {'object': {'url': 'http://www.obj/url'}},
+                       {'url': 'https://source/post/url'},
+                       {'object': {}},
+                     ]))
+
   def test_get_or_save_activity_changed(self):
     """If the response activity has changed, we should update and resend."""
     # original response
@@ -160,6 +218,54 @@ class ResponseTest(testutil.ModelsTest):
     self.assertEqual(['{"foo": "bar"}'], got.activities_json)
     self.assertIsNone(got.activity_json)
 
+  def test_load_activities_json(self):
+    keys = models.Activity.store_multi(['{"a": 1}', '{"b": 2}'])
+    self.responses[0].activity_keys = keys
+    self.responses[1].activity_keys = keys[1:]
+    self.responses[1].activities_json = []
+
+    self.assertEqual(['{"b": 2}'], self.responses[1].load_activities_json())
+    self.assertEqual([self.responses[0].activities_json + ['{"a": 1}', '{"b": 2}'],
+                      ['{"b": 2}']],
+                     Response.load_activities_json_multi(self.responses[:2]))
+
+
+class ActivityTest(testutil.ModelsTest):
+
+  def test_store_multi_dedupes(self):
+    keys = models.Activity.store_multi(['{"a": 1}', '{"b": 2}', '{"a": 1}'])
+    self.assertEqual(3, len(keys))
+    self.assertEqual(keys[0], keys[2])
+    self.assertNotEqual(keys[0], keys[1])
+    self.assertEqual(2, models.Activity.query().count())
+    self.assertEqual('{"a": 1}', keys[0].get().activity_json)
+
+    # storing again shouldn't rewrite existing activities
+    created = keys[0].get().created
+    self.assertEqual(keys[:1], models.Activity.store_multi(['{"a": 1}']))
+    self.assertEqual(created, keys[0].get().created)
+    self.assertEqual(2, models.Activity.query().count())
+
+  def test_store_multi_refreshes_last_used(self):
+    key = models.Activity.store_multi(['{"a": 1}'])[0]
+    self.assertEqual(testutil.NOW, key.get().last_used)
+
+    later = testutil.NOW + models.Activity.LAST_USED_RESOLUTION * 2
+    util.now_fn = lambda: later
+    models.Activity.store_multi(['{"a": 1}'])
+    self.assertEqual(later, key.get().last_used)
+
+  def test_delete_unused_multi(self):
+    old, new = models.Activity.store_multi(['{"a": 1}', '{"b": 2}'])
+    util.now_fn = lambda: testutil.NOW + datetime.timedelta(days=2)
+    models.Activity.store_multi(['{"b": 2}'])
+
+    cutoff = testutil.NOW + datetime.timedelta(days=1)
+    self.assertEqual([old], models.Activity.delete_unused_multi([old, new],
+                                                                cutoff))
+    self.assertIsNone(old.get())
+    self.assertIsNotNone(new.get())
+
 
 class SourceTest(testutil.HandlerTest):
 
@@ -173,6 +279,145 @@ class SourceTest(testutil.HandlerTest):
     self.assertEquals(twitter.Twitter, models.sources['twitter'])
     self.assertEquals(wordpress_rest.WordPress, models.sources['wordpress'])
 
+  def test_get_cached(self):
+    source = FakeSource.new(None, name='before')
+    source.put()
+    self.assertEqual('before', Source.get_cached(source.key).name)
+
+    # change it without invalidating. should still read from the cache.
+    post_put = Source._post_put_hook
+    Source._post_put_hook = lambda self, future: None
+    try:
+      source.name = 'stale'
+      source.put()
+    finally:
+      Source._post_put_hook = post_put
+    self.assertEqual('before', Source.get_cached(source.key).name)
+
+    # puts should invalidate
+    source.name = 'after'
+    source.put()
+    self.assertEqual('after', Source.get_cached(source.key).name)
+
+    source.key.delete()
+    self.assertIsNone(Source.get_cached(source.key))
+
+  def test_get_cached_multi(self):
+    a = FakeSource.new(None, name='a')
+    a.put()
+    b = FakeSource.new(None, name='b')
+    b.put()
+    missing = ndb.Key(FakeSource, 'missing')
+
+    keys = [a.key, missing, b.key]
+    names = lambda: [s.name if s else None for s in Source.get_cached_multi(keys)]
+    self.assertEqual(['a', None, 'b'], names())
+
+    # now only the missing one should hit the datastore
+    self.mox.StubOutWithMock(ndb, 'get_multi')
+    ndb.get_multi([missing]).AndReturn([None])
+    self.mox.ReplayAll()
+    self.assertEqual(['a', None, 'b'], names())
+
+  def test_domain_index(self):
+    source = FakeSource.new(None, domains=['foo.com', 'Bar.com'],
+                            features=['listen'])
+    source.put()
+    other = FakeSource.new(None, domains=['foo.com'], features=['publish'])
+    other.put()
+
+    self.assertEqual([source.key, other.key],
+                     [e.source for e in models.DomainIndex.lookup('foo.com')])
+    self.assertEqual([source.key], [e.source for e in models.DomainIndex.lookup(
+      'foo.com', feature='listen')])
+    self.assertEqual([source.key], [e.source for e in models.DomainIndex.lookup(
+      'bar.com', silo='fake', status='enabled')])
+    self.assertEqual([], models.DomainIndex.lookup('bar.com', silo='twitter'))
+
+    # removing a domain should remove it from the index
+    source.domains = ['foo.com']
+    source.put()
+    self.assertEqual([], models.DomainIndex.lookup('bar.com'))
+    self.assertIsNone(models.DomainIndex.get_by_id('bar.com'))
+
+    other.key.delete()
+    self.assertEqual([source.key], [e.source for e in
+                                    models.DomainIndex.lookup_multi(
+                                      ['foo.com', 'bar.com'])])
+
+  def test_put_index_errors_dont_fail_put(self):
+    self.mox.StubOutWithMock(models.DomainIndex, 'update_source')
+    models.DomainIndex.update_source(mox.IgnoreArg()).AndRaise(
+      datastore_errors.TransactionFailedError('contended'))
+    self.mox.ReplayAll()
+
+    source = FakeSource.new(None, name='Alice', features=['listen'])
+    source.put()
+    self.assertIsNotNone(source.key.get())
+    # the other updates still happen
+    self.assertIsNotNone(models.DirectoryEntry.get_by_id(source.key.urlsafe()))
+
+  def test_domain_index_query_fallback(self):
+    source = FakeSource.new(None, domains=['foo.com'], features=['listen'])
+    source.put()
+    # as if it was stored before DomainIndex existed
+    models.DomainIndex.get_by_id('foo.com').key.delete()
+    models.DomainIndex._cache.clear()
+
+    self.assertEqual([source.key], [e.source for e in models.DomainIndex.lookup(
+      'foo.com', silo='fake', feature='listen')])
+
+    models.DomainIndex._cache.clear()
+    self.mox.stubs.Set(models.DomainIndex, 'QUERY_FALLBACK', False)
+    self.assertEqual([], models.DomainIndex.lookup('foo.com'))
+
+  def test_domain_index_cache_bounded(self):
+    self.mox.stubs.Set(models.DomainIndex, 'CACHE_SIZE', 2)
+    models.DomainIndex.lookup_multi(['a.com', 'b.com', 'c.com'])
+    self.assertEqual(['b.com', 'c.com'], models.DomainIndex._cache.keys())
+
+    # a hit moves the domain to the end
+    models.DomainIndex.lookup('b.com')
+    self.assertEqual(['c.com', 'b.com'], models.DomainIndex._cache.keys())
+
+    # expired entries get refetched
+    source = FakeSource.new(None, domains=['b.com'])
+    models.DomainIndex(id='b.com', entries=[models.DomainIndexEntry(
+      source=source.key)]).put()
+    self.assertEqual([], models.DomainIndex.lookup('b.com'))
+    self.mox.stubs.Set(util, 'now_fn', lambda: datetime.datetime.utcnow() +
+                       models.DomainIndex.CACHE_TTL * 2)
+    self.assertEqual([source.key],
+                     [e.source for e in models.DomainIndex.lookup('b.com')])
+
+  def test_directory_entry(self):
+    source = FakeSource.new(None, name='Alice', features=['listen'],
+                            picture='http://pic')
+    source.put()
+    entry = models.DirectoryEntry.get_by_id(source.key.urlsafe())
+    self.assertEqual('alice', entry.sort_name)
+    self.assertEqual('fake', entry.silo)
+    self.assertEqual(source.bridgy_path(), entry.bridgy_path)
+    self.assertEqual(['listen'], entry.features)
+
+    util.CachedPage.store('/users', 'x')
+    source.name = 'Bob'
+    source.put()
+    self.assertEqual('bob', models.DirectoryEntry.get_by_id(
+      source.key.urlsafe()).sort_name)
+    self.assertIsNone(util.CachedPage.load('/users'))
+
+    # sources without features aren't listed
+    source.features = []
+    source.put()
+    self.assertIsNone(models.DirectoryEntry.get_by_id(source.key.urlsafe()))
+
+    source.features = ['listen']
+    source.put()
+    self.assertIsNotNone(models.DirectoryEntry.get_by_id(source.key.urlsafe()))
+    source.key.delete()
+    self.assertIsNone(models.DirectoryEntry.get_by_id(source.key.urlsafe()))
+
   def _test_create_new(self, **kwargs):
     FakeSource.create_new(self.handler, domains=['foo'],
                           domain_urls=['http://foo.com'],
@@ -577,3 +822,136 @@ class SyndicatedPostTest(testutil.ModelsTest):
     ).fetch()
 
     self.assertEqual(1, len(rs))
+
+  def test_insert_multi(self):
+    existing = self.relationships[0]
+    results = SyndicatedPost.insert_multi(self.source, [
+      # exact duplicate
+      ('http://silo/post/url', 'http://original/post/url'),
+      # replaces the blank for http://silo/no-original
+      ('http://silo/no-original', 'http://original/new'),
+      # skipped: the relationship above is in the same batch
+      (None, 'http://original/new'),
+      # new blanks, including a duplicate
+      ('http://silo/new-blank', None),
+      ('http://silo/new-blank', None),
+      # skipped: a non-blank already exists
+      ('http://silo/post/url', None),
+    ], deletes=[self.relationships[-1].key])
+
+    self.assertEqual(existing.key, results[('http://silo/post/url',
+                                            'http://original/post/url')].key)
+    self.assertEqual(2, len(results))
+
+    self.assertItemsEqual([
+      ('http://silo/post/url', 'http://original/post/url'),
+      ('http://silo/post/url', 'http://original/another/post'),
+      ('http://silo/another/url', 'http://original/post/url'),
+      ('http://silo/no-original', 'http://original/new'),
+      ('http://silo/new-blank', None),
+    ], [(r.syndication, r.original) for r in
+        SyndicatedPost.query(ancestor=self.source.key)])
+
+
+class SyndicatedPostFilterTest(testutil.ModelsTest):
+
+  def setUp(self):
+    super(SyndicatedPostFilterTest, self).setUp()
+    self.source = FakeSource.new(None)
+    self.source.put()
+    SyndicatedPost(parent=self.source.key, original='http://original/a',
+                   syndication='http://silo/a').put()
+
+  def test_builds_from_existing(self):
+    filter = SyndicatedPostFilter.load(self.source)
+    self.assertTrue(filter.might_contain(syndication='http://silo/a'))
+    self.assertTrue(filter.might_contain(original='http://original/a'))
+    self.assertFalse(filter.might_contain(syndication='http://original/a'))
+    self.assertFalse(filter.might_contain(original='http://original/b'))
+
+    stored = SyndicatedPostFilter.key_for(self.source.key).get()
+    self.assertFalse(stored.building)
+    self.assertEqual(filter.bits, stored.bits)
+
+  def test_load_memoized_on_source(self):
+    filter = SyndicatedPostFilter.load(self.source)
+    self.assertIs(filter, SyndicatedPostFilter.load(self.source))
+
+  def test_updated_on_insert(self):
+    SyndicatedPostFilter.load(self.source)
+    SyndicatedPost.insert(self.source, 'http://silo/b', 'http://original/b')
+    SyndicatedPost.insert_syndication_blank(self.source, 'http://silo/c')
+
+    # both the memoized copy and the stored filter
+    for filter in (SyndicatedPostFilter.load(self.source),
+                   SyndicatedPostFilter.key_for(self.source.key).get()):
+      self.assertTrue(filter.might_contain(syndication='http://silo/b'))
+      self.assertTrue(filter.might_contain(original='http://original/b'))
+      self.assertTrue(filter.might_contain(syndication='http://silo/c'))
+
+  def test_insert_multi_adds_every_url(self):
+    SyndicatedPostFilter.load(self.source)
+    relationships = [('http://silo/%d' % i, 'http://original/%d' % i)
+                     for i in range(5)]
+    relationships += [('http://silo/blank', None), (None, 'http://original/blank')]
+    SyndicatedPost.insert_multi(self.source, relationships)
+
+    filter = SyndicatedPostFilter.key_for(self.source.key).get()
+    for syndication, original in relationships:
+      if syndication:
+        self.assertTrue(filter.might_contain(syndication=syndication))
+      if original:
+        self.assertTrue(filter.might_contain(original=original))
+    self.assertFalse(filter.might_contain(syndication='http://silo/other'))
+
+  def test_building_filter_might_contain_everything(self):
+    SyndicatedPostFilter(key=SyndicatedPostFilter.key_for(self.source.key),
+                         bits=str(bytearray(SyndicatedPostFilter.NUM_BITS / 8)),
+                         building=True).put()
+    filter = SyndicatedPostFilter.load(self.source)
+    self.assertTrue(filter.building)
+    self.assertTrue(filter.might_contain(syndication='http://silo/other'))
+
+    # a build that died long ago gets taken over
+    self.mox.stubs.Set(util, 'now_fn', lambda: datetime.datetime.utcnow() +
+                       SyndicatedPostFilter.BUILD_TIMEOUT * 2)
+    del self.source._syndpost_filter
+    filter = SyndicatedPostFilter.load(self.source)
+    self.assertFalse(filter.building)
+    self.assertTrue(filter.might_contain(syndication='http://silo/a'))
+    self.assertFalse(filter.might_contain(syndication='http://silo/other'))
+
+  def test_hit_rates(self):
+    SyndicatedPostFilter.record_hits(positive=2, negative=3)
+    SyndicatedPostFilter.record_hits(false_positive=1, negative=1)
+    self.assertEqual({'positive': 2, 'negative': 4, 'false positive': 1},
+                     SyndicatedPostFilter.hit_rates())
+
+
+class CounterTest(testutil.ModelsTest):
+
+  def test_increment_and_get_counts(self):
+    models.Counter.set_base('users', 10)
+    for _ in range(5):
+      models.Counter.increment('users')
+    models.Counter.increment('links', 3)
+
+    counts = models.Counter.get_counts()
+    self.assertEqual(15, counts['users'])
+    self.assertEqual(3, counts['links'])
+    self.assertEqual(0, counts['publishes'])
+
+  def test_reset(self):
+    models.Counter.set_base('users', 10)
+    for _ in range(5):
+      models.Counter.increment('users')
+    models.Counter.reset('users', 3)
+    self.assertEqual({'users': 3}, models.Counter.get_counts(('users',)))
+
+  def test_new_response_increments(self):
+    self.responses[0].get_or_save(self.sources[0])
+    # existing response shouldn't count again
+    self.responses[0].get_or_save(self.sources[0])
+
+    counts = models.Counter.get_counts(('responses', 'links'))
+    self.assertEqual({'responses': 1, 'links': 1}, counts)
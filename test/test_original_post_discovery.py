@@ -1,15 +1,20 @@
 # coding=utf-8
 """Unit tests for original_post_discovery.py
 """
+import datetime
 import json
 
 from oauth_dropins import facebook as oauth_facebook
+import requests
 from requests.exceptions import HTTPError
 
 from facebook import FacebookPage
-from models import SyndicatedPost
+from models import DomainCapability, SyndicatedPost
+import original_post_discovery
 from original_post_discovery import discover, refetch
 import testutil
+from twitter import Twitter
+import util
 
 
 class OriginalPostDiscoveryTest(testutil.ModelsTest):
@@ -64,6 +69,60 @@ class OriginalPostDiscoveryTest(testutil.ModelsTest):
                                   'https://fa.ke/post/url'))
     self.assertEquals(testutil.NOW, self.source.updates['last_syndication_url'])
 
+  def test_share_relationships_with_other_sources(self):
+    """Syndication links to other silos are stored for the author's sources
+    there, if they have any.
+    """
+    tw = Twitter(id='tw', domains=['author'], features=['listen'])
+    tw.put()
+    # not listening
+    Twitter(id='tw2', domains=['author'], features=['publish']).put()
+    # different author
+    Twitter(id='tw3', domains=['other'], features=['listen']).put()
+
+    self.expect_requests_get('http://author', """
+    <html class="h-feed">
+      <div class="h-entry">
+        <a class="u-url" href="http://author/post/permalink"></a>
+        <a class="u-syndication" href="https://fa.ke/post/url"></a>
+        <a class="u-syndication" href="http://www.twitter.com/tw/status/123"></a>
+        <a class="u-syndication" href="http://not.real/statuses/postid"></a>
+      </div>
+    </html>""")
+
+    self.mox.ReplayAll()
+    self.assert_discover(['http://author/post/permalink'])
+    self.assert_syndicated_posts(('http://author/post/permalink',
+                                  'https://fa.ke/post/url'))
+
+    self.assertEquals(
+      [('http://author/post/permalink', 'https://twitter.com/tw/status/123')],
+      [(r.original, r.syndication) for r in
+       SyndicatedPost.query(ancestor=tw.key)])
+    for id in 'tw2', 'tw3':
+      self.assertIsNone(SyndicatedPost.query(
+        ancestor=Twitter(id=id).key).get())
+
+  def test_share_relationships_skips_ones_sibling_has(self):
+    """We shouldn't overwrite or duplicate the sibling's own relationships,
+    including blanks."""
+    tw = Twitter(id='tw', domains=['author'], features=['listen'])
+    tw.put()
+    SyndicatedPost.insert_original_blank(tw, 'http://author/a')
+    SyndicatedPost.insert(tw, 'https://twitter.com/tw/status/2', 'http://author/b')
+
+    original_post_discovery._share_relationships(self.source, [
+      ('https://twitter.com/tw/status/1', 'http://author/a'),
+      ('https://twitter.com/tw/status/2', 'http://author/b'),
+      ('https://twitter.com/tw/status/3', 'http://author/c'),
+    ])
+    self.assertItemsEqual([
+      ('http://author/a', None),
+      ('http://author/b', 'https://twitter.com/tw/status/2'),
+      ('http://author/c', 'https://twitter.com/tw/status/3'),
+    ], [(r.original, r.syndication) for r in
+        SyndicatedPost.query(ancestor=tw.key)])
+
   def test_syndication_url_in_hfeed(self):
     """Like test_single_post, but because the syndication URL is given in
     the h-feed we skip fetching the permalink. New behavior as of
@@ -357,6 +416,34 @@ class OriginalPostDiscoveryTest(testutil.ModelsTest):
     """
     self._test_failed_domain_url_fetch(raise_exception=True)
 
+  def test_domain_url_backed_off(self):
+    """We shouldn't refetch an author URL that just failed."""
+    self.expect_requests_get('http://author', status_code=500)
+    self.mox.ReplayAll()
+
+    discover(self.source, self.activity)
+    self.activity['object']['url'] = 'https://fa.ke/post/other'
+    discover(self.source, self.activity)
+    self.assert_syndicated_posts((None, 'https://fa.ke/post/url'),
+                                 (None, 'https://fa.ke/post/other'))
+
+  def test_permalink_backed_off(self):
+    """We shouldn't fetch a backed off permalink or store a blank for it, so
+    that we try it again once the backoff expires."""
+    util.FetchFailure(id='url http://author/post/permalink', failures=1,
+                      retry_after=testutil.NOW + datetime.timedelta(hours=1)
+                      ).put()
+    self.expect_requests_get('http://author', """
+    <html class="h-feed">
+      <div class="h-entry">
+        <a class="u-url" href="http://author/post/permalink"></a>
+      </div>
+    </html>""")
+    self.mox.ReplayAll()
+
+    self.assert_discover([])
+    self.assert_syndicated_posts((None, 'https://fa.ke/post/url'))
+
   def _expect_multiple_domain_url_fetches(self):
     self.source.domain_urls = ['http://author1', 'http://author2', 'http://author3']
     self.activity['object']['url'] = 'http://fa.ke/A'
@@ -401,6 +488,142 @@ class OriginalPostDiscoveryTest(testutil.ModelsTest):
     self.mox.ReplayAll()
     self.assert_discover([])
 
+  def test_permalink_budget(self):
+    """We should crawl the newest permalinks first and defer the rest."""
+    self.mox.stubs.Set(original_post_discovery, 'MAX_PERMALINKS', 1)
+    self.expect_requests_get('http://author', """
+    <html class="h-feed">
+      <div class="h-entry">
+        <a class="u-url" href="http://author/old"></a>
+        <time class="dt-published" datetime="2015-01-01T00:00:00Z"></time>
+        <a class="u-syndication" href="https://fa.ke/old"></a>
+      </div>
+      <div class="h-entry">
+        <a class="u-url" href="http://author/new"></a>
+        <time class="dt-published" datetime="2015-06-01T00:00:00Z"></time>
+      </div>
+    </html>""")
+    self.expect_requests_get('http://author/new', """
+    <div class="h-entry">
+      <a class="u-url" href="http://author/new"></a>
+      <a class="u-syndication" href="https://fa.ke/post/url"></a>
+    </div>""")
+
+    self.mox.ReplayAll()
+    self.assert_discover(['http://author/new'])
+    self.assert_syndicated_posts(('http://author/new', 'https://fa.ke/post/url'))
+
+    tasks = self.taskqueue_stub.GetTasks('crawl-permalinks')
+    self.assertEqual(1, len(tasks))
+    params = testutil.get_task_params(tasks[0])
+    self.assertEqual(self.source.key.urlsafe(), params['source_key'])
+    self.assertEqual([['http://author/old', ['https://fa.ke/old']]],
+                     json.loads(params['entries']))
+    self.assertEqual('', params['refetch'])
+
+  def test_crawl_permalinks_task_deduped_and_capped(self):
+    self.mox.stubs.Set(util, 'CRAWL_TASK_MAX_ENTRIES', 2)
+    entries = [('http://author/%d' % i, {'properties': {}}) for i in range(3)]
+
+    util.add_crawl_permalinks_task(self.source, entries)
+    util.add_crawl_permalinks_task(self.source, entries)
+    tasks = self.taskqueue_stub.GetTasks('crawl-permalinks')
+    self.assertEqual(1, len(tasks))
+    self.assertEqual([['http://author/0', []], ['http://author/1', []]],
+                     json.loads(testutil.get_task_params(tasks[0])['entries']))
+
+    self.mox.stubs.Set(util, 'CRAWL_TASK_MAX_BYTES', 30)
+    util.add_crawl_permalinks_task(self.source, entries)
+    self.assertItemsEqual(
+      [[['http://author/0', []], ['http://author/1', []]],
+       [['http://author/0', []]]],
+      [json.loads(testutil.get_task_params(task)['entries'])
+       for task in self.taskqueue_stub.GetTasks('crawl-permalinks')])
+
+  def test_throttle_domain_without_syndication_markup(self):
+    """We should only crawl one permalink on a domain that hasn't had
+    syndication links lately."""
+    DomainCapability(id='author', last_probe=testutil.NOW,
+                     syndication=[False] * DomainCapability.HISTORY).put()
+
+    self.expect_requests_get('http://author', """
+    <html class="h-feed">
+      <div class="h-entry"><a class="u-url" href="http://author/a"></a></div>
+      <div class="h-entry"><a class="u-url" href="http://author/b"></a></div>
+      <div class="h-entry"><a class="u-url" href="http://author/c"></a></div>
+    </html>""")
+    self.expect_requests_get('http://author/a', 'no markup here')
+
+    self.mox.ReplayAll()
+    self.assert_discover([])
+    self.assertEqual([], self.taskqueue_stub.GetTasks('crawl-permalinks'))
+
+    cap = DomainCapability.get_by_id('author')
+    self.assertEqual([False] * DomainCapability.HISTORY, cap.syndication)
+    self.assertEqual(testutil.NOW, cap.last_probe)
+    self.assertTrue(cap.is_throttled())
+
+  def test_record_domain_syndication_markup(self):
+    """A crawl that finds syndication links should unthrottle the domain."""
+    DomainCapability(id='author', last_probe=testutil.NOW,
+                     syndication=[False] * DomainCapability.HISTORY).put()
+
+    self.expect_requests_get('http://author', """
+    <html class="h-feed">
+      <div class="h-entry">
+        <a class="u-url" href="http://author/a"></a>
+        <a class="u-syndication" href="https://fa.ke/post/url"></a>
+      </div>
+    </html>""")
+
+    self.mox.ReplayAll()
+    self.assert_discover(['http://author/a'])
+    cap = DomainCapability.get_by_id('author')
+    self.assertEqual([True] + [False] * (DomainCapability.HISTORY - 1),
+                     cap.syndication)
+    self.assertFalse(cap.is_throttled())
+
+  def test_crawl_flushes_relationships_in_chunks(self):
+    """Relationships found before a crawl dies should already be stored."""
+    self.mox.stubs.Set(original_post_discovery, 'FLUSH_PERMALINKS', 1)
+    self.expect_requests_get('http://author/b').AndRaise(AssertionError('dead'))
+    self.mox.ReplayAll()
+
+    entries = [
+      ('http://author/a', {'properties': {'syndication': ['https://fa.ke/a']}}),
+      ('http://author/b', {'properties': {}}),
+    ]
+    with self.assertRaises(AssertionError):
+      original_post_discovery.crawl_permalinks(self.source, entries)
+    self.assert_syndicated_posts(('http://author/a', 'https://fa.ke/a'))
+
+  def test_crawl_skips_domain_that_goes_down(self):
+    """Once a domain is backed off mid-crawl, we shouldn't fetch the rest of
+    its permalinks."""
+    entries = [('http://author/%d' % i, {'properties': {}})
+               for i in range(util.DOMAIN_FAILURE_THRESHOLD + 2)]
+    for permalink, _ in entries[:util.DOMAIN_FAILURE_THRESHOLD]:
+      self.expect_requests_get(permalink).AndRaise(
+        requests.ConnectionError('down'))
+    self.mox.ReplayAll()
+
+    original_post_discovery.crawl_permalinks(self.source, entries)
+    self.assertFalse(util.FetchFailure.should_fetch('http://author/x'))
+
+  def test_crawl_deadline(self):
+    """We should stop crawling permalinks when we're near the deadline."""
+    self.source.crawl_deadline = testutil.NOW
+    self.expect_requests_get('http://author', """
+    <html class="h-feed">
+      <div class="h-entry">
+        <a class="u-url" href="http://author/post/permalink"></a>
+      </div>
+    </html>""")
+
+    self.mox.ReplayAll()
+    self.assert_discover([])
+    self.assertEqual(1, len(self.taskqueue_stub.GetTasks('crawl-permalinks')))
+
   def test_rel_feed_link_error(self):
     """Author page has an h-feed link that raises an exception. We should
     recover and use the main page's h-entries as a fallback."""
@@ -92,6 +92,16 @@ class PollTest(TaskQueueTest):
 
     # sort fields in json properties since they're compared as strings
     stored = list(Response.query())
+    for resp in stored:
+      resp.activities_json = resp.load_activities_json()
+      resp.activity_keys = []
+
+    if 'activities_json' in ignore or 'response_json' in ignore:
+      ignore += Response.RENDER_FIELDS
+    else:
+      for resp in expected:
+        resp.set_render_fields(json.loads(resp.response_json),
+                               [json.loads(a) for a in resp.activities_json])
     for resp in expected + stored:
       if 'activities_json' not in ignore:
         resp.activities_json = [json.dumps(json.loads(a), sort_keys=True)
@@ -115,6 +125,15 @@ class PollTest(TaskQueueTest):
     self.assertAlmostEqual(datetime.datetime.utcnow() + countdown,
                            testutil.get_task_eta(task), delta=delta)
 
+  def refetch_hfeed(self):
+    """Runs and flushes any refetch-hfeed tasks that the poll added."""
+    for task in self.taskqueue_stub.GetTasks('refetch-hfeed'):
+      resp = tasks.application.get_response(
+        '/_ah/queue/refetch-hfeed', method='POST',
+        body=urllib.urlencode(testutil.get_task_params(task)))
+      self.assertEqual(200, resp.status_int)
+    self.taskqueue_stub.FlushQueue('refetch-hfeed')
+
   def expect_get_activities(self, **kwargs):
     """Adds and returns an expected get_activities_response() call."""
     self.mox.StubOutWithMock(FakeSource, 'get_activities_response')
@@ -286,13 +305,16 @@ class PollTest(TaskQueueTest):
                        self.responses[0].key.get().unsent)
 
   def test_non_html_file_extension(self):
-    """If our HEAD request fails, we should infer type from file extension."""
+    """If our HEAD and GET requests fail, we should infer type from file
+    extension."""
     self.activities[0]['object'].update({'tags': [], 'content': 'http://x/a.zip'})
     FakeGrSource.activities = [self.activities[0]]
 
     self.expect_requests_head('http://x/a.zip', status_code=405,
                               # we should ignore an error response's content type
                               content_type='text/html')
+    self.expect_requests_get('http://x/a.zip', status_code=405,
+                             content_type='text/html', allow_redirects=True)
 
     self.mox.ReplayAll()
     self.post_task()
@@ -385,7 +407,8 @@ class PollTest(TaskQueueTest):
     ids = set()
     for task in self.taskqueue_stub.GetTasks('propagate'):
       resp_key = ndb.Key(urlsafe=testutil.get_task_params(task)['response_key'])
-      ids.update(json.loads(a)['id'] for a in resp_key.get().activities_json)
+      ids.update(json.loads(a)['id']
+                 for a in resp_key.get().load_activities_json())
     self.assert_equals(ids, set([self.activities[0]['id'], self.activities[2]['id']]))
 
   def test_no_responses(self):
@@ -456,7 +479,7 @@ class PollTest(TaskQueueTest):
     self.assertEquals(1, Response.query().count())
     resp = Response.query().get()
     self.assert_equals(['tag:source.com,2013:%s' % id for id in 'a', 'b', 'c'],
-                       [json.loads(a)['id'] for a in resp.activities_json])
+                       [json.loads(a)['id'] for a in resp.load_activities_json()])
 
     urls = ['http://from/tag', 'http://from/synd/post', 'http://target1/post/url']
     self.assert_equals(urls, resp.unsent)
@@ -542,6 +565,7 @@ class PollTest(TaskQueueTest):
         'id': 'tag:source.com,2013:a',
         'object': {'content': 'foo http://target1/post/url bar'},
       })]
+      resp.activity_urls = []
     expected += self.responses[:3]
 
     self.assert_responses(expected, ignore=('activities_json', 'response_json',
@@ -880,8 +904,10 @@ class PollTest(TaskQueueTest):
 
     self.post_task()
 
-    self.assert_equals({'prefix b': 0},
-                       json.loads(source.key.get().last_activities_cache_json))
+    self.assert_equals({'prefix b': 0}, json.loads(
+      source.key.get().load_state().last_activities_cache_json))
+    # should have migrated it off the source entity
+    self.assertIsNone(source.key.get().last_activities_cache_json)
 
   def test_slow_poll_never_sent_webmention(self):
     self.sources[0].created = NOW - (FakeSource.FAST_POLL_GRACE_PERIOD +
@@ -976,6 +1002,7 @@ class PollTest(TaskQueueTest):
 
     self.mox.ReplayAll()
     self.post_task()
+    self.assertEquals(0, len(self.taskqueue_stub.GetTasks('refetch-hfeed')))
     self.assertEquals(hour_ago, self.sources[0].key.get().last_hfeed_fetch)
 
     # should still be a blank SyndicatedPost
@@ -1001,6 +1028,7 @@ class PollTest(TaskQueueTest):
       id='tag:or.ig,2013:9',
       response_json='{}',
       activities_json=['{"url": "http://source/post/url"}'],
+      activity_urls=['https://source/post/url'],
       source=self.sources[0].key,
       status='complete',
       original_posts=['http://author/permalink'],
@@ -1011,11 +1039,39 @@ class PollTest(TaskQueueTest):
     self._expect_fetch_hfeed()
     self.mox.ReplayAll()
     self.post_task()
+    self.refetch_hfeed()
 
     # shouldn't repropagate it
     self.assertEquals(0, len(self.taskqueue_stub.GetTasks('propagate')))
     self.assertEquals('complete', resp.key.get().status)
 
+  def test_repropagate_response_matching_multiple_batches(self):
+    """A response that matches URLs in two query batches should only be
+    repropagated once."""
+    self.mox.stubs.Set(tasks, 'MAX_ALLOWABLE_QUERIES', 1)
+    resp = Response(
+      id='tag:or.ig,2013:9',
+      response_json='{}',
+      activity_urls=['https://fa.ke/1', 'https://fa.ke/2'],
+      source=self.sources[0].key,
+      status='complete',
+    )
+    resp.put()
+    num_tasks = len(self.taskqueue_stub.GetTasks('propagate'))
+
+    tasks.repropagate_old_responses(self.sources[0], {
+      'https://fa.ke/1': [SyndicatedPost(syndication='https://fa.ke/1',
+                                         original='http://author/1')],
+      'https://fa.ke/2': [SyndicatedPost(syndication='https://fa.ke/2',
+                                         original='http://author/2')],
+    })
+
+    resp = resp.key.get()
+    self.assertEquals('new', resp.status)
+    self.assertItemsEqual(['http://author/1', 'http://author/2'], resp.unsent)
+    self.assertEquals(num_tasks + 1,
+                      len(self.taskqueue_stub.GetTasks('propagate')))
+
   def test_do_refetch_hfeed(self):
     """Emulate a situation where we've done posse-post-discovery earlier and
     found no rel=syndication relationships for a particular silo URL. Every
@@ -1027,6 +1083,13 @@ class PollTest(TaskQueueTest):
     self.mox.ReplayAll()
     self.post_task()
 
+    # the poll should only enqueue the refetch, not do it
+    self.assertEquals(1, len(self.taskqueue_stub.GetTasks('refetch-hfeed')))
+    self.assertEquals(0, SyndicatedPost.query(
+      SyndicatedPost.syndication == 'https://source/post/url',
+      SyndicatedPost.original == 'http://author/permalink').count())
+    self.refetch_hfeed()
+
     # should have a new SyndicatedPost
     relationships = SyndicatedPost.query(
       SyndicatedPost.original == 'http://author/permalink',
@@ -1061,6 +1124,46 @@ class PollTest(TaskQueueTest):
     self._expect_fetch_hfeed()
     self.mox.ReplayAll()
     self.post_task()
+    self.refetch_hfeed()
+
+  def test_refetch_hfeed_task_deduped(self):
+    """Polls that run before a refetch finishes shouldn't add another one."""
+    self._setup_refetch_hfeed()
+    util.add_refetch_hfeed_task(self.sources[0])
+    util.add_refetch_hfeed_task(self.sources[0])
+
+    queued = self.taskqueue_stub.GetTasks('refetch-hfeed')
+    self.assertEquals(1, len(queued))
+    self.assertEquals({'source_key': self.sources[0].key.urlsafe()},
+                      testutil.get_task_params(queued[0]))
+
+  def test_refetch_hfeed_task_deduped_across_hours(self):
+    """If last_hfeed_fetch doesn't advance, we should only add one refetch per
+    refetch period."""
+    self._setup_refetch_hfeed()
+    period = self.sources[0].refetch_period()
+    start = util.EPOCH + period * 200000
+    for now in (start, start + datetime.timedelta(hours=1),
+                start + period - datetime.timedelta(seconds=1)):
+      util.now_fn = lambda: now
+      util.add_refetch_hfeed_task(self.sources[0])
+    self.assertEquals(1, len(self.taskqueue_stub.GetTasks('refetch-hfeed')))
+
+    util.now_fn = lambda: start + period
+    util.add_refetch_hfeed_task(self.sources[0])
+    self.assertEquals(2, len(self.taskqueue_stub.GetTasks('refetch-hfeed')))
+
+  def test_refetch_hfeed_source_disabled(self):
+    self._setup_refetch_hfeed()
+    util.add_refetch_hfeed_task(self.sources[0])
+    self.sources[0].status = 'disabled'
+    self.sources[0].put()
+
+    self.mox.ReplayAll()
+    self.refetch_hfeed()
+    self.assertEquals(NOW - models.Source.REFETCH_PERIOD -
+                      datetime.timedelta(minutes=10),
+                      self.sources[0].key.get().last_hfeed_fetch)
 
   def test_refetch_hfeed_repropagate_responses_query_expired(self):
     """https://github.com/snarfed/bridgy/issues/515"""
@@ -1083,11 +1186,13 @@ class PollTest(TaskQueueTest):
     self._expect_fetch_hfeed()
 
     self.mox.StubOutWithMock(Response, 'query')
-    Response.query(Response.source == self.sources[0].key).AndRaise(exception)
+    Response.query(Response.source == self.sources[0].key,
+                   mox.IgnoreArg()).AndRaise(exception)
     self.mox.ReplayAll()
 
     # should 200
     self.post_task()
+    self.refetch_hfeed()
     self.assertEquals(NOW, self.sources[0].key.get().last_hfeed_fetch)
 
   def test_no_duplicate_syndicated_posts(self):
@@ -1224,6 +1329,7 @@ class PollTest(TaskQueueTest):
     for source in self.sources:
       source = source.key.get()
       self.post_task(source=source)
+      self.refetch_hfeed()
       self.assertEquals(NOW, source.key.get().last_hfeed_fetch)
 
     assert_syndicated_posts(
@@ -1268,12 +1374,13 @@ class PollTest(TaskQueueTest):
     self._change_response_and_poll()
 
     # return new response *and* existing response. both should be stored in
-    # Source.seen_responses_cache_json
+    # SourceState.seen_responses_cache_json
     replies = activity['object']['replies']['items']
     replies.append(self.activities[1]['object']['replies']['items'][0])
 
     self.post_task(reset=True)
-    self.assert_equals(replies, json.loads(source.key.get().seen_responses_cache_json))
+    self.assert_equals(replies, json.loads(
+      source.key.get().load_state().seen_responses_cache_json))
     self.responses[3].key.delete()
 
     # new responses that don't include existing response. cache will have
@@ -1284,7 +1391,8 @@ class PollTest(TaskQueueTest):
     self.post_task(reset=True)
     self.assert_equals([r.key for r in self.responses[:3]],
                        list(Response.query().iter(keys_only=True)))
-    self.assert_equals(tags, json.loads(source.key.get().seen_responses_cache_json))
+    self.assert_equals(tags, json.loads(
+      source.key.get().load_state().seen_responses_cache_json))
 
   def _change_response_and_poll(self):
     resp = self.responses[0].key.get() or self.responses[0]
@@ -1313,7 +1421,53 @@ class PollTest(TaskQueueTest):
     self.taskqueue_stub.FlushQueue('propagate')
 
     source = self.sources[0].key.get()
-    self.assert_equals([reply], json.loads(source.seen_responses_cache_json))
+    self.assert_equals([reply], json.loads(
+      source.load_state().seen_responses_cache_json))
+
+
+class CrawlPermalinksTest(TaskQueueTest):
+
+  post_url = '/_ah/queue/crawl-permalinks'
+
+  def setUp(self):
+    super(CrawlPermalinksTest, self).setUp()
+    FakeGrSource.DOMAIN = 'source'
+    self.sources[0].domain_urls = ['http://author']
+    self.sources[0].put()
+
+  def tearDown(self):
+    FakeGrSource.DOMAIN = 'fa.ke'
+    super(CrawlPermalinksTest, self).tearDown()
+
+  def test_crawl_permalinks(self):
+    """Leftover permalinks should be crawled and their responses repropagated."""
+    for r in self.responses:
+      r.status = 'complete'
+      r.put()
+
+    self.mox.ReplayAll()
+    self.post_task(params={
+      'source_key': self.sources[0].key.urlsafe(),
+      'entries': json.dumps([['http://author/permalink',
+                              ['http://source/post/url']]]),
+      'refetch': 'true',
+      'store_blanks': 'true',
+    })
+
+    relationships = SyndicatedPost.query(ancestor=self.sources[0].key).fetch()
+    self.assertEquals(1, len(relationships))
+    self.assertEquals('http://author/permalink', relationships[0].original)
+    self.assertEquals('https://source/post/url', relationships[0].syndication)
+
+    self.assertEquals(9, len(self.taskqueue_stub.GetTasks('propagate')))
+    self.assertEquals(NOW, self.sources[0].key.get().last_syndication_url)
+
+  def test_source_disabled(self):
+    self.sources[0].status = 'disabled'
+    self.sources[0].put()
+    self.post_task(params={'source_key': self.sources[0].key.urlsafe(),
+                           'entries': '[]'})
+    self.assertEquals(0, SyndicatedPost.query().count())
 
 
 class PropagateTest(TaskQueueTest):
@@ -1369,6 +1523,24 @@ class PropagateTest(TaskQueueTest):
     mock_send.error = error
     return mock_send.send(timeout=999, headers=util.USER_AGENT_HEADER)
 
+  def test_resend_of_changed_response_not_counted(self):
+    """Sending to a target counts, resending a changed response doesn't."""
+    self.expect_webmention().AndReturn(True)
+    self.expect_webmention().AndReturn(True)
+    self.mox.ReplayAll()
+
+    self.post_task()
+    resp = self.responses[0].key.get()
+    resp.status = 'new'
+    resp.unsent = resp.sent
+    resp.sent = []
+    resp.old_response_jsons = [resp.response_json]
+    resp.put()
+    self.post_task()
+
+    self.assertEquals({'webmentions': 1},
+                      models.Counter.get_counts(('webmentions',)))
+
   def test_propagate(self):
     """Normal propagate tasks."""
     self.assertEqual('new', self.responses[0].status)
@@ -1530,13 +1702,16 @@ class PropagateTest(TaskQueueTest):
     self.assert_response_is('complete')
 
   def test_non_html_file(self):
-    """If our HEAD fails, we should still require content-type text/html."""
+    """If our HEAD and GET fail, we should still require content-type
+    text/html."""
     self.mox.UnsetStubs()  # drop WebmentionSend mock; let it run
     super(PropagateTest, self).setUp()
 
     self.responses[0].unsent = ['http://not/html']
     self.responses[0].put()
     self.expect_requests_head('http://not/html', status_code=405)
+    self.expect_requests_get('http://not/html', status_code=405,
+                             allow_redirects=True)
     self.expect_webmention_requests_get(
       'http://not/html', content_type='image/gif', timeout=999, verify=False)
 
@@ -1545,13 +1720,15 @@ class PropagateTest(TaskQueueTest):
     self.assert_response_is('complete', skipped=['http://not/html'])
 
   def test_non_html_file_extension(self):
-    """If our HEAD fails, we should infer type from file extension."""
+    """If our HEAD and GET fail, we should infer type from file extension."""
     self.responses[0].unsent = ['http://this/is/a.pdf']
     self.responses[0].put()
 
     self.expect_requests_head('http://this/is/a.pdf', status_code=405,
                               # we should ignore an error response's content type
                               content_type='text/html')
+    self.expect_requests_get('http://this/is/a.pdf', status_code=405,
+                             content_type='text/html', allow_redirects=True)
 
     self.mox.ReplayAll()
     self.post_task()
@@ -1565,6 +1742,8 @@ class PropagateTest(TaskQueueTest):
     self.responses[0].unsent = ['http://html/charset']
     self.responses[0].put()
     self.expect_requests_head('http://html/charset', status_code=405)
+    self.expect_requests_get('http://html/charset', status_code=405,
+                             allow_redirects=True)
     self.expect_webmention_requests_get(
       'http://html/charset',
       content_type='text/html; charset=utf-8',
@@ -1590,6 +1769,8 @@ class PropagateTest(TaskQueueTest):
     self.responses[0].unsent = ['http://unknown/type']
     self.responses[0].put()
     self.expect_requests_head('http://unknown/type', status_code=405)
+    self.expect_requests_get('http://unknown/type', status_code=405,
+                             allow_redirects=True)
     self.expect_webmention_requests_get('http://unknown/type', content_type=None,
                                         timeout=999, verify=False)
 
@@ -1933,3 +2114,184 @@ class PropagateTest(TaskQueueTest):
                           ).AndReturn(True)
     self.mox.ReplayAll()
     self.post_task()
+
+
+class GarbageCollectTest(TaskQueueTest):
+
+  post_url = '/_ah/queue/gc'
+
+  def setUp(self):
+    super(GarbageCollectTest, self).setUp()
+    # everything stored in this test is more than a year old
+    util.now_fn = lambda: NOW + datetime.timedelta(days=400)
+
+  def gc(self, policy, **params):
+    """Runs a gc task and any follow-up tasks it adds."""
+    params['policy'] = policy
+    self.post_task(params=params)
+    while True:
+      queued = self.taskqueue_stub.GetTasks('gc')
+      if not queued:
+        break
+      self.taskqueue_stub.FlushQueue('gc')
+      for task in queued:
+        self.post_task(params=testutil.get_task_params(task))
+
+  def test_responses(self):
+    for resp in self.responses:
+      resp.status = 'complete'
+      resp.put()
+    pending = Response(id='pending', source=self.sources[0].key, status='error')
+    pending.put()
+
+    self.gc('Response')
+
+    # complete responses are kept for dedupe, minus their JSON
+    for resp in Response.query(Response.status == 'complete'):
+      self.assertIsNone(resp.response_json)
+      self.assertEqual([], resp.activities_json)
+      self.assertEqual([], resp.activity_keys)
+      self.assertEqual(['http://target1/post/url'], resp.unsent)
+    self.assertEqual(len(self.responses) + 1, Response.query().count())
+
+    # and not propagated again if the silo returns them again
+    self.taskqueue_stub.FlushQueue('propagate')
+    self.responses[0].get_or_save(self.sources[0])
+    self.assertEqual([], self.taskqueue_stub.GetTasks('propagate'))
+
+  def test_responses_orphaned_activities(self):
+    util.now_fn = lambda: NOW
+    shared, other = models.Activity.store_multi(['{"id": "1"}', '{"id": "2"}'])
+    util.now_fn = lambda: NOW + datetime.timedelta(days=400)
+    old = Response(id='old', source=self.sources[0].key, status='complete',
+                   response_json='{}', activity_keys=[shared, other])
+    old.put()
+    pending = Response(id='pending', source=self.sources[0].key, status='new',
+                       response_json='{}', activity_keys=[shared])
+    pending.put()
+
+    self.gc('Response')
+    self.assertEqual([shared], models.Activity.query().fetch(keys_only=True))
+    self.assertEqual([shared], pending.key.get().activity_keys)
+
+  def test_responses_activity_reused_during_gc(self):
+    """A new response can reuse an old activity while gc is deleting it."""
+    util.now_fn = lambda: NOW
+    key = models.Activity.store_multi(['{"id": "1"}'])[0]
+    util.now_fn = lambda: NOW + datetime.timedelta(days=400)
+    Response(id='old', source=self.sources[0].key, status='complete',
+             response_json='{}', activity_keys=[key]).put()
+
+    # a new like on the old post, stored after gc's query for responses that
+    # refer to the activity
+    orig = models.Activity.delete_unused_multi
+    def store_then_delete(keys, cutoff):
+      self.assertEqual([key], models.Activity.store_multi(['{"id": "1"}']))
+      return orig(keys, cutoff)
+    self.mox.stubs.Set(models.Activity, 'delete_unused_multi',
+                       staticmethod(store_then_delete))
+
+    self.gc('Response')
+    self.assertIsNotNone(key.get())
+
+  def test_archive_policy_skips_already_archived(self):
+    for resp in self.responses:
+      resp.status = 'complete'
+      resp.put()
+    self.gc('Response')
+    cutoff = NOW.replace(microsecond=0) + datetime.timedelta(days=35)
+    self.assertEqual(
+      cutoff, models.GarbageCollection.get_by_id('Response').archived_before)
+
+    # the next run only looks at responses updated since the last cutoff, so it
+    # doesn't rewrite the ones we already archived
+    util.now_fn = lambda: NOW + datetime.timedelta(days=401)
+    self.mox.StubOutWithMock(ndb, 'put_multi')
+    self.mox.ReplayAll()
+    self.gc('Response')
+    self.assertEqual(
+      cutoff + datetime.timedelta(days=1),
+      models.GarbageCollection.get_by_id('Response').archived_before)
+
+  def test_responses_too_new(self):
+    util.now_fn = lambda: NOW
+    for resp in self.responses:
+      resp.status = 'complete'
+      resp.put()
+
+    self.gc('Response')
+    self.assertEqual(len(self.responses), Response.query().count())
+
+  def test_dry_run(self):
+    for resp in self.responses:
+      resp.status = 'complete'
+      resp.put()
+
+    self.gc('Response', dry_run='true')
+    self.assertEqual(len(self.responses), Response.query().count())
+    for resp in Response.query():
+      self.assertIsNotNone(resp.response_json)
+    self.assertIsNone(models.GarbageCollection.get_by_id('Response'))
+
+  def test_batches(self):
+    self.mox.stubs.Set(tasks, 'GC_BATCH_SIZE', 2)
+    for resp in self.responses:
+      resp.status = 'complete'
+      resp.put()
+
+    self.gc('Response')
+    self.assertEqual(len(self.responses), Response.query().count())
+    for resp in Response.query():
+      self.assertIsNone(resp.response_json)
+
+  def test_publish_html(self):
+    page = models.PublishedPage(id='http://foo/post')
+    page.put()
+    complete = models.Publish(parent=page.key, source=self.sources[0].key,
+                              status='complete', type='comment', html='<p>x</p>')
+    complete.put()
+    failed = models.Publish(parent=page.key, source=self.sources[0].key,
+                            status='failed', html='<p>y</p>')
+    failed.put()
+
+    self.gc('Publish-html')
+    self.gc('Publish-failed')
+
+    # the complete one is kept for dedupe
+    publishes = models.Publish.query().fetch()
+    self.assertEqual([complete.key], [p.key for p in publishes])
+    self.assertIsNone(publishes[0].html)
+    self.assertEqual('complete', publishes[0].status)
+
+  def test_syndicated_post_blanks(self):
+    source = self.sources[0]
+    SyndicatedPost.insert_multi(source, [
+      ('http://silo/1', 'http://original/1'),
+      ('http://silo/2', None),
+      (None, 'http://original/3'),
+    ])
+
+    self.gc('SyndicatedPost')
+    self.assertItemsEqual(
+      [('http://silo/1', 'http://original/1'), (None, 'http://original/3')],
+      [(r.syndication, r.original) for r in SyndicatedPost.query()])
+
+  def test_caches(self):
+    now = util.now_fn()
+    old = now - datetime.timedelta(days=100)
+    util.ResolvedUrl(id='http://old', fetched=old).put()
+    util.ResolvedUrl(id='http://new', fetched=now).put()
+    util.FetchFailure(id='domain old', failures=3, retry_after=old).put()
+    util.FetchFailure(id='domain new', failures=3, retry_after=now).put()
+    models.DomainCapability(id='old', last_probe=old).put()
+    models.DomainCapability(id='new', last_probe=now).put()
+
+    for policy in 'ResolvedUrl', 'FetchFailure', 'DomainCapability':
+      self.gc(policy)
+
+    def ids(model):
+      return [key.id() for key in model.query().iter(keys_only=True)]
+
+    self.assertEqual(['http://new'], ids(util.ResolvedUrl))
+    self.assertEqual(['domain new'], ids(util.FetchFailure))
+    self.assertEqual(['new'], ids(models.DomainCapability))
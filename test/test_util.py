@@ -7,7 +7,9 @@ import urlparse
 
 from appengine_config import HTTP_TIMEOUT
 
+from google.appengine.api import memcache
 from google.appengine.ext import ndb
+import requests
 import webapp2
 from webmentiontools import send
 
@@ -145,6 +147,183 @@ class UtilTest(testutil.ModelsTest):
     self.assert_equals(('https://end', 'end', True),
                        util.get_webmention_target('http://orig', resolve=True))
 
+  def test_get_webmention_targets(self):
+    self.expect_requests_head('http://a', redirected_url='http://final')
+    self.expect_requests_head('http://pdf', content_type='application/pdf')
+    self.mox.ReplayAll()
+
+    self.assert_equals({
+      'http://a': ('http://final', 'final', True),
+      'http://pdf': ('http://pdf', 'pdf', False),
+    }, util.get_webmention_targets(['http://a', 'http://pdf', 'http://a']))
+
+  def test_follow_redirects_stores_chain(self):
+    self.expect_requests_head('http://orig',
+                              redirected_url=['http://middle', 'https://end'])
+    self.mox.ReplayAll()
+
+    self.assertEquals('https://end', util.follow_redirects('http://orig').url)
+
+    # second time should use the stored ResolvedUrls, not fetch
+    for url in 'http://orig', 'https://end':
+      resp = util.follow_redirects(url)
+      self.assertEquals('https://end', resp.url)
+      self.assertEquals(200, resp.status_code)
+      self.assertTrue(resp.headers['content-type'].startswith('text/html'))
+
+    self.assertEquals([], util.ResolvedUrl.get_by_id('https://end').history)
+
+  def test_follow_redirects_expired(self):
+    util.ResolvedUrl(id='http://orig', final_url='http://old', status=200,
+                     fetched=util.now_fn() - util.RESOLVED_URL_TTL -
+                             datetime.timedelta(seconds=1)).put()
+    self.expect_requests_head('http://orig', redirected_url='http://new')
+    self.mox.ReplayAll()
+
+    self.assertEquals('http://new', util.follow_redirects('http://orig').url)
+    self.assertEquals('http://new',
+                      util.ResolvedUrl.get_by_id('http://orig').final_url)
+
+  def test_follow_redirects_head_not_allowed(self):
+    self.expect_requests_head('http://orig', status_code=405)
+    self.expect_requests_get('http://orig', '', allow_redirects=True,
+                             redirected_url='http://final')
+    # we only need the headers, so the streamed GET should be closed
+    self.mox.StubOutWithMock(requests.Response, 'close')
+    requests.Response.close()
+    self.mox.ReplayAll()
+
+    self.assertEquals('http://final', util.follow_redirects('http://orig').url)
+
+  def test_follow_redirects_failure(self):
+    self.expect_requests_head('http://orig', status_code=500)
+    self.mox.ReplayAll()
+
+    resp = util.follow_redirects('http://orig')
+    self.assertEquals('http://orig', resp.url)
+    self.assertEquals('text/html', resp.headers['content-type'])
+
+    stored = util.ResolvedUrl.get_by_id('http://orig')
+    self.assertIsNone(stored.status)
+    util.now_fn = lambda: stored.fetched + util.RESOLVED_URL_FAILURE_TTL * 2
+    self.assertTrue(stored.expired())
+
+  def test_follow_redirects_failure_guesses_type_from_extension(self):
+    """Same as granary's follow_redirects did before we replaced it."""
+    self.expect_requests_head('http://orig/a.pdf', status_code=500)
+    self.expect_requests_head('http://orig/b.html', status_code=500)
+    self.mox.ReplayAll()
+
+    self.assertEquals('application/pdf', util.follow_redirects(
+      'http://orig/a.pdf').headers['content-type'])
+    self.assertEquals('text/html', util.follow_redirects(
+      'http://orig/b.html').headers['content-type'])
+
+  def test_follow_redirects_multi(self):
+    util.ResolvedUrl(id='http://stored', final_url='http://final', status=200,
+                     fetched=util.now_fn()).put()
+    self.expect_requests_head('http://a', redirected_url='http://final')
+    self.expect_requests_head('http://b')
+    self.mox.ReplayAll()
+
+    self.assertEquals(
+      {'http://a': 'http://final', 'http://b': 'http://b',
+       'http://stored': 'http://final'},
+      {url: resp.url for url, resp in util.follow_redirects_multi(
+        ['http://a', 'http://stored', 'http://b', 'http://a']).items()})
+
+  def test_fetch_failure_backoff(self):
+    url = 'http://dead/a'
+    self.assertTrue(util.FetchFailure.should_fetch(url))
+
+    util.FetchFailure.record_failure(url, 404)
+    self.assertFalse(util.FetchFailure.should_fetch(url))
+    self.assertTrue(util.FetchFailure.should_fetch('http://dead/b'))
+    self.assertIsNone(util.FetchFailure.get_by_id('domain dead'))
+
+    first = util.FetchFailure.get_by_id('url ' + url).retry_after - util.now_fn()
+    self.assertTrue(util.FETCH_BACKOFF_BASE * 3 / 4 <= first
+                    <= util.FETCH_BACKOFF_BASE * 5 / 4)
+    util.FetchFailure.record_failure(url, 404)
+    second = util.FetchFailure.get_by_id('url ' + url).retry_after - util.now_fn()
+    self.assertTrue(util.FETCH_BACKOFF_BASE * 3 / 2 <= second
+                    <= util.FETCH_BACKOFF_BASE * 5 / 2)
+
+    util.now_fn = lambda: datetime.datetime(2000, 1, 1) + util.FETCH_BACKOFF_MAX
+    self.assertTrue(util.FetchFailure.should_fetch(url))
+
+    util.FetchFailure.record_success(url)
+    self.assertIsNone(util.FetchFailure.get_by_id('url ' + url))
+
+  def test_fetch_failure_backoff_many_failures(self):
+    url = 'http://dead/a'
+    util.FetchFailure(id='url ' + url, failures=1000).put()
+    util.FetchFailure.record_failure(url, 404)
+
+    failure = util.FetchFailure.get_by_id('url ' + url)
+    self.assertEquals(1001, failure.failures)
+    self.assertTrue(failure.retry_after - util.now_fn()
+                    <= util.FETCH_BACKOFF_MAX * 5 / 4)
+
+  def test_fetch_failure_domain_backoff(self):
+    for i in range(util.DOMAIN_FAILURE_THRESHOLD - 1):
+      util.FetchFailure.record_failure('http://dead/%d' % i, 503)
+    self.assertTrue(util.FetchFailure.should_fetch('http://dead/other'))
+
+    util.FetchFailure.record_failure('http://dead/x',
+                                     requests.ConnectionError('foo'))
+    self.assertFalse(util.FetchFailure.should_fetch('http://dead/other'))
+
+    # any success clears the domain
+    util.FetchFailure.record_success('http://dead/0')
+    self.assertTrue(util.FetchFailure.should_fetch('http://dead/other'))
+    self.assertFalse(util.FetchFailure.should_fetch('http://dead/1'))
+
+  def test_fetch_failure_load_multi(self):
+    util.FetchFailure.record_failure('http://dead/a', 404)
+    failures = util.FetchFailure.load_multi(['http://dead/a', 'http://dead/b'])
+    self.assertEquals(['url http://dead/a'],
+                      [f.key.id() for f in failures['http://dead/a']])
+    self.assertEquals([], failures['http://dead/b'])
+
+    self.assertFalse(util.FetchFailure.should_fetch(
+      'http://dead/a', failures=failures['http://dead/a']))
+    self.assertTrue(util.FetchFailure.should_fetch(
+      'http://dead/b', failures=failures['http://dead/b']))
+
+    util.FetchFailure.record_success('http://dead/a',
+                                     failures=failures['http://dead/a'])
+    self.assertIsNone(util.FetchFailure.get_by_id('url http://dead/a'))
+
+  def test_run_parallel(self):
+    util.MAX_PARALLEL_REQUESTS = 3
+    self.assertEquals([2, 4, 6, 8, 10],
+                      util.run_parallel(lambda x: x * 2, [1, 2, 3, 4, 5]))
+
+    def fn(x):
+      if x % 2:
+        raise ValueError(x)
+      return x
+
+    with self.assertRaises(ValueError) as e:
+      util.run_parallel(fn, [2, 3, 4, 5])
+    self.assertEquals((3,), e.exception.args)
+
+  def test_run_parallel_ndb(self):
+    util.MAX_PARALLEL_REQUESTS = 2
+
+    def store(url):
+      # not waited on. run_parallel should finish it before the thread ends.
+      util.ResolvedUrl(id=url, final_url=url).put_async()
+      return ndb.get_context()
+
+    urls = ['http://a', 'http://b']
+    contexts = util.run_parallel(store, urls)
+    self.assertNotIn(ndb.get_context(), contexts)
+    self.assertNotEqual(contexts[0], contexts[1])
+    self.assertEquals(urls, [r.final_url for r in ndb.get_multi(
+      ndb.Key(util.ResolvedUrl, url) for url in urls)])
+
   def test_registration_callback(self):
     """Run through an authorization back and forth and make sure that
     the external callback makes it all the way through.
@@ -324,3 +503,58 @@ class UtilTest(testutil.ModelsTest):
 
     for good in 'snarfed.org', 'www.snarfed.org', 't.co.com':
       self.assertFalse(util.in_webmention_blacklist(good), good)
+
+  def test_cached_page_tiers(self):
+    util.CachedPage.store('/foo', 'bar')
+
+    # local
+    self.assertEqual('bar', util.CachedPage.load('/foo').html)
+
+    # memcache
+    util.CachedPage._local.clear()
+    self.assertEqual('bar', util.CachedPage.load('/foo').html)
+
+    # datastore
+    util.CachedPage._local.clear()
+    memcache.flush_all()
+    self.assertEqual('bar', util.CachedPage.load('/foo').html)
+    self.assertIsNotNone(memcache.get('CachedPage page /foo'))
+
+  def test_cached_page_invalidate_drops_local_copies(self):
+    util.CachedPage.store('/foo', 'bar')
+    self.assertEqual('bar', util.CachedPage.load('/foo').html)
+
+    util.CachedPage.invalidate('/foo')
+    self.assertIsNone(util.CachedPage.load('/foo'))
+    self.assertIsNone(util.CachedPage.get_by_id('/foo'))
+
+  def test_cached_page_store_drops_other_local_copies(self):
+    util.CachedPage.store('/foo', 'old')
+    self.assertEqual('old', util.CachedPage.load('/foo').html)
+
+    # simulate a store in another instance
+    util.CachedPage(id='/foo', html='new').put()
+    memcache.set('CachedPage page /foo', {'html': 'new', 'expires': None})
+    memcache.incr('CachedPage version /foo')
+    self.assertEqual('new', util.CachedPage.load('/foo').html)
+
+  def test_cached_page_expired(self):
+    util.CachedPage.store('/foo', 'bar', expires=datetime.timedelta(minutes=1))
+    self.assertFalse(util.CachedPage.load('/foo').expired())
+
+    util.now_fn = lambda: datetime.datetime(2000, 1, 1, 0, 2)
+    page = util.CachedPage.load('/foo')
+    self.assertEqual('bar', page.html)
+    self.assertTrue(page.expired())
+
+    # only one re-render task at a time
+    util.CachedPage.refresh('/foo')
+    util.CachedPage.refresh('/foo')
+    tasks = self.taskqueue_stub.GetTasks('render-page')
+    self.assertEqual(1, len(tasks))
+    self.assertEqual({'path': '/foo'}, testutil.get_task_params(tasks[0]))
+
+    # storing releases the lock
+    util.CachedPage.store('/foo', 'baz')
+    util.CachedPage.refresh('/foo')
+    self.assertEqual(2, len(self.taskqueue_stub.GetTasks('render-page')))
@@ -15,7 +15,7 @@ from granary import source as gr_source
 from granary import testutil as gr_testutil
 from google.appengine.datastore import datastore_stub_util
 from google.appengine.ext import ndb
-from models import Response, Source
+from models import DomainIndex, Response, Source
 from oauth_dropins.models import BaseAuth
 # mirror some methods from webutil.testutil
 from oauth_dropins import handlers as oauth_handlers
@@ -181,6 +181,10 @@ class HandlerTest(gr_testutil.TestCase):
     self.handler = util.Handler(self.request, self.response)
     FakeGrSource.clear()
     util.now_fn = lambda: NOW
+    # resolve URLs etc. serially so that mox sees requests in a stable order
+    util.MAX_PARALLEL_REQUESTS = 1
+    DomainIndex._cache.clear()
+    util.CachedPage._local.clear()
 
     # we use global queries in tests to verify entities in the datastore, so
     # make the datastore stub always return consistent data. not ideal, since it
@@ -309,6 +313,7 @@ class ModelsTest(HandlerTest):
           type='comment',
           source=self.sources[0].key,
           unsent=['http://target1/post/url'],
+          activity_urls=['https://source/post/url'],
           created=created))
 
       created += datetime.timedelta(hours=1)
@@ -321,6 +326,7 @@ class ModelsTest(HandlerTest):
           type='like',
           source=self.sources[0].key,
           unsent=['http://target1/post/url'],
+          activity_urls=['https://source/post/url'],
           created=created))
 
       created += datetime.timedelta(hours=1)
@@ -333,6 +339,7 @@ class ModelsTest(HandlerTest):
           type='repost',
           source=self.sources[0].key,
           unsent=['http://target1/post/url'],
+          activity_urls=['https://source/post/url'],
           created=created))
 
       created += datetime.timedelta(hours=1)
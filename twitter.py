@@ -118,7 +118,7 @@ class Twitter(models.Source):
     """
     id = self.gr_source.tag_uri('%s_favorited_by_%s' % (activity_id, like_user_id))
     resp = models.Response.get_by_id(id)
-    if resp:
+    if resp and resp.response_json:  # not archived by gc
       return json.loads(resp.response_json)
     else:
       return super(Twitter, self).get_like(activity_user_id, activity_id,
@@ -5,8 +5,14 @@
 import collections
 import Cookie
 import datetime
+import hashlib
+import itertools
 import json
+import mimetypes
+import random
 import re
+import sys
+import threading
 import urllib
 import urlparse
 
@@ -71,6 +77,23 @@ MAX_HTTP_RESPONSE_SIZE = 500000
 # Returned as the HTTP status code when we refuse to make or finish a request.
 HTTP_REQUEST_REFUSED_STATUS_CODE = 599
 
+# How long ResolvedUrls are used before we resolve the URL again.
+RESOLVED_URL_TTL = datetime.timedelta(days=7)
+RESOLVED_URL_FAILURE_TTL = datetime.timedelta(hours=1)
+
+# Exponential backoff for URLs and domains we fail to fetch. See FetchFailure.
+FETCH_BACKOFF_BASE = datetime.timedelta(minutes=30)
+FETCH_BACKOFF_MAX = datetime.timedelta(days=7)
+DOMAIN_FAILURE_THRESHOLD = 3
+
+# Max permalinks to pass to one crawl-permalinks task, and max size of their
+# JSON. Task payloads are limited to 100KB.
+CRAWL_TASK_MAX_ENTRIES = 200
+CRAWL_TASK_MAX_BYTES = 90 * 1000
+
+# Max number of threads for run_parallel(). Unit tests set this to 1.
+MAX_PARALLEL_REQUESTS = 10
+
 # Unpacked representation of logged in account in the logins cookie.
 Login = collections.namedtuple('Login', ('site', 'name', 'path'))
 
@@ -121,6 +144,94 @@ def add_propagate_blogpost_task(entity, **kwargs):
   logging.info('Added propagate-blogpost task: %s', task.name)
 
 
+def add_crawl_permalinks_task(source, entries, refetch=False, store_blanks=True,
+                              **kwargs):
+  """Adds a crawl-permalinks task for h-feed permalinks we didn't get to.
+
+  Only each h-entry's u-syndication links are passed along, since that's all
+  original_post_discovery needs from the h-feed. At most
+  CRAWL_TASK_MAX_ENTRIES entries, and CRAWL_TASK_MAX_BYTES of them, are passed
+  along. The rest are dropped; later polls will get to them.
+
+  The task is named after the source and a hash of the permalinks, so that
+  every poll that runs out of crawl budget on the same h-feed doesn't add
+  another task for the same permalinks.
+
+  Args:
+    source: Source entity
+    entries: sequence of (string permalink, mf2 h-entry dict) tuples
+    refetch: boolean, passed through to original_post_discovery
+    store_blanks: boolean, passed through to original_post_discovery
+  """
+  entries = [(permalink, [url for url in
+                          entry.get('properties', {}).get('syndication', [])
+                          if isinstance(url, basestring)])
+             for permalink, entry in list(entries)[:CRAWL_TASK_MAX_ENTRIES]]
+  entries_json = json.dumps(entries)
+  while len(entries_json) > CRAWL_TASK_MAX_BYTES:
+    entries = entries[:len(entries) / 2]
+    entries_json = json.dumps(entries)
+
+  digest = hashlib.sha1(u'\n'.join(
+    [permalink for permalink, _ in entries] +
+    [unicode(bool(refetch)), unicode(bool(store_blanks))]).encode('utf-8'))
+  name = '-'.join((source.key.urlsafe(), digest.hexdigest()))
+  try:
+    task = taskqueue.add(queue_name='crawl-permalinks', name=name,
+                         params={'source_key': source.key.urlsafe(),
+                                 'entries': entries_json,
+                                 'refetch': 'true' if refetch else '',
+                                 'store_blanks': 'true' if store_blanks else ''},
+                         target=taskqueue.DEFAULT_APP_VERSION,
+                         **kwargs)
+  except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+    logging.info('crawl-permalinks task %s already exists', name)
+    return
+
+  logging.info('Added crawl-permalinks task %s for %d permalinks',
+               task.name, len(entries))
+
+
+def add_refetch_hfeed_task(source, **kwargs):
+  """Adds a refetch-hfeed task for the given source entity.
+
+  The task is named after the source, its last_hfeed_fetch, and the current
+  slot of source.refetch_period() since the epoch, so that polls that run
+  before the refetch finishes don't add duplicates. If a refetch fails for
+  good and last_hfeed_fetch doesn't advance, we try again at most once per
+  refetch period.
+  """
+  slot = int((now_fn() - EPOCH).total_seconds() //
+             source.refetch_period().total_seconds())
+  name = '-'.join((source.key.urlsafe(),
+                   source.last_hfeed_fetch.strftime(POLL_TASK_DATETIME_FORMAT),
+                   str(slot)))
+  try:
+    task = taskqueue.add(queue_name='refetch-hfeed', name=name,
+                         params={'source_key': source.key.urlsafe()},
+                         target=taskqueue.DEFAULT_APP_VERSION,
+                         **kwargs)
+  except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+    logging.info('refetch-hfeed task %s already exists', name)
+    return
+
+  logging.info('Added refetch-hfeed task %s', task.name)
+
+
+def add_gc_task(policy, dry_run=False, **params):
+  """Adds a gc task for the given garbage collection policy.
+
+  Args:
+    policy: string, key in tasks.RETENTION
+    dry_run: boolean, whether to only count what we'd collect
+    params: passed through as task parameters, e.g. cursor
+  """
+  params.update({'policy': policy, 'dry_run': 'true' if dry_run else 'false'})
+  task = taskqueue.add(queue_name='gc', params=params,
+                       target=taskqueue.DEFAULT_APP_VERSION)
+  logging.info('Added gc task %s for %s', task.name, policy)
+
+
 def webmention_endpoint_cache_key(url):
   """Returns memcache key for a cached webmention endpoint for a given URL.
 
@@ -170,12 +281,155 @@ def requests_get(url, **kwargs):
 
 
 def follow_redirects(url, cache=True):
-  """Wraps granary.source.follow_redirects and injects our settings.
+  """Follows a URL's redirects, with results cached in ResolvedUrl.
+
+  Args:
+    url: string
+    cache: boolean, whether to use and update ResolvedUrl
+
+  Returns: requests.Response. Only url, status_code, headers['content-type'],
+    and history (with just urls) are populated when it comes from the cache.
+  """
+  return follow_redirects_multi([url], cache=cache)[url]
+
+
+def follow_redirects_multi(urls, cache=True):
+  """Follows multiple URLs' redirects at once.
+
+  Looks them all up in ResolvedUrl with one batch get, then resolves the
+  misses in parallel, up to MAX_PARALLEL_REQUESTS at a time, and stores the
+  results for every URL in their redirect chains. The store is async so that it
+  doesn't hold up read-only requests; it finishes the next time ndb waits, or
+  at the end of the request for ndb.toplevel applications.
+
+  Args:
+    urls: sequence of string URLs
+    cache: boolean, whether to use and update ResolvedUrl
+
+  Returns: dict mapping each URL to a requests.Response, as in follow_redirects()
+  """
+  urls = uniquify(urls)
+  # ResolvedUrls are in their own entity groups, so they'd break transactions
+  cache = cache and not ndb.in_transaction()
+
+  resolved = {}
+  if cache:
+    cacheable = [url for url in urls if ResolvedUrl.cacheable(url)]
+    for url, stored in zip(cacheable, ndb.get_multi(
+        ndb.Key(ResolvedUrl, url) for url in cacheable)):
+      if stored and not stored.expired():
+        resolved[url] = stored.response()
 
-  ...specifically memcache and USER_AGENT_HEADER.
+  misses = [url for url in urls if url not in resolved]
+  for url, resp in zip(misses, run_parallel(_resolve_redirects, misses)):
+    resolved[url] = resp
+
+  if cache and misses:
+    ndb.put_multi_async(itertools.chain.from_iterable(
+      ResolvedUrl.for_chain(url, resolved[url]) for url in misses))
+
+  return resolved
+
+
+def _resolve_redirects(url):
+  """Resolves a URL with HEAD, or GET if the server doesn't support HEAD.
+
+  Never raises an exception except AssertionError (for unit tests). If the
+  request fails, returns a fake response with just the original URL, a content
+  type guessed from its file extension (default text/html), and no status code.
+
+  Args:
+    url: string
+
+  Returns: requests.Response
   """
-  return gr_source.follow_redirects(url, cache=memcache if cache else None,
-                                    headers=USER_AGENT_HEADER)
+  if not urlparse.urlparse(url).scheme:
+    url = 'http://' + url
+
+  kwargs = {'allow_redirects': True, 'timeout': HTTP_TIMEOUT,
+            'headers': USER_AGENT_HEADER}
+  try:
+    resp = requests.head(url, **kwargs)
+    if resp.status_code in (405, 501):
+      logging.info('HEAD %s returned %s, trying GET', url, resp.status_code)
+      # stream so that we only fetch the headers, not the body, then close to
+      # release the connection
+      resp = requests.get(url, stream=True, **kwargs)
+      resp.close()
+    resp.raise_for_status()
+  except AssertionError:
+    raise  # for unit tests
+  except BaseException, e:
+    logging.warning("Couldn't resolve URL %s : %s", url, e)
+    resp = requests.Response()
+    resp.url = url
+    # guess the type from the file extension, if any
+    resp.headers['content-type'] = mimetypes.guess_type(url)[0] or 'text/html'
+    return resp
+
+  if resp.url != url:
+    logging.debug('Resolved %s to %s', url, resp.url)
+
+  refresh = resp.headers.get('refresh')
+  if refresh:
+    for part in refresh.split(';'):
+      if part.strip().startswith('url='):
+        return _resolve_redirects(part.strip()[4:])
+
+  return resp
+
+
+def run_parallel(fn, args):
+  """Calls a function on each of a sequence of arguments in parallel.
+
+  Uses up to MAX_PARALLEL_REQUESTS threads. Runs everything in the current
+  thread if that's 1, or if there's only one argument.
+
+  ndb contexts aren't thread safe, so each call in a thread gets its own fresh
+  one, and any async datastore calls it starts are finished before it returns.
+  Callers shouldn't hand entities from their own context to fn if fn modifies
+  them.
+
+  If any calls raise an exception, the first one (in argument order) is
+  re-raised after all calls have finished.
+
+  Args:
+    fn: one-argument function
+    args: sequence of arguments
+
+  Returns: list of return values, in the same order as args
+  """
+  args = list(args)
+  if MAX_PARALLEL_REQUESTS <= 1 or len(args) <= 1:
+    return [fn(arg) for arg in args]
+
+  results = [None] * len(args)
+  errors = [None] * len(args)
+  todo = collections.deque(enumerate(args))
+  call = ndb.toplevel(fn)
+
+  def worker():
+    while True:
+      try:
+        i, arg = todo.popleft()
+      except IndexError:
+        return
+      try:
+        results[i] = call(arg)
+      except BaseException:
+        errors[i] = sys.exc_info()
+
+  threads = [threading.Thread(target=worker)
+             for _ in range(min(MAX_PARALLEL_REQUESTS, len(args)))]
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+
+  for error in errors:
+    if error:
+      raise error[0], error[1], error[2]
+  return results
 
 
 def get_webmention_target(url, resolve=True):
@@ -192,22 +446,51 @@ def get_webmention_target(url, resolve=True):
     True if we should send a webmention, False otherwise, e.g. if it's a bad
     URL, not text/html, or in the blacklist.
   """
-  url = util.clean_url(url)
-  try:
-    domain = domain_from_link(url).lower()
-  except BaseException:
-    logging.info('Dropping bad URL %s.', url)
-    return url, None, False
+  return get_webmention_targets([url], resolve=resolve)[url]
+
+
+def get_webmention_targets(urls, resolve=True):
+  """Like get_webmention_target(), but for multiple URLs at once.
+
+  Resolves all of the URLs together with follow_redirects_multi(), so they're
+  fetched in parallel.
+
+  Args:
+    urls: sequence of string URLs
+    resolve: whether to follow redirects
+
+  Returns: dict mapping each URL to a (string url, string pretty domain,
+    boolean) tuple, as in get_webmention_target()
+  """
+  cleaned = {}
+  for url in urls:
+    clean = util.clean_url(url)
+    try:
+      cleaned[url] = clean, domain_from_link(clean).lower()
+    except BaseException:
+      logging.info('Dropping bad URL %s.', clean)
 
-  send = True
   if resolve:
     # this follows *all* redirects, until the end
-    resolved = follow_redirects(url, cache=memcache)
-    send = resolved.headers.get('content-type', '').startswith('text/html')
-    url, domain, _ = get_webmention_target(resolved.url, resolve=False)
+    resolved = follow_redirects_multi([clean for clean, _ in cleaned.values()])
+
+  targets = {}
+  for url in urls:
+    if url not in cleaned:
+      targets[url] = util.clean_url(url), None, False
+      continue
+
+    clean, domain = cleaned[url]
+    send = True
+    if resolve:
+      resp = resolved[clean]
+      send = resp.headers.get('content-type', '').startswith('text/html')
+      clean, domain, _ = get_webmention_target(resp.url, resolve=False)
+
+    send = send and domain and not in_webmention_blacklist(domain)
+    targets[url] = replace_test_domains_with_localhost(clean), domain, send
 
-  send = send and domain and not in_webmention_blacklist(domain)
-  return replace_test_domains_with_localhost(url), domain, send
+  return targets
 
 
 def in_webmention_blacklist(domain):
@@ -520,10 +803,18 @@ def oauth_starter(oauth_start_handler, **kwargs):
 class CachedPage(StringIdModel):
   """Cached HTML for pages that changes rarely. Key id is path.
 
-  Stored in the datastore since datastore entities in memcache (mostly
-  Responses) are requested way more often, so it would get evicted
+  Cached in three tiers: a small in-process LRU cache, memcache, and the
+  datastore. The datastore backs memcache since datastore entities in memcache
+  (mostly Responses) are requested way more often, so pages would get evicted
   out of memcache easily.
 
+  Each path has a version number in memcache that store() and invalidate()
+  bump. In-process entries remember the version they were loaded at, so a bump
+  in one instance makes every instance drop its local copy.
+
+  Expired pages are still returned by load(). Callers should serve them and call
+  refresh() to re-render them in the background.
+
   Keys, useful for deleting from memcache:
   /: aglzfmJyaWQtZ3lyEQsSCkNhY2hlZFBhZ2UiAS8M
   /users: aglzfmJyaWQtZ3lyFgsSCkNhY2hlZFBhZ2UiBi91c2Vycww
@@ -531,17 +822,59 @@ class CachedPage(StringIdModel):
   html = ndb.TextProperty()
   expires = ndb.DateTimeProperty()
 
+  # max pages in each instance's in-process cache
+  LOCAL_CACHE_SIZE = 20
+  # how long a re-render task holds the lock for its path, in seconds
+  LOCK_TTL = 5 * 60
+
+  # maps path to (version, CachedPage), least recently used first
+  _local = collections.OrderedDict()
+  _local_lock = threading.Lock()
+
+  def expired(self):
+    return self.expires and now_fn() > self.expires
+
+  @staticmethod
+  def _memcache_keys(path):
+    """Returns (version, page, lock) memcache keys for a path."""
+    return ['CachedPage %s %s' % (kind, path)
+            for kind in ('version', 'page', 'lock')]
+
+  @classmethod
+  def _set_local(cls, path, version, page):
+    with cls._local_lock:
+      cls._local.pop(path, None)
+      cls._local[path] = (version, page)
+      while len(cls._local) > cls.LOCAL_CACHE_SIZE:
+        cls._local.popitem(last=False)
+
   @classmethod
   def load(cls, path):
-    cached = CachedPage.get_by_id(path)
+    """Returns the cached page for path, or None. May be expired."""
+    version_key, page_key, _ = cls._memcache_keys(path)
+    got = memcache.get_multi([version_key, page_key])
+    version = got.get(version_key) or 0
+
+    with cls._local_lock:
+      local = cls._local.get(path)
+    if local and local[0] == version:
+      logging.info('Found cached page for %s in local cache', path)
+      cls._set_local(path, version, local[1])
+      return local[1]
+
+    cached = got.get(page_key)
     if cached:
-      if cached.expires and now_fn() > cached.expires:
-        logging.info('Deleting expired cached page for %s', path)
-        cached.key.delete()
+      logging.info('Found cached page for %s in memcache', path)
+      page = CachedPage(id=path, **cached)
+    else:
+      page = CachedPage.get_by_id(path)
+      if not page:
         return None
-      else:
-        logging.info('Found cached page for %s', path)
-    return cached
+      logging.info('Found cached page for %s in datastore', path)
+      memcache.set(page_key, {'html': page.html, 'expires': page.expires})
+
+    cls._set_local(path, version, page)
+    return page
 
   @classmethod
   def store(cls, path, html, expires=None):
@@ -550,9 +883,199 @@ class CachedPage(StringIdModel):
     if expires is not None:
       logging.info('  (expires in %s)', expires)
       expires = now_fn() + expires
-    CachedPage(id=path, html=html, expires=expires).put()
+    page = CachedPage(id=path, html=html, expires=expires)
+    page.put()
+
+    version_key, page_key, lock_key = cls._memcache_keys(path)
+    version = memcache.incr(version_key, initial_value=0)
+    memcache.set(page_key, {'html': html, 'expires': expires})
+    memcache.delete(lock_key)
+    if version is not None:
+      cls._set_local(path, version, page)
+
+  @classmethod
+  def refresh(cls, path, host_url=None):
+    """Adds a task to re-render an expired page, unless one's already running.
+
+    Args:
+      path: string
+      host_url: string, scheme and host of the request that served the expired
+        page, e.g. 'https://brid.gy'. The task renders with the same ones, so
+        that links and images in the page match. Optional.
+    """
+    _, _, lock_key = cls._memcache_keys(path)
+    if memcache.add(lock_key, '', time=cls.LOCK_TTL):
+      logging.info('Adding task to re-render cached page for %s', path)
+      params = {'path': path}
+      if host_url:
+        params['host_url'] = host_url
+      taskqueue.add(queue_name='render-page', params=params,
+                    target=taskqueue.DEFAULT_APP_VERSION)
 
   @classmethod
   def invalidate(cls, path):
     logging.info('Deleting cached page for %s', path)
     CachedPage(id=path).key.delete()
+    version_key, page_key, _ = cls._memcache_keys(path)
+    memcache.delete(page_key)
+    memcache.incr(version_key, initial_value=0)
+
+
+class ResolvedUrl(StringIdModel):
+  """Where a URL redirects to, and what's there. Key id is the URL.
+
+  Written by follow_redirects(). Every URL in a redirect chain gets its own
+  entity, so later lookups of intermediate URLs are cached too. Failed
+  resolutions are stored with status None and expire sooner.
+  """
+  final_url = ndb.StringProperty(indexed=False)
+  content_type = ndb.StringProperty(indexed=False)
+  status = ndb.IntegerProperty(indexed=False)
+  # this URL and the redirects after it, before final_url, in order. empty if
+  # it doesn't redirect. same as requests.Response.history.
+  history = ndb.StringProperty(repeated=True, indexed=False)
+  fetched = ndb.DateTimeProperty()
+
+  @staticmethod
+  def cacheable(url):
+    """Returns True if url is short enough to be a datastore key id."""
+    return len(url.encode('utf-8') if isinstance(url, unicode) else url) <= 500
+
+  @classmethod
+  def for_chain(cls, url, resp):
+    """Returns unsaved ResolvedUrls for each URL in a response's redirect chain.
+
+    Args:
+      url: string, the URL that was resolved
+      resp: requests.Response from _resolve_redirects()
+    """
+    chain = uniquify([url] + [r.url for r in resp.history] + [resp.url])
+    return [cls(id=u, final_url=resp.url, status=resp.status_code,
+                content_type=resp.headers.get('content-type'),
+                history=chain[i:-1], fetched=now_fn())
+            for i, u in enumerate(chain) if cls.cacheable(u)]
+
+  def expired(self):
+    ttl = RESOLVED_URL_TTL if self.status else RESOLVED_URL_FAILURE_TTL
+    return now_fn() > self.fetched + ttl
+
+  def response(self):
+    """Returns a requests.Response with the stored values."""
+    resp = requests.Response()
+    resp.url = self.final_url
+    resp.status_code = self.status
+    if self.content_type:
+      resp.headers['content-type'] = self.content_type
+    resp.history = [requests.Response() for _ in self.history]
+    for r, url in zip(resp.history, self.history):
+      r.url = url
+    return resp
+
+
+class FetchFailure(StringIdModel):
+  """Remembers that we've failed to fetch a URL or domain, so we can back off.
+
+  Key id is 'url URL' or 'domain DOMAIN'. Every failure extends the backoff
+  exponentially, with jitter, up to FETCH_BACKOFF_MAX. A domain is only backed
+  off after DOMAIN_FAILURE_THRESHOLD failures that look like the whole site is
+  down, ie connection failures and 5xxes, not 4xxes for individual pages. A
+  successful fetch deletes both the URL's and the domain's entities.
+  """
+  failures = ndb.IntegerProperty(default=0)
+  retry_after = ndb.DateTimeProperty()
+
+  @classmethod
+  def _keys(cls, url):
+    """Returns the URL's and the domain's keys, either of which may be None."""
+    domain = domain_from_link(url)
+    return [ndb.Key(cls, 'url ' + url) if ResolvedUrl.cacheable(url) else None,
+            ndb.Key(cls, 'domain ' + domain) if domain else None]
+
+  @classmethod
+  def _get_multi(cls, keys):
+    return ndb.get_multi([key for key in keys if key])
+
+  @classmethod
+  def load_multi(cls, urls):
+    """Loads the failures for many URLs and their domains in one batch get.
+
+    Pass each URL's value to should_fetch() and record_success() as failures
+    to save them a datastore get each.
+
+    Returns: dict mapping each URL to a list of its and its domain's
+      FetchFailures, possibly empty
+    """
+    keys = {url: [key for key in cls._keys(url) if key] for url in urls}
+    all_keys = uniquify(itertools.chain.from_iterable(keys.values()))
+    loaded = dict(zip(all_keys, ndb.get_multi(all_keys)))
+    return {url: [loaded[key] for key in url_keys if loaded[key]]
+            for url, url_keys in keys.items()}
+
+  @classmethod
+  def should_fetch(cls, url, failures=None):
+    """Returns False if url or its domain is currently backed off.
+
+    Args:
+      url: string
+      failures: optional list of FetchFailures from load_multi()
+    """
+    if failures is None:
+      failures = cls._get_multi(cls._keys(url))
+    for failure in failures:
+      if failure and failure.backed_off():
+        logging.info('Skipping %s after %d failures, backed off until %s',
+                     failure.key.id(), failure.failures, failure.retry_after)
+        return False
+    return True
+
+  @classmethod
+  def record_success(cls, url, failures=None):
+    """Clears url's and its domain's backoff, if any.
+
+    Args:
+      url: string
+      failures: optional list of FetchFailures from load_multi()
+    """
+    if failures is None:
+      failures = cls._get_multi(cls._keys(url))
+    keys = [f.key for f in failures if f]
+    if keys:
+      logging.info('Fetched %s, clearing backoff for %s', url, keys)
+      ndb.delete_multi(keys)
+
+  @classmethod
+  def record_failure(cls, url, error=None):
+    """Extends url's backoff, and its domain's if the whole site looks down.
+
+    Args:
+      url: string
+      error: the exception or integer HTTP status code, if any
+
+    Returns: boolean, whether url's domain is now backed off
+    """
+    status = error if isinstance(error, int) else getattr(
+      getattr(error, 'response', None), 'status_code', None)
+    domain_wide = (status >= 500 if status
+                   else error is None or is_connection_failure(error))
+
+    url_key, domain_key = cls._keys(url)
+    keys = [url_key, domain_key if domain_wide else None]
+    failures = [f or cls(key=key) for key, f in
+                zip([k for k in keys if k], cls._get_multi(keys))]
+    for failure in failures:
+      failure.failures += 1
+      # cap the exponent first. timedelta overflows after ~36 doublings.
+      backoff = min(FETCH_BACKOFF_BASE * 2 ** min(failure.failures - 1, 20),
+                    FETCH_BACKOFF_MAX)
+      failure.retry_after = now_fn() + datetime.timedelta(
+        seconds=backoff.total_seconds() * random.uniform(.75, 1.25))
+      logging.info('Backing off %s until %s after %d failures',
+                   failure.key.id(), failure.retry_after, failure.failures)
+    ndb.put_multi(failures)
+    return bool(domain_key and domain_wide and failures[-1].backed_off())
+
+  def backed_off(self):
+    if (self.key.id().startswith('domain ') and
+        self.failures < DOMAIN_FAILURE_THRESHOLD):
+      return False
+    return now_fn() < self.retry_after